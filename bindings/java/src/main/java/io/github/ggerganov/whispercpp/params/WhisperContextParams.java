@@ -24,8 +24,19 @@ public class WhisperContextParams extends Structure {
         use_gpu = enable ? CBool.TRUE : CBool.FALSE;
     }
 
+    /** Map the model file instead of reading it, with the CPU backend (default = true) */
+    public CBool use_mmap;
+
+    /** Map the model file instead of reading it, with the CPU backend (default = true) */
+    public void useMmap(boolean enable) {
+        use_mmap = enable ? CBool.TRUE : CBool.FALSE;
+    }
+
+    /** Type of the KV caches: 0 - default, 1 - f16, 2 - q8_0 keys (see whisper_kv_type) */
+    public int kv_type;
+
     @Override
     protected List<String> getFieldOrder() {
-        return Arrays.asList("use_gpu");
+        return Arrays.asList("use_gpu", "use_mmap", "kv_type");
     }
 }
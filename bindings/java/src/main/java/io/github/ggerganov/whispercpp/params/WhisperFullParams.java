@@ -137,6 +137,9 @@ public class WhisperFullParams extends Structure {
         speed_up = enable ? CBool.TRUE : CBool.FALSE;
     }
 
+    /** Flag to enable debug mode, which provides extra info (e.g. dumps log_mel). (default = false) */
+    public CBool debug_mode;
+
     /** Overwrite the audio context size (0 = use default). */
     public int audio_ctx;
 
@@ -148,6 +151,23 @@ public class WhisperFullParams extends Structure {
         tdrz_enable = enable ? CBool.TRUE : CBool.FALSE;
     }
 
+    /** [EXPERIMENTAL] Flag to drop the frames without speech before the encoder. (default = false) */
+    public CBool vad;
+
+    /** [EXPERIMENTAL] Flag to drop the frames without speech before the encoder. (default = false) */
+    public void vadEnable(boolean enable) {
+        vad = enable ? CBool.TRUE : CBool.FALSE;
+    }
+
+    /** Speech threshold, as a fraction of the energy range above the noise floor. (default = 0.3) */
+    public float vad_thold;
+
+    /** Pauses shorter than this are kept, in milliseconds. */
+    public int vad_min_silence_ms;
+
+    /** Silence kept on each side of the speech, in milliseconds. */
+    public int vad_pad_ms;
+
     /** Tokens to provide to the whisper decoder as an initial prompt.
      * These are prepended to any existing text context from a previous call. */
     public String initial_prompt;
@@ -279,6 +299,28 @@ public class WhisperFullParams extends Structure {
      */
     public Pointer encoder_begin_callback_user_data;
 
+    /**
+     * Callback to run the encoder, instead of running it on the state.
+     * whisper_encode_callback
+     */
+    public Pointer encode_callback;
+
+    /**
+     * User data for the encode_callback.
+     */
+    public Pointer encode_callback_user_data;
+
+    /**
+     * Callback each time before ggml computation starts.
+     * whisper_abort_callback
+     */
+    public Pointer abort_callback;
+
+    /**
+     * User data for the abort_callback.
+     */
+    public Pointer abort_callback_user_data;
+
     /**
      * Callback by each decoder to filter obtained logits.
      * WhisperLogitsFilterCallback
@@ -318,13 +360,16 @@ public class WhisperFullParams extends Structure {
         return Arrays.asList("strategy", "n_threads", "n_max_text_ctx", "offset_ms", "duration_ms", "translate",
                 "no_context", "single_segment", "no_timestamps",
                 "print_special", "print_progress", "print_realtime", "print_timestamps",  "token_timestamps",
-                "thold_pt", "thold_ptsum", "max_len", "split_on_word", "max_tokens", "speed_up", "audio_ctx",
-                "tdrz_enable", "initial_prompt", "prompt_tokens", "prompt_n_tokens", "language", "detect_language",
+                "thold_pt", "thold_ptsum", "max_len", "split_on_word", "max_tokens", "speed_up", "debug_mode",
+                "audio_ctx", "tdrz_enable", "vad", "vad_thold", "vad_min_silence_ms", "vad_pad_ms",
+                "initial_prompt", "prompt_tokens", "prompt_n_tokens", "language", "detect_language",
                 "suppress_blank", "suppress_non_speech_tokens", "temperature", "max_initial_ts", "length_penalty",
                 "temperature_inc", "entropy_thold", "logprob_thold", "no_speech_thold", "greedy", "beam_search",
                 "new_segment_callback", "new_segment_callback_user_data",
                 "progress_callback", "progress_callback_user_data",
                 "encoder_begin_callback", "encoder_begin_callback_user_data",
+                "encode_callback", "encode_callback_user_data",
+                "abort_callback", "abort_callback_user_data",
                 "logits_filter_callback", "logits_filter_callback_user_data",
                 "grammar_rules", "n_grammar_rules", "i_start_rule", "grammar_penalty");
     }
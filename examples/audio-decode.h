@@ -0,0 +1,248 @@
+#pragma once
+
+// Decode audio from memory to the 16 kHz float PCM used by whisper
+//
+// Used by the server example, so that the common uploads are decoded straight from the request body, without a temp
+// file and an ffmpeg process:
+//
+//   - WAV, with any sample rate, number of channels and sample format supported by dr_wav (8/16/24/32-bit integer,
+//     32/64-bit float, A-law, mu-law)
+//   - raw interleaved PCM, s16le or f32le, with a given sample rate and number of channels
+//
+// Other sample rates are converted to 16 kHz with a polyphase windowed-sinc resampler
+//
+
+#include "dr_wav.h"
+
+#include <algorithm>
+#include <cmath>
+#include <cstdint>
+#include <cstring>
+#include <string>
+#include <vector>
+
+#define AUDIO_DECODE_SAMPLE_RATE 16000
+
+// the sample rates accepted for the input - they come from the client, and size the resampling buffers
+#define AUDIO_DECODE_MIN_SAMPLE_RATE 1000
+#define AUDIO_DECODE_MAX_SAMPLE_RATE 384000
+
+// the decoded audio is at most this long, 4 hours at 16 kHz
+#define AUDIO_DECODE_MAX_SAMPLES (4ull*3600*AUDIO_DECODE_SAMPLE_RATE)
+
+// the resampling filter spans this many zero crossings of the sinc on each side
+#define AUDIO_RESAMPLE_N_ZEROS 16
+
+// at most this many phases of the filter are precomputed, the positions of the other rates are rounded down to them
+#define AUDIO_RESAMPLE_MAX_PHASES 1024
+
+static bool audio_is_wav(const void * data, size_t size) {
+    return size >= 4 && (memcmp(data, "RIFF", 4) == 0 || memcmp(data, "RIFX", 4) == 0 || memcmp(data, "RF64", 4) == 0 || memcmp(data, "riff", 4) == 0);
+}
+
+static int audio_gcd(int a, int b) {
+    while (b != 0) {
+        const int t = a % b;
+        a = b;
+        b = t;
+    }
+    return a;
+}
+
+// resample src from rate_in to rate_out
+//
+// the output is sampled at the positions j*rate_in/rate_out of the input, L/M = rate_out/rate_in in lowest terms. For
+// each of the L phases of such a position between two input samples, the taps of the lowpass filter are precomputed,
+// so that an output sample is a dot product over n_taps input samples. The common rates have at most 640 phases, for
+// the others the phases are rounded down to AUDIO_RESAMPLE_MAX_PHASES
+static void audio_resample(const float * src, size_t n_src, int rate_in, int rate_out, std::vector<float> & dst) {
+    if (rate_in == rate_out) {
+        dst.assign(src, src + n_src);
+        return;
+    }
+
+    const int g = audio_gcd(rate_in, rate_out);
+    const int L = rate_out/g;
+    const int M = rate_in/g;
+
+    // cutoff in cycles per input sample, a bit below the lower of the two Nyquist frequencies
+    const double fc = 0.5*std::min(1.0, double(rate_out)/rate_in)*0.95;
+
+    // half the filter length, in input samples
+    const int n_half  = (int) std::ceil(AUDIO_RESAMPLE_N_ZEROS/(2.0*fc));
+    const int n_taps  = 2*n_half;
+
+    const int n_phases = std::min(L, AUDIO_RESAMPLE_MAX_PHASES);
+
+    // taps[p*n_taps + k] weighs the input sample n_half - 1 - k before the position, for a position p/n_phases past a sample
+    std::vector<float> taps((size_t) n_phases*n_taps);
+    for (int p = 0; p < n_phases; ++p) {
+        for (int k = 0; k < n_taps; ++k) {
+            const double t = double(p)/n_phases + n_half - 1 - k;
+            const double x = 2.0*fc*t;
+            const double w = t/n_half; // Blackman window over [-n_half, n_half]
+            double h = 0.0;
+            if (std::fabs(w) < 1.0) {
+                h = 2.0*fc*(x == 0.0 ? 1.0 : std::sin(M_PI*x)/(M_PI*x))*(0.42 + 0.5*std::cos(M_PI*w) + 0.08*std::cos(2.0*M_PI*w));
+            }
+            taps[(size_t) p*n_taps + k] = h;
+        }
+    }
+
+    const uint64_t n_dst = ((uint64_t) n_src*L + M - 1)/M;
+
+    dst.resize(n_dst);
+
+    for (uint64_t j = 0; j < n_dst; ++j) {
+        const uint64_t pos  = j*M;
+        const int64_t  base = pos/L;
+        const int      p    = (int) ((pos%L)*n_phases/L);
+
+        const float * h = taps.data() + (size_t) p*n_taps;
+
+        // input samples base - n_half + 1 .. base + n_half, clipped to the signal
+        const int64_t i0 = base - n_half + 1;
+        const int k0 = (int) std::max<int64_t>(0, -i0);
+        const int k1 = (int) std::min<int64_t>(n_taps, (int64_t) n_src - i0);
+
+        float sum = 0.0f;
+        for (int k = k0; k < k1; ++k) {
+            sum += h[k]*src[i0 + k];
+        }
+
+        dst[j] = sum;
+    }
+}
+
+// check the sample rate and the length of the input before the buffers are allocated - they come from the client
+static bool audio_check_size(uint64_t n_frames, int sample_rate, std::string & error) {
+    if (sample_rate < AUDIO_DECODE_MIN_SAMPLE_RATE || sample_rate > AUDIO_DECODE_MAX_SAMPLE_RATE) {
+        error = "unsupported sample rate " + std::to_string(sample_rate) + " Hz, must be between " +
+            std::to_string(AUDIO_DECODE_MIN_SAMPLE_RATE) + " and " + std::to_string(AUDIO_DECODE_MAX_SAMPLE_RATE) + " Hz";
+        return false;
+    }
+
+    if (n_frames/sample_rate > AUDIO_DECODE_MAX_SAMPLES/AUDIO_DECODE_SAMPLE_RATE) {
+        error = "audio is too long, at most " + std::to_string(AUDIO_DECODE_MAX_SAMPLES/AUDIO_DECODE_SAMPLE_RATE) + " seconds are supported";
+        return false;
+    }
+
+    return true;
+}
+
+// convert interleaved frames to mono, and to stereo if requested, at the whisper sample rate
+static bool audio_from_frames(
+        const float * frames, uint64_t n_frames, int n_channels, int sample_rate,
+        std::vector<float> & pcmf32, std::vector<std::vector<float>> & pcmf32s, bool stereo, std::string & error) {
+    if (n_channels < 1 || sample_rate < 1) {
+        error = "invalid number of channels or sample rate";
+        return false;
+    }
+
+    if (!audio_check_size(n_frames, sample_rate, error)) {
+        return false;
+    }
+
+    if (stereo && n_channels != 2) {
+        error = "audio must be stereo for diarization";
+        return false;
+    }
+
+    std::vector<float> mono(n_frames);
+    for (uint64_t i = 0; i < n_frames; ++i) {
+        float sum = 0.0f;
+        for (int c = 0; c < n_channels; ++c) {
+            sum += frames[i*n_channels + c];
+        }
+        mono[i] = sum/n_channels;
+    }
+
+    audio_resample(mono.data(), mono.size(), sample_rate, AUDIO_DECODE_SAMPLE_RATE, pcmf32);
+
+    if (stereo) {
+        pcmf32s.resize(2);
+
+        std::vector<float> channel(n_frames);
+        for (int c = 0; c < 2; ++c) {
+            for (uint64_t i = 0; i < n_frames; ++i) {
+                channel[i] = frames[2*i + c];
+            }
+            audio_resample(channel.data(), channel.size(), sample_rate, AUDIO_DECODE_SAMPLE_RATE, pcmf32s[c]);
+        }
+    }
+
+    return true;
+}
+
+// decode a WAV file from memory
+static bool audio_decode_wav(
+        const void * data, size_t size,
+        std::vector<float> & pcmf32, std::vector<std::vector<float>> & pcmf32s, bool stereo, std::string & error) {
+    drwav wav;
+    if (!drwav_init_memory(&wav, data, size, nullptr)) {
+        error = "failed to parse WAV data";
+        return false;
+    }
+
+    const int n_channels  = wav.channels;
+    const int sample_rate = wav.sampleRate;
+
+    // the frame count of a stream without a size in the header is unknown - fall back to the size of the data. The header
+    // cannot claim more frames than the data holds
+    uint64_t n_frames = wav.totalPCMFrameCount;
+    if (wav.channels*wav.bitsPerSample > 0) {
+        const uint64_t n_frames_max = (uint64_t) size*8/(wav.channels*wav.bitsPerSample);
+        if (n_frames == 0 || n_frames > n_frames_max) {
+            n_frames = n_frames_max;
+        }
+    }
+
+    if (!audio_check_size(n_frames, sample_rate, error)) {
+        drwav_uninit(&wav);
+        return false;
+    }
+
+    std::vector<float> frames(n_frames*n_channels);
+    n_frames = drwav_read_pcm_frames_f32(&wav, n_frames, frames.data());
+    drwav_uninit(&wav);
+
+    if (n_frames == 0) {
+        error = "failed to read samples from WAV data, or unsupported WAV format";
+        return false;
+    }
+
+    return audio_from_frames(frames.data(), n_frames, n_channels, sample_rate, pcmf32, pcmf32s, stereo, error);
+}
+
+// decode raw interleaved little-endian PCM from memory - format is "s16le" or "f32le"
+static bool audio_decode_raw(
+        const void * data, size_t size, const std::string & format, int sample_rate, int n_channels,
+        std::vector<float> & pcmf32, std::vector<std::vector<float>> & pcmf32s, bool stereo, std::string & error) {
+    if (n_channels < 1) {
+        error = "invalid number of channels";
+        return false;
+    }
+
+    std::vector<float> frames;
+
+    if (format == "s16le") {
+        const uint64_t n = size/sizeof(int16_t);
+        frames.resize(n);
+        drwav_s16_to_f32(frames.data(), (const int16_t *) data, n);
+    } else if (format == "f32le") {
+        const uint64_t n = size/sizeof(float);
+        frames.resize(n);
+        memcpy(frames.data(), data, n*sizeof(float));
+    } else {
+        error = "unsupported raw audio format '" + format + "', use s16le or f32le";
+        return false;
+    }
+
+    const uint64_t n_frames = frames.size()/n_channels;
+    if (n_frames == 0) {
+        error = "no samples in raw audio data";
+        return false;
+    }
+
+    return audio_from_frames(frames.data(), n_frames, n_channels, sample_rate, pcmf32, pcmf32s, stereo, error);
+}
@@ -1,4 +1,5 @@
 #include "whisper.h"
+#include "timings-json.h"
 
 #include <cstdio>
 #include <cstring>
@@ -11,6 +12,7 @@ struct whisper_params {
     int32_t what = 0; // what to benchmark: 0 - whisper ecoder, 1 - memcpy, 2 - ggml_mul_mat
 
     std::string model = "models/ggml-base.en.bin";
+    std::string fname_timings;
 
     bool use_gpu = true;
 };
@@ -29,6 +31,7 @@ bool whisper_params_parse(int argc, char ** argv, whisper_params & params) {
         else if (arg == "-m"  || arg == "--model")   { params.model     = argv[++i]; }
         else if (arg == "-w"  || arg == "--what")    { params.what      = atoi(argv[++i]); }
         else if (arg == "-ng" || arg == "--no-gpu")  { params.use_gpu   = false; }
+        else if (arg == "--timings-json")            { params.fname_timings = argv[++i]; }
         else {
             fprintf(stderr, "error: unknown argument: %s\n", arg.c_str());
             whisper_print_usage(argc, argv, params);
@@ -52,13 +55,14 @@ void whisper_print_usage(int /*argc*/, char ** argv, const whisper_params & para
     fprintf(stderr, "                           %-7s  0 - whisper\n",                                 "");
     fprintf(stderr, "                           %-7s  1 - memcpy\n",                                  "");
     fprintf(stderr, "                           %-7s  2 - ggml_mul_mat\n",                            "");
+    fprintf(stderr, "  --timings-json FNAME    [%-7s] write the performance information as JSON (- for stdout)\n", params.fname_timings.c_str());
     fprintf(stderr, "\n");
 }
 
 int whisper_bench_full(const whisper_params & params) {
     // whisper init
 
-    struct whisper_context_params cparams;
+    struct whisper_context_params cparams = whisper_context_default_params();
     cparams.use_gpu = params.use_gpu;
 
     struct whisper_context * ctx = whisper_init_from_file_with_params(params.model.c_str(), cparams);
@@ -133,6 +137,11 @@ int whisper_bench_full(const whisper_params & params) {
     }
 
     whisper_print_timings(ctx);
+
+    if (!params.fname_timings.empty()) {
+        whisper_timings_write_json(params.fname_timings, ctx, params.model, params.n_threads, 1);
+    }
+
     whisper_free(ctx);
 
     fprintf(stderr, "\n");
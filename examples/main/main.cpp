@@ -1,4 +1,5 @@
 #include "common.h"
+#include "timings-json.h"
 
 #include "whisper.h"
 
@@ -68,6 +69,7 @@ struct whisper_params {
     float word_thold    =  0.01f;
     float entropy_thold =  2.40f;
     float logprob_thold = -1.00f;
+    float vad_thold     =  0.30f;
 
     bool speed_up        = false;
     bool debug_mode      = false;
@@ -75,6 +77,7 @@ struct whisper_params {
     bool detect_language = false;
     bool diarize         = false;
     bool tinydiarize     = false;
+    bool vad             = false;
     bool split_on_word   = false;
     bool no_fallback     = false;
     bool output_txt      = false;
@@ -102,6 +105,10 @@ struct whisper_params {
 
     std::string openvino_encode_device = "CPU";
 
+    std::string kv_type = "default";
+
+    std::string fname_timings;
+
     std::vector<std::string> fname_inp = {};
     std::vector<std::string> fname_out = {};
 };
@@ -143,6 +150,8 @@ bool whisper_params_parse(int argc, char ** argv, whisper_params & params) {
         else if (arg == "-tr"   || arg == "--translate")       { params.translate       = true; }
         else if (arg == "-di"   || arg == "--diarize")         { params.diarize         = true; }
         else if (arg == "-tdrz" || arg == "--tinydiarize")     { params.tinydiarize     = true; }
+        else if (arg == "-vad"  || arg == "--vad")             { params.vad             = true; }
+        else if (arg == "-vt"   || arg == "--vad-thold")       { params.vad_thold       = std::stof(argv[++i]); }
         else if (arg == "-sow"  || arg == "--split-on-word")   { params.split_on_word   = true; }
         else if (arg == "-nf"   || arg == "--no-fallback")     { params.no_fallback     = true; }
         else if (arg == "-otxt" || arg == "--output-txt")      { params.output_txt      = true; }
@@ -155,6 +164,7 @@ bool whisper_params_parse(int argc, char ** argv, whisper_params & params) {
         else if (arg == "-oj"   || arg == "--output-json")     { params.output_jsn      = true; }
         else if (arg == "-ojf"  || arg == "--output-json-full"){ params.output_jsn_full = params.output_jsn = true; }
         else if (arg == "-of"   || arg == "--output-file")     { params.fname_out.emplace_back(argv[++i]); }
+        else if (                  arg == "--timings-json")    { params.fname_timings   = argv[++i]; }
         else if (arg == "-ps"   || arg == "--print-special")   { params.print_special   = true; }
         else if (arg == "-pc"   || arg == "--print-colors")    { params.print_colors    = true; }
         else if (arg == "-pp"   || arg == "--print-progress")  { params.print_progress  = true; }
@@ -167,6 +177,7 @@ bool whisper_params_parse(int argc, char ** argv, whisper_params & params) {
         else if (arg == "-oved" || arg == "--ov-e-device")     { params.openvino_encode_device = argv[++i]; }
         else if (arg == "-ls"   || arg == "--log-score")       { params.log_score       = true; }
         else if (arg == "-ng"   || arg == "--no-gpu")          { params.use_gpu         = false; }
+        else if (arg == "-kvt"  || arg == "--kv-type")         { params.kv_type         = argv[++i]; }
         else {
             fprintf(stderr, "error: unknown argument: %s\n", arg.c_str());
             whisper_print_usage(argc, argv, params);
@@ -201,6 +212,8 @@ void whisper_print_usage(int /*argc*/, char ** argv, const whisper_params & para
     fprintf(stderr, "  -tr,       --translate         [%-7s] translate from source language to english\n",      params.translate ? "true" : "false");
     fprintf(stderr, "  -di,       --diarize           [%-7s] stereo audio diarization\n",                       params.diarize ? "true" : "false");
     fprintf(stderr, "  -tdrz,     --tinydiarize       [%-7s] enable tinydiarize (requires a tdrz model)\n",     params.tinydiarize ? "true" : "false");
+    fprintf(stderr, "  -vad,      --vad               [%-7s] skip the parts of the audio without speech\n",    params.vad ? "true" : "false");
+    fprintf(stderr, "  -vt N,     --vad-thold N       [%-7.2f] VAD speech threshold, above the noise floor\n",  params.vad_thold);
     fprintf(stderr, "  -nf,       --no-fallback       [%-7s] do not use temperature fallback while decoding\n", params.no_fallback ? "true" : "false");
     fprintf(stderr, "  -otxt,     --output-txt        [%-7s] output result in a text file\n",                   params.output_txt ? "true" : "false");
     fprintf(stderr, "  -ovtt,     --output-vtt        [%-7s] output result in a vtt file\n",                    params.output_vtt ? "true" : "false");
@@ -211,6 +224,7 @@ void whisper_print_usage(int /*argc*/, char ** argv, const whisper_params & para
     fprintf(stderr, "  -ocsv,     --output-csv        [%-7s] output result in a CSV file\n",                    params.output_csv ? "true" : "false");
     fprintf(stderr, "  -oj,       --output-json       [%-7s] output result in a JSON file\n",                   params.output_jsn ? "true" : "false");
     fprintf(stderr, "  -ojf,      --output-json-full  [%-7s] include more information in the JSON file\n",      params.output_jsn_full ? "true" : "false");
+    fprintf(stderr, "             --timings-json FILE [%-7s] write the performance information as JSON (- for stdout)\n", params.fname_timings.c_str());
     fprintf(stderr, "  -of FNAME, --output-file FNAME [%-7s] output file path (without file extension)\n",      "");
     fprintf(stderr, "  -ps,       --print-special     [%-7s] print special tokens\n",                           params.print_special ? "true" : "false");
     fprintf(stderr, "  -pc,       --print-colors      [%-7s] print colors\n",                                   params.print_colors ? "true" : "false");
@@ -224,6 +238,7 @@ void whisper_print_usage(int /*argc*/, char ** argv, const whisper_params & para
     fprintf(stderr, "  -oved D,   --ov-e-device DNAME [%-7s] the OpenVINO device used for encode inference\n",  params.openvino_encode_device.c_str());
     fprintf(stderr, "  -ls,       --log-score         [%-7s] log best decoder scores of tokens\n",              params.log_score?"true":"false");
     fprintf(stderr, "  -ng,       --no-gpu            [%-7s] disable GPU\n",                                    params.use_gpu ? "false" : "true");
+    fprintf(stderr, "  -kvt T,    --kv-type T         [%-7s] KV cache type: default, f16 or q8_0\n",           params.kv_type.c_str());
     fprintf(stderr, "\n");
 }
 
@@ -880,9 +895,19 @@ int main(int argc, char ** argv) {
 
     // whisper init
 
-    struct whisper_context_params cparams;
+    struct whisper_context_params cparams = whisper_context_default_params();
     cparams.use_gpu = params.use_gpu;
 
+    if (params.kv_type == "f16") {
+        cparams.kv_type = WHISPER_KV_TYPE_F16;
+    } else if (params.kv_type == "q8_0") {
+        cparams.kv_type = WHISPER_KV_TYPE_Q8_0;
+    } else if (params.kv_type != "default") {
+        fprintf(stderr, "error: unknown KV cache type '%s'\n", params.kv_type.c_str());
+        whisper_print_usage(argc, argv, params);
+        exit(0);
+    }
+
     struct whisper_context * ctx = whisper_init_from_file_with_params(params.model.c_str(), cparams);
 
     if (ctx == nullptr) {
@@ -964,6 +989,9 @@ int main(int argc, char ** argv) {
 
             wparams.tdrz_enable      = params.tinydiarize; // [TDRZ]
 
+            wparams.vad              = params.vad;
+            wparams.vad_thold        = params.vad_thold;
+
             wparams.initial_prompt   = params.prompt.c_str();
 
             wparams.greedy.best_of        = params.best_of;
@@ -1072,6 +1100,11 @@ int main(int argc, char ** argv) {
     }
 
     whisper_print_timings(ctx);
+
+    if (!params.fname_timings.empty()) {
+        whisper_timings_write_json(params.fname_timings, ctx, params.model, params.n_threads, params.n_processors);
+    }
+
     whisper_free(ctx);
 
     return 0;
@@ -12,6 +12,8 @@
 #include <string>
 #include <vector>
 #include <regex>
+#include <sstream>
+#include <algorithm>
 
 // default hparams (Whisper tiny)
 struct whisper_hparams {
@@ -35,8 +37,263 @@ struct whisper_filters {
     std::vector<float> data;
 };
 
+// per-tensor precision policy
+//
+// a text file with one rule per line:
+//
+//   <regex> <type>
+//
+// where type is f32, f16 or one of the quantization types (q4_0, q4_1, q5_0, q5_1, q8_0, q2_k, q3_k, q4_k, q5_k, q6_k)
+// the first rule whose regex matches the full tensor name decides the type of the tensor - tensors that no rule
+// matches keep their type. empty lines and lines starting with '#' are ignored
+//
+// the 1D tensors and the tensors in the "to_skip" list below are never converted and the quantization types are only
+// applied to 2D tensors with a row size that is a multiple of the block size
+// the model ftype is taken from the type of a final catch-all ".*" rule, if there is one
+//
+// the same format is understood by the Python converters, see models/ggml_format.py
+//
+struct whisper_quant_rule {
+    std::string pattern;
+    std::regex  regex;
+    ggml_type   type;
+};
+
+static const std::map<std::string, ggml_type> WHISPER_QUANT_TYPES = {
+    {"f32",  GGML_TYPE_F32},
+    {"f16",  GGML_TYPE_F16},
+    {"q4_0", GGML_TYPE_Q4_0},
+    {"q4_1", GGML_TYPE_Q4_1},
+    {"q5_0", GGML_TYPE_Q5_0},
+    {"q5_1", GGML_TYPE_Q5_1},
+    {"q8_0", GGML_TYPE_Q8_0},
+    {"q2_k", GGML_TYPE_Q2_K},
+    {"q3_k", GGML_TYPE_Q3_K},
+    {"q4_k", GGML_TYPE_Q4_K},
+    {"q5_k", GGML_TYPE_Q5_K},
+    {"q6_k", GGML_TYPE_Q6_K},
+};
+
+static bool whisper_load_quant_policy(const std::string & fname, std::vector<whisper_quant_rule> & rules) {
+    auto fin = std::ifstream(fname);
+    if (!fin) {
+        fprintf(stderr, "%s: failed to open policy '%s'\n", __func__, fname.c_str());
+        return false;
+    }
+
+    std::string line;
+    for (int n_line = 1; std::getline(fin, line); n_line++) {
+        std::istringstream iss(line);
+
+        std::string pattern;
+        std::string type;
+        if (!(iss >> pattern) || pattern[0] == '#') {
+            continue;
+        }
+
+        std::string extra;
+        if (!(iss >> type) || ((iss >> extra) && extra[0] != '#')) {
+            fprintf(stderr, "%s: %s:%d: expected '<regex> <type>'\n", __func__, fname.c_str(), n_line);
+            return false;
+        }
+
+        std::transform(type.begin(), type.end(), type.begin(), ::tolower);
+
+        const auto it = WHISPER_QUANT_TYPES.find(type);
+        if (it == WHISPER_QUANT_TYPES.end()) {
+            fprintf(stderr, "%s: %s:%d: unknown type '%s'\n", __func__, fname.c_str(), n_line, type.c_str());
+            return false;
+        }
+
+        try {
+            rules.push_back({ pattern, std::regex(pattern), it->second });
+        } catch (const std::regex_error & e) {
+            fprintf(stderr, "%s: %s:%d: invalid regex '%s': %s\n", __func__, fname.c_str(), n_line, pattern.c_str(), e.what());
+            return false;
+        }
+    }
+
+    return true;
+}
+
+static ggml_ftype whisper_type_to_ftype(ggml_type type) {
+    switch (type) {
+        case GGML_TYPE_F32:  return GGML_FTYPE_ALL_F32;
+        case GGML_TYPE_F16:  return GGML_FTYPE_MOSTLY_F16;
+        case GGML_TYPE_Q4_0: return GGML_FTYPE_MOSTLY_Q4_0;
+        case GGML_TYPE_Q4_1: return GGML_FTYPE_MOSTLY_Q4_1;
+        case GGML_TYPE_Q5_0: return GGML_FTYPE_MOSTLY_Q5_0;
+        case GGML_TYPE_Q5_1: return GGML_FTYPE_MOSTLY_Q5_1;
+        case GGML_TYPE_Q8_0: return GGML_FTYPE_MOSTLY_Q8_0;
+        case GGML_TYPE_Q2_K: return GGML_FTYPE_MOSTLY_Q2_K;
+        case GGML_TYPE_Q3_K: return GGML_FTYPE_MOSTLY_Q3_K;
+        case GGML_TYPE_Q4_K: return GGML_FTYPE_MOSTLY_Q4_K;
+        case GGML_TYPE_Q5_K: return GGML_FTYPE_MOSTLY_Q5_K;
+        case GGML_TYPE_Q6_K: return GGML_FTYPE_MOSTLY_Q6_K;
+        default:             return GGML_FTYPE_UNKNOWN;
+    }
+}
+
+// with --align, the data of each tensor starts at a multiple of this many bytes - the names are padded with '\0' to get
+// there, so that whisper.cpp can map the file and use the tensor data in place (see WHISPER_TENSOR_ALIGNMENT in
+// whisper.cpp). Older whisper.cpp builds do not strip the padding and reject such files, so it is opt-in
+#define WHISPER_TENSOR_ALIGNMENT 32
+
+// convert the tensors according to a per-tensor precision policy
+static bool whisper_quantize_policy(
+        std::ifstream & finp,
+        std::ofstream & fout,
+        const std::vector<whisper_quant_rule> & rules,
+        const std::vector<std::string> & to_skip,
+        bool align) {
+    size_t total_size_org = 0;
+    size_t total_size_new = 0;
+
+    std::vector<uint8_t>     data_u8;
+    std::vector<float>       data_f32;
+    std::vector<uint8_t>     work;
+    std::vector<int64_t>     hist(1 << 4, 0);
+
+    std::map<ggml_type, size_t> size_per_type;
+
+    while (true) {
+        int32_t n_dims;
+        int32_t length;
+        int32_t ttype;
+
+        finp.read(reinterpret_cast<char *>(&n_dims), sizeof(n_dims));
+        finp.read(reinterpret_cast<char *>(&length), sizeof(length));
+        finp.read(reinterpret_cast<char *>(&ttype),  sizeof(ttype));
+
+        if (finp.eof()) {
+            break;
+        }
+
+        int32_t nelements = 1;
+        int32_t ne[4] = { 1, 1, 1, 1 };
+        for (int i = 0; i < n_dims; ++i) {
+            finp.read (reinterpret_cast<char *>(&ne[i]), sizeof(ne[i]));
+            nelements *= ne[i];
+        }
+
+        std::string name(length, 0);
+        finp.read (&name[0], length);
+
+        // the input may be padded already
+        name.resize(strnlen(name.data(), name.size()));
+
+        const ggml_type type_src = (ggml_type) ttype;
+
+        data_u8.resize(nelements*ggml_type_size(type_src)/ggml_blck_size(type_src));
+        finp.read(reinterpret_cast<char *>(data_u8.data()), data_u8.size());
+
+        ggml_type type_dst = type_src;
+
+        bool skip = n_dims < 2;
+        for (const auto & s : to_skip) {
+            if (std::regex_match(name, std::regex(s))) {
+                skip = true;
+                break;
+            }
+        }
+
+        if (!skip) {
+            for (const auto & rule : rules) {
+                if (std::regex_match(name, rule.regex)) {
+                    type_dst = rule.type;
+                    break;
+                }
+            }
+        }
+
+        if (ggml_is_quantized(type_dst) && (n_dims != 2 || ne[0] % ggml_blck_size(type_dst) != 0)) {
+            printf("%64s - cannot be stored as %s, keeping %s\n", name.data(), ggml_type_name(type_dst), ggml_type_name(type_src));
+            type_dst = type_src;
+        }
+
+        if (type_dst != type_src && type_src != GGML_TYPE_F32 && type_src != GGML_TYPE_F16) {
+            fprintf(stderr, "%s: cannot convert tensor '%s' from %s\n", __func__, name.c_str(), ggml_type_name(type_src));
+            return false;
+        }
+
+        printf("%64s - [%5d, %5d, %5d], type = %6s -> %6s ", name.data(), ne[0], ne[1], ne[2], ggml_type_name(type_src), ggml_type_name(type_dst));
+
+        const int32_t ttype_dst = type_dst;
+
+        // pad the name so that the data is aligned
+        if (align) {
+            const size_t pos_data = (size_t) fout.tellp() + 3*sizeof(int32_t) + n_dims*sizeof(int32_t) + name.size();
+            name.resize(name.size() + (WHISPER_TENSOR_ALIGNMENT - pos_data % WHISPER_TENSOR_ALIGNMENT) % WHISPER_TENSOR_ALIGNMENT, '\0');
+        }
+
+        const int32_t length_dst = name.size();
+
+        fout.write(reinterpret_cast<const char *>(&n_dims),     sizeof(n_dims));
+        fout.write(reinterpret_cast<const char *>(&length_dst), sizeof(length_dst));
+        fout.write(reinterpret_cast<const char *>(&ttype_dst),  sizeof(ttype_dst));
+        for (int i = 0; i < n_dims; ++i) {
+            fout.write(reinterpret_cast<const char *>(&ne[i]), sizeof(ne[i]));
+        }
+        fout.write(&name[0], length_dst);
+
+        size_t cur_size = data_u8.size();
+
+        if (type_dst == type_src) {
+            fout.write(reinterpret_cast<const char *>(data_u8.data()), data_u8.size());
+        } else {
+            data_f32.resize(nelements);
+            if (type_src == GGML_TYPE_F16) {
+                const ggml_fp16_t * src = reinterpret_cast<const ggml_fp16_t *>(data_u8.data());
+                for (int i = 0; i < nelements; ++i) {
+                    data_f32[i] = ggml_fp16_to_fp32(src[i]);
+                }
+            } else {
+                memcpy(data_f32.data(), data_u8.data(), nelements*sizeof(float));
+            }
+
+            work.resize(nelements*sizeof(float));
+
+            switch (type_dst) {
+                case GGML_TYPE_F32:
+                    {
+                        cur_size = nelements*sizeof(float);
+                        memcpy(work.data(), data_f32.data(), cur_size);
+                    } break;
+                case GGML_TYPE_F16:
+                    {
+                        cur_size = nelements*sizeof(ggml_fp16_t);
+                        ggml_fp32_to_fp16_row(data_f32.data(), reinterpret_cast<ggml_fp16_t *>(work.data()), nelements);
+                    } break;
+                default:
+                    {
+                        cur_size = ggml_quantize_chunk(type_dst, data_f32.data(), work.data(), 0, nelements, hist.data());
+                    } break;
+            }
+
+            fout.write(reinterpret_cast<const char *>(work.data()), cur_size);
+        }
+
+        printf("size = %8.3f MB -> %8.3f MB\n", data_u8.size()/1024.0/1024.0, cur_size/1024.0/1024.0);
+
+        total_size_org += data_u8.size();
+        total_size_new += cur_size;
+
+        size_per_type[type_dst] += cur_size;
+    }
+
+    printf("%s: model size  = %8.2f MB\n", __func__, total_size_org/1024.0/1024.0);
+    printf("%s: quant size  = %8.2f MB\n", __func__, total_size_new/1024.0/1024.0);
+    for (const auto & kv : size_per_type) {
+        printf("%s:   %6s      = %8.2f MB\n", __func__, ggml_type_name(kv.first), kv.second/1024.0/1024.0);
+    }
+
+    return true;
+}
+
 // quantize a model
-bool whisper_model_quantize(const std::string & fname_inp, const std::string & fname_out, ggml_ftype ftype) {
+// if policy is not empty, the tensors are converted according to the policy rules and ftype is ignored
+// if align is true, the tensor data is aligned in the output, see WHISPER_TENSOR_ALIGNMENT
+bool whisper_model_quantize(const std::string & fname_inp, const std::string & fname_out, ggml_ftype ftype, const std::vector<whisper_quant_rule> & policy = {}, bool align = false) {
     gpt_vocab vocab;
 
     printf("%s: loading model from '%s'\n", __func__, fname_inp.c_str());
@@ -81,8 +338,16 @@ bool whisper_model_quantize(const std::string & fname_inp, const std::string & f
         finp.read((char *) &hparams.n_mels,        sizeof(hparams.n_mels));
         finp.read((char *) &hparams.ftype,         sizeof(hparams.ftype));
 
+        if (!policy.empty()) {
+            // the model ftype of a policy is the type of its catch-all rule, if any
+            ftype = (ggml_ftype) (hparams.ftype % GGML_QNT_VERSION_FACTOR);
+            if (policy.back().pattern == ".*") {
+                ftype = whisper_type_to_ftype(policy.back().type);
+            }
+        }
+
         const int32_t qntvr_src =    hparams.ftype / GGML_QNT_VERSION_FACTOR;
-        const int32_t ftype_dst = GGML_QNT_VERSION * GGML_QNT_VERSION_FACTOR + ftype;
+        const int32_t ftype_dst = (ftype == GGML_FTYPE_ALL_F32 || ftype == GGML_FTYPE_MOSTLY_F16) ? ftype : GGML_QNT_VERSION * GGML_QNT_VERSION_FACTOR + ftype;
 
         fprintf(stderr, "%s: n_vocab       = %d\n", __func__, hparams.n_vocab);
         fprintf(stderr, "%s: n_audio_ctx   = %d\n", __func__, hparams.n_audio_ctx);
@@ -164,7 +429,19 @@ bool whisper_model_quantize(const std::string & fname_inp, const std::string & f
         "decoder.positional_embedding",
     };
 
-    if (!ggml_common_quantize_0(finp, fout, ftype, { ".*" }, to_skip)) {
+    // a single type is a policy with a catch-all rule - the tensors are written the same way
+    std::vector<whisper_quant_rule> rules = policy;
+    if (rules.empty()) {
+        const ggml_type qtype = ggml_ftype_to_ggml_type(ftype);
+        if (!ggml_is_quantized(qtype)) {
+            fprintf(stderr, "%s: invalid model type %d\n", __func__, ftype);
+            return false;
+        }
+
+        rules.push_back({ ".*", std::regex(".*"), qtype });
+    }
+
+    if (!whisper_quantize_policy(finp, fout, rules, to_skip, align)) {
         fprintf(stderr, "%s: failed to quantize model '%s'\n", __func__, fname_inp.c_str());
         return false;
     }
@@ -176,12 +453,32 @@ bool whisper_model_quantize(const std::string & fname_inp, const std::string & f
 }
 
 int main(int argc, char ** argv) {
-    if (argc != 4) {
-        fprintf(stderr, "usage: %s model-f32.bin model-quant.bin type\n", argv[0]);
+    // --align: align the tensor data, so that whisper.cpp can map the file
+    const bool align = argc > 1 && std::string(argv[argc - 1]) == "--align";
+    if (align) {
+        argc--;
+    }
+
+    const bool use_policy = argc == 5 && std::string(argv[3]) == "--policy";
+
+    if (argc != 4 && !use_policy) {
+        fprintf(stderr, "usage: %s model-f32.bin model-quant.bin type [--align]\n", argv[0]);
+        fprintf(stderr, "       %s model-f32.bin model-quant.bin --policy policy.txt [--align]\n", argv[0]);
         ggml_print_ftypes(stderr);
         return 1;
     }
 
+    std::vector<whisper_quant_rule> policy;
+    if (use_policy) {
+        if (!whisper_load_quant_policy(argv[4], policy)) {
+            return 1;
+        }
+        if (policy.empty()) {
+            fprintf(stderr, "%s: policy '%s' has no rules\n", __func__, argv[4]);
+            return 1;
+        }
+    }
+
     // needed to initialize f16 tables
     {
         struct ggml_init_params params = { 0, NULL, false };
@@ -192,7 +489,7 @@ int main(int argc, char ** argv) {
     const std::string fname_inp = argv[1];
     const std::string fname_out = argv[2];
 
-    const ggml_ftype ftype = ggml_parse_ftype(argv[3]);
+    const ggml_ftype ftype = use_policy ? GGML_FTYPE_UNKNOWN : ggml_parse_ftype(argv[3]);
 
     const int64_t t_main_start_us = ggml_time_us();
 
@@ -202,7 +499,7 @@ int main(int argc, char ** argv) {
     {
         const int64_t t_start_us = ggml_time_us();
 
-        if (!whisper_model_quantize(fname_inp, fname_out, ggml_ftype(ftype))) {
+        if (!whisper_model_quantize(fname_inp, fname_out, ggml_ftype(ftype), policy, align)) {
             fprintf(stderr, "%s: failed to quantize model from '%s'\n", __func__, fname_inp.c_str());
             return 1;
         }
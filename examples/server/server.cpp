@@ -1,12 +1,22 @@
 #include "common.h"
+#include "audio-decode.h"
 
 #include "whisper.h"
 #include "httplib.h"
 #include "json.hpp"
 
+#include <atomic>
+#include <chrono>
 #include <cmath>
+#include <condition_variable>
+#include <deque>
+#include <exception>
 #include <fstream>
+#include <functional>
+#include <map>
+#include <memory>
 #include <cstdio>
+#include <mutex>
 #include <string>
 #include <thread>
 #include <vector>
@@ -44,7 +54,17 @@ struct server_params
     int32_t port          = 8080;
     int32_t read_timeout  = 600;
     int32_t write_timeout = 600;
-    
+
+    int32_t n_workers     = 1;  // number of requests processed in parallel, each with its own whisper_state
+    int32_t queue_size    = 16; // number of requests that can wait for a free worker
+    int32_t retry_after   = 5;  // seconds, sent with 503 when the queue is full
+
+    int32_t encoder_batch = 0;  // max number of requests encoded together, 0 - each worker runs its own encoder
+    int32_t batch_wait_ms = 10; // how long the first request of a batch waits for others
+
+    std::vector<std::pair<std::string, std::string>> models; // NAME=FNAME, in addition to -m
+    int32_t models_mem_mb = 0; // memory limit of the resident models, 0 - no limit
+
     bool ffmpeg_converter = false;
 };
 
@@ -64,6 +84,7 @@ struct whisper_params {
     float entropy_thold =  2.40f;
     float logprob_thold = -1.00f;
     float userdef_temp  =  0.20f;
+    float vad_thold     =  0.30f;
 
     bool speed_up        = false;
     bool debug_mode      = false;
@@ -71,6 +92,7 @@ struct whisper_params {
     bool detect_language = false;
     bool diarize         = false;
     bool tinydiarize     = false;
+    bool vad             = false;
     bool split_on_word   = false;
     bool no_fallback     = false;
     bool print_special   = false;
@@ -79,6 +101,7 @@ struct whisper_params {
     bool print_progress  = false;
     bool no_timestamps   = false;
     bool use_gpu         = true;
+    bool stream          = false; // send the segments as Server-Sent Events while they are decoded
 
     std::string language        = "en";
     std::string prompt          = "";
@@ -87,10 +110,17 @@ struct whisper_params {
 
     std::string response_format     = json_format;
 
+    // raw PCM uploads: "s16le" or "f32le", empty for WAV and the formats converted by ffmpeg
+    std::string audio_format = "";
+    int32_t     sample_rate  = WHISPER_SAMPLE_RATE;
+    int32_t     channels     = 1;
+
     // [TDRZ] speaker turn string
     std::string tdrz_speaker_turn = " [SPEAKER_TURN]"; // TODO: set from command line
 
     std::string openvino_encode_device = "CPU";
+
+    std::string kv_type = "default";
 };
 
 //  500 -> 00:05.000
@@ -127,8 +157,8 @@ void whisper_print_usage(int /*argc*/, char ** argv, const whisper_params & para
     fprintf(stderr, "\n");
     fprintf(stderr, "options:\n");
     fprintf(stderr, "  -h,        --help              [default] show this help message and exit\n");
-    fprintf(stderr, "  -t N,      --threads N         [%-7d] number of threads to use during computation\n",    params.n_threads);
-    fprintf(stderr, "  -p N,      --processors N      [%-7d] number of processors to use during computation\n", params.n_processors);
+    fprintf(stderr, "  -t N,      --threads N         [%-7d] number of threads to use during computation, per worker\n", params.n_threads);
+    fprintf(stderr, "  -p N,      --processors N      [%-7d] not used by the server, see --workers\n",         params.n_processors);
     fprintf(stderr, "  -ot N,     --offset-t N        [%-7d] time offset in milliseconds\n",                    params.offset_t_ms);
     fprintf(stderr, "  -on N,     --offset-n N        [%-7d] segment index offset\n",                           params.offset_n);
     fprintf(stderr, "  -d  N,     --duration N        [%-7d] duration of audio to process in milliseconds\n",   params.duration_ms);
@@ -145,6 +175,8 @@ void whisper_print_usage(int /*argc*/, char ** argv, const whisper_params & para
     fprintf(stderr, "  -tr,       --translate         [%-7s] translate from source language to english\n",      params.translate ? "true" : "false");
     fprintf(stderr, "  -di,       --diarize           [%-7s] stereo audio diarization\n",                       params.diarize ? "true" : "false");
     fprintf(stderr, "  -tdrz,     --tinydiarize       [%-7s] enable tinydiarize (requires a tdrz model)\n",     params.tinydiarize ? "true" : "false");
+    fprintf(stderr, "  -vad,      --vad               [%-7s] skip the parts of the audio without speech\n",    params.vad ? "true" : "false");
+    fprintf(stderr, "  -vt N,     --vad-thold N       [%-7.2f] VAD speech threshold, above the noise floor\n",  params.vad_thold);
     fprintf(stderr, "  -nf,       --no-fallback       [%-7s] do not use temperature fallback while decoding\n", params.no_fallback ? "true" : "false");
     fprintf(stderr, "  -ps,       --print-special     [%-7s] print special tokens\n",                           params.print_special ? "true" : "false");
     fprintf(stderr, "  -pc,       --print-colors      [%-7s] print colors\n",                                   params.print_colors ? "true" : "false");
@@ -156,11 +188,19 @@ void whisper_print_usage(int /*argc*/, char ** argv, const whisper_params & para
     fprintf(stderr, "             --prompt PROMPT     [%-7s] initial prompt\n",                                 params.prompt.c_str());
     fprintf(stderr, "  -m FNAME,  --model FNAME       [%-7s] model path\n",                                     params.model.c_str());
     fprintf(stderr, "  -oved D,   --ov-e-device DNAME [%-7s] the OpenVINO device used for encode inference\n",  params.openvino_encode_device.c_str());
+    fprintf(stderr, "  -kvt T,    --kv-type T         [%-7s] KV cache type: default, f16 or q8_0\n",           params.kv_type.c_str());
     // server params
     fprintf(stderr, "  --host HOST,                   [%-7s] Hostname/ip-adress for the server\n", sparams.hostname.c_str());
     fprintf(stderr, "  --port PORT,                   [%-7d] Port number for the server\n", sparams.port);
     fprintf(stderr, "  --public PATH,                 [%-7s] Path to the public folder\n", sparams.public_path.c_str());
-    fprintf(stderr, "  --convert,                     [%-7s] Convert audio to WAV, requires ffmpeg on the server", sparams.ffmpeg_converter ? "true" : "false");
+    fprintf(stderr, "  --convert,                     [%-7s] Convert audio that is not WAV or raw PCM to WAV, requires ffmpeg on the server\n", sparams.ffmpeg_converter ? "true" : "false");
+    fprintf(stderr, "  --workers N,                   [%-7d] Number of requests processed in parallel\n", sparams.n_workers);
+    fprintf(stderr, "  --queue-size N,                [%-7d] Number of requests waiting for a worker before rejecting with 503\n", sparams.queue_size);
+    fprintf(stderr, "  --retry-after N,               [%-7d] Retry-After seconds sent with 503\n", sparams.retry_after);
+    fprintf(stderr, "  --encoder-batch N,             [%-7d] Max number of requests encoded together (0 - off, at most --workers)\n", sparams.encoder_batch);
+    fprintf(stderr, "  --batch-wait-ms N,             [%-7d] Time the first request of an encoder batch waits for others\n", sparams.batch_wait_ms);
+    fprintf(stderr, "  --add-model NAME=FNAME,        [%-7s] Model that requests can select by name, loaded when first used\n", "");
+    fprintf(stderr, "  --models-mem-mb N,             [%-7d] Evict the least recently used models when their weights and states exceed this (0 - no limit)\n", sparams.models_mem_mb);
     fprintf(stderr, "\n");
 }
 
@@ -189,6 +229,8 @@ bool whisper_params_parse(int argc, char ** argv, whisper_params & params, serve
         else if (arg == "-tr"   || arg == "--translate")       { params.translate       = true; }
         else if (arg == "-di"   || arg == "--diarize")         { params.diarize         = true; }
         else if (arg == "-tdrz" || arg == "--tinydiarize")     { params.tinydiarize     = true; }
+        else if (arg == "-vad"  || arg == "--vad")             { params.vad             = true; }
+        else if (arg == "-vt"   || arg == "--vad-thold")       { params.vad_thold       = std::stof(argv[++i]); }
         else if (arg == "-sow"  || arg == "--split-on-word")   { params.split_on_word   = true; }
         else if (arg == "-nf"   || arg == "--no-fallback")     { params.no_fallback     = true; }
         else if (arg == "-fp"   || arg == "--font-path")       { params.font_path       = argv[++i]; }
@@ -203,28 +245,911 @@ bool whisper_params_parse(int argc, char ** argv, whisper_params & params, serve
         else if (arg == "-m"    || arg == "--model")           { params.model           = argv[++i]; }
         else if (arg == "-oved" || arg == "--ov-e-device")     { params.openvino_encode_device = argv[++i]; }
         else if (arg == "-ng"   || arg == "--no-gpu")          { params.use_gpu         = false; }
+        else if (arg == "-kvt"  || arg == "--kv-type")         { params.kv_type         = argv[++i]; }
         // server params
         else if (                  arg == "--port")            { sparams.port        = std::stoi(argv[++i]); }
         else if (                  arg == "--host")            { sparams.hostname    = argv[++i]; }
         else if (                  arg == "--public")          { sparams.public_path = argv[++i]; }
         else if (                  arg == "--convert")         { sparams.ffmpeg_converter     = true; }
+        else if (                  arg == "--workers")         { sparams.n_workers   = std::stoi(argv[++i]); }
+        else if (                  arg == "--queue-size")      { sparams.queue_size  = std::stoi(argv[++i]); }
+        else if (                  arg == "--retry-after")     { sparams.retry_after = std::stoi(argv[++i]); }
+        else if (                  arg == "--encoder-batch")   { sparams.encoder_batch = std::stoi(argv[++i]); }
+        else if (                  arg == "--batch-wait-ms")   { sparams.batch_wait_ms = std::stoi(argv[++i]); }
+        else if (                  arg == "--models-mem-mb")   { sparams.models_mem_mb = std::stoi(argv[++i]); }
+        else if (                  arg == "--add-model") {
+            const std::string value = argv[++i];
+            const size_t pos = value.find('=');
+            if (pos == std::string::npos || pos == 0) {
+                fprintf(stderr, "error: --add-model expects NAME=FNAME, got '%s'\n", value.c_str());
+                whisper_print_usage(argc, argv, params, sparams);
+                exit(0);
+            }
+            sparams.models.emplace_back(value.substr(0, pos), value.substr(pos + 1));
+        }
         else {
             fprintf(stderr, "error: unknown argument: %s\n", arg.c_str());
             whisper_print_usage(argc, argv, params, sparams);
             exit(0);
         }
-    }
+    }
+
+    return true;
+}
+
+struct whisper_print_user_data {
+    const whisper_params * params;
+
+    const std::vector<std::vector<float>> * pcmf32s;
+    int progress_prev;
+};
+
+// the workers run one request at a time, with the whisper_state (KV caches and compute buffers) that each model keeps
+// for each worker. Requests that find all workers busy wait in a bounded queue and are rejected when it is full, so
+// that a burst of uploads gets a fast 503 instead of piling up behind a long one
+struct server_worker {
+    int id = 0;
+};
+
+struct server_job {
+    std::function<void(server_worker &)> fn;
+
+    int64_t t_queued_us = 0;
+    int64_t t_wait_us   = 0;
+
+    bool done = false;
+
+    std::exception_ptr error;
+};
+
+struct server_pool_stats {
+    int32_t n_workers  = 0;
+    int32_t n_busy     = 0;
+    int32_t n_queued   = 0;
+    int32_t queue_size = 0;
+
+    int64_t n_done     = 0; // jobs that have been run
+    int64_t n_rejected = 0; // jobs rejected because the queue was full
+
+    int64_t t_wait_us_total = 0; // time the jobs spent in the queue
+    int64_t t_wait_us_max   = 0;
+};
+
+struct server_pool {
+    std::vector<server_worker> workers;
+    std::vector<std::thread>   threads;
+
+    std::deque<server_job *> queue;
+
+    std::mutex              mutex;
+    std::condition_variable cv_job;  // a job was queued, or the pool is stopped
+    std::condition_variable cv_done; // a job is done
+
+    int32_t queue_size = 0;
+    int32_t n_busy     = 0;
+
+    bool stopped = false;
+
+    server_pool_stats stats;
+
+    void start(int n_workers, int n_queue) {
+        workers.resize(n_workers);
+        for (int i = 0; i < n_workers; ++i) {
+            workers[i].id = i;
+        }
+
+        queue_size = n_queue;
+
+        for (auto & w : workers) {
+            threads.emplace_back([this, &w]() { loop(w); });
+        }
+    }
+
+    void stop() {
+        {
+            std::lock_guard<std::mutex> lock(mutex);
+            stopped = true;
+        }
+        cv_job.notify_all();
+
+        for (auto & t : threads) {
+            t.join();
+        }
+        threads.clear();
+    }
+
+    // how many of n_queued jobs cannot start right away
+    int32_t n_waiting(size_t n_queued) const {
+        return std::max(0, (int32_t) n_queued - ((int32_t) workers.size() - n_busy));
+    }
+
+    // used to reject a request before reading its audio - counted like a rejection by run()
+    bool check_full() {
+        std::lock_guard<std::mutex> lock(mutex);
+        if (n_waiting(queue.size() + 1) > queue_size) {
+            stats.n_rejected++;
+            return true;
+        }
+        return false;
+    }
+
+    // run fn on the next free worker and wait for it to finish
+    // returns false without running fn if the queue is full, exceptions thrown by fn are rethrown here
+    bool run(const std::function<void(server_worker &)> & fn, int64_t & t_wait_us) {
+        server_job job;
+        job.fn          = fn;
+        job.t_queued_us = ggml_time_us();
+
+        std::unique_lock<std::mutex> lock(mutex);
+
+        if (n_waiting(queue.size() + 1) > queue_size) {
+            stats.n_rejected++;
+            return false;
+        }
+
+        queue.push_back(&job);
+
+        cv_job.notify_one();
+        cv_done.wait(lock, [&job]() { return job.done; });
+
+        t_wait_us = job.t_wait_us;
+
+        if (job.error) {
+            std::rethrow_exception(job.error);
+        }
+
+        return true;
+    }
+
+    server_pool_stats get_stats() {
+        std::lock_guard<std::mutex> lock(mutex);
+
+        server_pool_stats res = stats;
+        res.n_workers  = workers.size();
+        res.n_busy     = n_busy;
+        res.n_queued   = queue.size();
+        res.queue_size = queue_size;
+
+        return res;
+    }
+
+    void loop(server_worker & w) {
+        std::unique_lock<std::mutex> lock(mutex);
+
+        while (true) {
+            cv_job.wait(lock, [this]() { return stopped || !queue.empty(); });
+            if (stopped) {
+                break;
+            }
+
+            server_job * job = queue.front();
+            queue.pop_front();
+
+            job->t_wait_us = ggml_time_us() - job->t_queued_us;
+
+            n_busy++;
+            lock.unlock();
+
+            try {
+                job->fn(w);
+            } catch (...) {
+                job->error = std::current_exception();
+            }
+
+            lock.lock();
+            n_busy--;
+
+            stats.n_done++;
+            stats.t_wait_us_total += job->t_wait_us;
+            stats.t_wait_us_max    = std::max(stats.t_wait_us_max, job->t_wait_us);
+
+            job->done = true;
+            cv_done.notify_all();
+        }
+    }
+};
+
+struct server_batcher_stats {
+    int32_t n_batch_max = 0;
+
+    int64_t n_runs    = 0; // encoder runs
+    int64_t n_encoded = 0; // windows encoded by them
+};
+
+// encodes the mel windows of the workers together - a worker submits its state from the encode callback of
+// whisper_full and waits, the batch runs when it is full, when all active workers have submitted, or after wait_us
+struct server_batcher {
+    struct request {
+        whisper_state * state  = nullptr;
+        int             offset = 0;
+
+        bool done = false;
+        bool ok   = false;
+    };
+
+    whisper_context       * ctx   = nullptr;
+    whisper_encoder_batch * batch = nullptr;
+
+    int32_t n_batch_max = 0;
+    int32_t n_threads   = 1; // per request in the batch
+    int64_t wait_us     = 0;
+
+    int32_t n_active = 0; // workers running whisper_full
+
+    std::deque<request *> pending;
+
+    std::mutex              mutex;
+    std::condition_variable cv_pending; // a request was submitted, a worker finished, or the batcher is stopped
+    std::condition_variable cv_done;    // a batch was encoded
+
+    std::thread thread;
+
+    bool stopped = false;
+
+    server_batcher_stats stats;
+
+    bool init(whisper_context * ctx_new) {
+        ctx   = ctx_new;
+        batch = whisper_encoder_batch_init(ctx, n_batch_max);
+
+        return batch != nullptr;
+    }
+
+    void free() {
+        whisper_encoder_batch_free(batch);
+        batch = nullptr;
+    }
+
+    bool start(whisper_context * ctx_new, int n_batch, int n_threads_per_request, int wait_ms) {
+        n_batch_max = n_batch;
+        n_threads   = n_threads_per_request;
+        wait_us     = 1000ll*wait_ms;
+
+        if (!init(ctx_new)) {
+            return false;
+        }
+
+        thread = std::thread([this]() { loop(); });
+
+        return true;
+    }
+
+    void stop() {
+        {
+            std::lock_guard<std::mutex> lock(mutex);
+            stopped = true;
+        }
+        cv_pending.notify_all();
+
+        if (thread.joinable()) {
+            thread.join();
+        }
+
+        free();
+    }
+
+    // call around whisper_full, so that a batch does not wait for workers that will not submit
+    void begin() {
+        std::lock_guard<std::mutex> lock(mutex);
+        n_active++;
+    }
+
+    void end() {
+        {
+            std::lock_guard<std::mutex> lock(mutex);
+            n_active--;
+        }
+        cv_pending.notify_all();
+    }
+
+    // encode the window of the state starting at offset, with the windows of other workers
+    bool encode(whisper_state * state, int offset) {
+        request req;
+        req.state  = state;
+        req.offset = offset;
+
+        std::unique_lock<std::mutex> lock(mutex);
+
+        pending.push_back(&req);
+
+        cv_pending.notify_all();
+        cv_done.wait(lock, [&req]() { return req.done; });
+
+        return req.ok;
+    }
+
+    server_batcher_stats get_stats() {
+        std::lock_guard<std::mutex> lock(mutex);
+
+        server_batcher_stats res = stats;
+        res.n_batch_max = n_batch_max;
+
+        return res;
+    }
+
+    void loop() {
+        std::unique_lock<std::mutex> lock(mutex);
+
+        std::vector<request *>       reqs;
+        std::vector<whisper_state *> states;
+        std::vector<int>             offsets;
+
+        while (true) {
+            cv_pending.wait(lock, [this]() { return stopped || !pending.empty(); });
+            if (stopped) {
+                break;
+            }
+
+            // wait for more requests, unless no other worker can submit one
+            const auto t_end = std::chrono::steady_clock::now() + std::chrono::microseconds(wait_us);
+            cv_pending.wait_until(lock, t_end, [this]() {
+                return stopped || (int32_t) pending.size() >= std::min(n_batch_max, n_active);
+            });
+
+            const int n = std::min<int>(n_batch_max, pending.size());
+
+            reqs.assign(pending.begin(), pending.begin() + n);
+            pending.erase(pending.begin(), pending.begin() + n);
+
+            lock.unlock();
+
+            states.resize(n);
+            offsets.resize(n);
+            for (int i = 0; i < n; ++i) {
+                states[i]  = reqs[i]->state;
+                offsets[i] = reqs[i]->offset;
+            }
+
+            // the threads of the waiting workers are idle
+            const int n_threads_batch = std::max<int>(1, std::min<int>(n*n_threads, std::thread::hardware_concurrency()));
+
+            const bool ok = whisper_encode_batch(ctx, batch, states.data(), offsets.data(), n, n_threads_batch) == 0;
+
+            lock.lock();
+
+            stats.n_runs++;
+            stats.n_encoded += n;
+
+            for (auto * req : reqs) {
+                req->ok   = ok;
+                req->done = true;
+            }
+            cv_done.notify_all();
+        }
+    }
+};
+
+// what a model needs to serve requests
+struct server_model_params {
+    whisper_context_params cparams = whisper_context_default_params();
+
+    int32_t n_workers     = 1;
+    int32_t n_threads     = 1;
+    int32_t encoder_batch = 0;
+    int32_t batch_wait_ms = 0;
+
+    std::string openvino_encode_device;
+};
+
+// a resident model: the context, a state for each worker and the encoder batcher
+// the requests hold a reference while they run, so that a model that is replaced or evicted is freed after them
+struct server_model {
+    std::string name;
+    std::string path;
+
+    whisper_context * ctx = nullptr;
+
+    std::vector<whisper_state *> states; // indexed by worker id
+
+    server_batcher batcher;
+
+    size_t size        = 0; // bytes of the weights
+    size_t size_states = 0; // bytes of the states, when they are created
+
+    ~server_model() {
+        if (batcher.batch) {
+            batcher.stop();
+        }
+        for (auto * state : states) {
+            whisper_free_state(state);
+        }
+        whisper_free(ctx);
+    }
+};
+
+static std::shared_ptr<server_model> server_model_load(const std::string & name, const std::string & path, const server_model_params & mparams) {
+    fprintf(stderr, "%s: loading model '%s' from '%s'\n", __func__, name.c_str(), path.c_str());
+
+    const int64_t t_start_us = ggml_time_us();
+
+    std::shared_ptr<server_model> model = std::make_shared<server_model>();
+    model->name = name;
+    model->path = path;
+
+    // the states are created for the workers below
+    model->ctx = whisper_init_from_file_with_params_no_state(path.c_str(), mparams.cparams);
+    if (model->ctx == nullptr) {
+        fprintf(stderr, "error: failed to initialize whisper context from '%s'\n", path.c_str());
+        return nullptr;
+    }
+
+    // initialize openvino encoder. this has no effect on whisper.cpp builds that don't have OpenVINO configured
+    whisper_ctx_init_openvino_encoder(model->ctx, nullptr, mparams.openvino_encode_device.c_str(), nullptr);
+
+    for (int i = 0; i < mparams.n_workers; ++i) {
+        whisper_state * state = whisper_init_state(model->ctx);
+        if (state == nullptr) {
+            fprintf(stderr, "error: failed to initialize the state of worker %d\n", i);
+            return nullptr;
+        }
+        model->states.push_back(state);
+        model->size_states += whisper_get_memory_with_state(model->ctx, state).total;
+    }
+
+    if (mparams.encoder_batch > 0 && !model->batcher.start(model->ctx, mparams.encoder_batch, mparams.n_threads, mparams.batch_wait_ms)) {
+        fprintf(stderr, "error: failed to initialize the encoder batch\n");
+        return nullptr;
+    }
+
+    model->size = whisper_model_size(model->ctx);
+
+    fprintf(stderr, "%s: loaded model '%s' (%.2f MB) in %.1f ms\n", __func__, name.c_str(), model->size/1e6, (ggml_time_us() - t_start_us)/1000.0);
+
+    return model;
+}
+
+// the models that the requests select by name
+//
+// a model is loaded when it is first needed, or by /load. The requests keep using the resident model while a new one
+// is loaded, then it is swapped in. When the resident models use more than mem_max bytes, the least recently used
+// ones are evicted - they stay registered and are loaded again when a request needs them
+struct server_registry {
+    struct entry {
+        std::string path;
+
+        std::shared_ptr<server_model> model;
+
+        int64_t t_last_used_us = 0;
+
+        bool loading = false;
+    };
+
+    server_model_params mparams;
+
+    size_t mem_max = 0; // 0 - no limit
+
+    std::string name_default;
+
+    std::map<std::string, entry> entries;
+
+    std::mutex              mutex;
+    std::condition_variable cv_loaded;
+
+    // add a model, without loading it
+    void add(const std::string & name, const std::string & path) {
+        std::lock_guard<std::mutex> lock(mutex);
+        entries[name].path = path;
+    }
+
+    // the model with the given name, empty for the default one - loaded if it is not resident
+    std::shared_ptr<server_model> get(const std::string & name_req, std::string & error) {
+        const std::string name = name_req.empty() ? name_default : name_req;
+
+        std::unique_lock<std::mutex> lock(mutex);
+
+        auto it = entries.find(name);
+        if (it == entries.end()) {
+            error = "unknown model '" + name + "'";
+            return nullptr;
+        }
+
+        entry & e = it->second;
+
+        // being added by /load
+        if (e.path.empty()) {
+            error = "model '" + name + "' is not loaded yet";
+            return nullptr;
+        }
+
+        // another request is loading it
+        cv_loaded.wait(lock, [&e]() { return e.model || !e.loading; });
+
+        if (!e.model) {
+            e.loading = true;
+            const std::string path = e.path;
+
+            lock.unlock();
+            std::shared_ptr<server_model> model = server_model_load(name, path, mparams);
+            lock.lock();
+
+            e.loading = false;
+            e.model   = model;
+            cv_loaded.notify_all();
+
+            if (!model) {
+                error = "failed to load model '" + name + "'";
+                return nullptr;
+            }
+
+            evict(name);
+        }
+
+        e.t_last_used_us = ggml_time_us();
+
+        return e.model;
+    }
+
+    // load a model from path and swap it in, under the given name - the requests use the previous one meanwhile
+    bool load(const std::string & name, const std::string & path) {
+        std::unique_lock<std::mutex> lock(mutex);
+
+        entry & e = entries[name];
+
+        // one load at a time for each name
+        cv_loaded.wait(lock, [&e]() { return !e.loading; });
+        e.loading = true;
+
+        lock.unlock();
+        std::shared_ptr<server_model> model = server_model_load(name, path, mparams);
+        lock.lock();
+
+        e.loading = false;
+        cv_loaded.notify_all();
+
+        if (!model) {
+            if (e.path.empty()) {
+                entries.erase(name);
+            }
+            return false;
+        }
+
+        e.path  = path;
+        e.model = model;
+        e.t_last_used_us = ggml_time_us();
+
+        evict(name);
+
+        return true;
+    }
+
+    // evict the least recently used models until the weights and states of the resident ones fit in mem_max, except keep
+    void evict(const std::string & keep) {
+        if (mem_max == 0) {
+            return;
+        }
+
+        while (true) {
+            size_t mem = 0;
+            entry * lru = nullptr;
+            std::string lru_name;
+
+            for (auto & it : entries) {
+                if (!it.second.model) {
+                    continue;
+                }
+                mem += it.second.model->size + it.second.model->size_states;
+                if (it.first != keep && (lru == nullptr || it.second.t_last_used_us < lru->t_last_used_us)) {
+                    lru = &it.second;
+                    lru_name = it.first;
+                }
+            }
+
+            if (mem <= mem_max || lru == nullptr) {
+                break;
+            }
+
+            fprintf(stderr, "%s: evicting model '%s' (%.2f MB + %.2f MB states), resident models use %.2f MB > %.2f MB\n",
+                    __func__, lru_name.c_str(), lru->model->size/1e6, lru->model->size_states/1e6, mem/1e6, mem_max/1e6);
+
+            // freed when the requests that use it finish
+            lru->model.reset();
+        }
+    }
+
+    // the resident default model, if any
+    std::shared_ptr<server_model> get_default() {
+        std::lock_guard<std::mutex> lock(mutex);
+
+        auto it = entries.find(name_default);
+        return it == entries.end() ? nullptr : it->second.model;
+    }
+
+    json to_json() {
+        std::lock_guard<std::mutex> lock(mutex);
+
+        json res = json::array();
+        for (const auto & it : entries) {
+            const entry & e = it.second;
+            res.push_back({
+                {"name",     it.first},
+                {"path",     e.path},
+                {"default",  it.first == name_default},
+                {"resident", (bool) e.model},
+                {"loading",  e.loading},
+                {"size_mb",  e.model ? e.model->size/1e6 : 0.0},
+                {"states_mb", e.model ? e.model->size_states/1e6 : 0.0},
+                {"requests", e.model ? e.model.use_count() - 1 : 0},
+                {"idle_s",   e.model ? (ggml_time_us() - e.t_last_used_us)/1e6 : 0.0},
+            });
+
+            if (e.model && e.model->batcher.batch) {
+                const server_batcher_stats bstats = e.model->batcher.get_stats();
+
+                res.back()["encoder_batch"] = {
+                    {"size",    bstats.n_batch_max},
+                    {"runs",    bstats.n_runs},
+                    {"encoded", bstats.n_encoded},
+                    {"mean",    bstats.n_runs > 0 ? double(bstats.n_encoded)/bstats.n_runs : 0.0},
+                };
+            }
+        }
+
+        return res;
+    }
+
+    // name and size of the weights of the resident models
+    std::vector<std::pair<std::string, size_t>> resident() {
+        std::lock_guard<std::mutex> lock(mutex);
+
+        std::vector<std::pair<std::string, size_t>> res;
+        for (const auto & it : entries) {
+            if (it.second.model) {
+                res.emplace_back(it.first, it.second.model->size);
+            }
+        }
+
+        return res;
+    }
+
+    // free the models - call after the workers are stopped
+    void clear() {
+        std::lock_guard<std::mutex> lock(mutex);
+        entries.clear();
+    }
+};
+
+// a latency histogram with the power-of-2 buckets of whisper_timings
+struct server_histogram {
+    double  sum = 0.0; // seconds
+    int64_t hist[WHISPER_TIMINGS_N_BUCKETS] = {};
+
+    void add(int64_t t_us) {
+        int i = 0;
+        while (i < WHISPER_TIMINGS_N_BUCKETS - 1 && t_us >= (int64_t(2) << i)) {
+            i++;
+        }
+        hist[i]++;
+        sum += 1e-6*t_us;
+    }
+
+    // the difference of two snapshots of a whisper_timings histogram
+    void add(const int32_t * hist1, const int32_t * hist0, float ms1, float ms0) {
+        for (int i = 0; i < WHISPER_TIMINGS_N_BUCKETS; ++i) {
+            hist[i] += hist1[i] - hist0[i];
+        }
+        sum += 1e-3*(ms1 - ms0);
+    }
+};
+
+// the metrics of the requests, exported by /metrics in the Prometheus text format
+// the whisper timings of a request are the difference of the timings of the state before and after whisper_full, so
+// that the counters do not depend on the lifetime of the models
+struct server_metrics {
+    struct model_metrics {
+        int64_t n_runs   = 0;
+        int64_t n_tokens = 0; // sampled
+        int64_t n_fail_p = 0; // fallbacks to a higher temperature
+        int64_t n_fail_h = 0;
+
+        double audio_s      = 0.0;
+        double processing_s = 0.0;
+
+        int64_t n_rtf        = 0; // the runs on audio of a non-zero duration
+        double  rtf_sum      = 0.0;
+        int64_t hist_rtf[10] = {};
+
+        server_histogram mel;
+        server_histogram encode;
+        server_histogram decode;
+        server_histogram batchd;
+        server_histogram prompt;
+        server_histogram sample;
+    };
+
+    std::mutex mutex;
+
+    int64_t n_ok       = 0;
+    int64_t n_error    = 0;
+    int64_t n_rejected = 0;
+
+    server_histogram decode_audio;
+
+    std::map<std::string, model_metrics> models;
+
+    void add_ok() {
+        std::lock_guard<std::mutex> lock(mutex);
+        n_ok++;
+    }
+
+    void add_error() {
+        std::lock_guard<std::mutex> lock(mutex);
+        n_error++;
+    }
+
+    void add_rejected() {
+        std::lock_guard<std::mutex> lock(mutex);
+        n_rejected++;
+    }
+
+    void add_decode_audio(int64_t t_us) {
+        std::lock_guard<std::mutex> lock(mutex);
+        decode_audio.add(t_us);
+    }
+
+    void add_run(const std::string & model, const whisper_timings & t0, const whisper_timings & t1, double audio_s, double processing_s) {
+        static const double rtf_buckets[] = { 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0, 10.0 };
+
+        std::lock_guard<std::mutex> lock(mutex);
+
+        model_metrics & m = models[model];
+
+        m.n_runs++;
+        m.n_tokens += t1.n_sample - t0.n_sample;
+        m.n_fail_p += t1.n_fail_p - t0.n_fail_p;
+        m.n_fail_h += t1.n_fail_h - t0.n_fail_h;
+
+        m.audio_s      += audio_s;
+        m.processing_s += processing_s;
+
+        if (audio_s > 0.0) {
+            const double rtf = processing_s/audio_s;
+            m.n_rtf++;
+            m.rtf_sum += rtf;
+            for (int i = 0; i < 10; ++i) {
+                if (rtf <= rtf_buckets[i]) {
+                    m.hist_rtf[i]++;
+                    break;
+                }
+            }
+        }
+
+        m.mel   .add(t1.hist_mel,    t0.hist_mel,    t1.mel_ms,    t0.mel_ms);
+        m.encode.add(t1.hist_encode, t0.hist_encode, t1.encode_ms, t0.encode_ms);
+        m.decode.add(t1.hist_decode, t0.hist_decode, t1.decode_ms, t0.decode_ms);
+        m.batchd.add(t1.hist_batchd, t0.hist_batchd, t1.batchd_ms, t0.batchd_ms);
+        m.prompt.add(t1.hist_prompt, t0.hist_prompt, t1.prompt_ms, t0.prompt_ms);
+        m.sample.add(t1.hist_sample, t0.hist_sample, t1.sample_ms, t0.sample_ms);
+    }
+
+    std::string to_prometheus(const server_pool_stats & stats, const std::vector<std::pair<std::string, size_t>> & resident) {
+        static const double rtf_buckets[] = { 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0, 10.0 };
+
+        std::lock_guard<std::mutex> lock(mutex);
+
+        std::stringstream ss;
+
+        const auto header = [&ss](const char * name, const char * type, const char * help) {
+            ss << "# HELP " << name << " " << help << "\n";
+            ss << "# TYPE " << name << " " << type << "\n";
+        };
+
+        const auto label = [](const std::string & value) {
+            std::string res;
+            for (char c : value) {
+                if (c == '\\' || c == '"') {
+                    res += '\\';
+                    res += c;
+                } else if (c == '\n') {
+                    res += "\\n";
+                } else {
+                    res += c;
+                }
+            }
+            return res;
+        };
+
+        // the bucket i of whisper_timings ends at 2^(i+1) us
+        const auto histogram = [&ss](const std::string & name, const std::string & labels, const server_histogram & h) {
+            const std::string sep = labels.empty() ? "" : ",";
+            const std::string all = labels.empty() ? "" : "{" + labels + "}";
+
+            int64_t count = 0;
+            for (int i = 0; i < WHISPER_TIMINGS_N_BUCKETS - 1; ++i) {
+                char le[32];
+                snprintf(le, sizeof(le), "%.6f", (int64_t(2) << i)*1e-6);
+
+                count += h.hist[i];
+                ss << name << "_bucket{" << labels << sep << "le=\"" << le << "\"} " << count << "\n";
+            }
+            count += h.hist[WHISPER_TIMINGS_N_BUCKETS - 1];
+            ss << name << "_bucket{" << labels << sep << "le=\"+Inf\"} " << count << "\n";
+            ss << name << "_sum"     << all << " " << h.sum << "\n";
+            ss << name << "_count"   << all << " " << count << "\n";
+        };
+
+        header("whisper_requests_total", "counter", "Transcription requests by outcome");
+        ss << "whisper_requests_total{status=\"ok\"} "       << n_ok       << "\n";
+        ss << "whisper_requests_total{status=\"error\"} "    << n_error    << "\n";
+        ss << "whisper_requests_total{status=\"rejected\"} " << n_rejected << "\n";
+
+        header("whisper_workers", "gauge", "Number of workers");
+        ss << "whisper_workers " << stats.n_workers << "\n";
+        header("whisper_workers_busy", "gauge", "Number of workers running a request");
+        ss << "whisper_workers_busy " << stats.n_busy << "\n";
+        header("whisper_queue_depth", "gauge", "Number of requests waiting for a worker");
+        ss << "whisper_queue_depth " << stats.n_queued << "\n";
+        header("whisper_queue_size", "gauge", "Max number of requests waiting for a worker");
+        ss << "whisper_queue_size " << stats.queue_size << "\n";
+        header("whisper_queue_wait_seconds_total", "counter", "Time the requests waited for a worker");
+        ss << "whisper_queue_wait_seconds_total " << stats.t_wait_us_total*1e-6 << "\n";
+
+        header("whisper_decode_audio_seconds", "histogram", "Time to decode the uploaded audio");
+        histogram("whisper_decode_audio_seconds", "", decode_audio);
+
+        header("whisper_model_resident_bytes", "gauge", "Size of the weights of the resident models");
+        for (const auto & it : resident) {
+            ss << "whisper_model_resident_bytes{model=\"" << label(it.first) << "\"} " << it.second << "\n";
+        }
+
+        header("whisper_audio_seconds_total", "counter", "Duration of the transcribed audio");
+        for (const auto & it : models) {
+            ss << "whisper_audio_seconds_total{model=\"" << label(it.first) << "\"} " << it.second.audio_s << "\n";
+        }
 
-    return true;
-}
+        header("whisper_processing_seconds_total", "counter", "Time spent in whisper_full, the real-time factor is its rate over the rate of whisper_audio_seconds_total");
+        for (const auto & it : models) {
+            ss << "whisper_processing_seconds_total{model=\"" << label(it.first) << "\"} " << it.second.processing_s << "\n";
+        }
 
-struct whisper_print_user_data {
-    const whisper_params * params;
+        header("whisper_rtf", "histogram", "Real-time factor of the requests - processing time over audio duration");
+        for (const auto & it : models) {
+            const std::string labels = "model=\"" + label(it.first) + "\"";
+            int64_t count = 0;
+            for (int i = 0; i < 10; ++i) {
+                count += it.second.hist_rtf[i];
+                ss << "whisper_rtf_bucket{" << labels << ",le=\"" << rtf_buckets[i] << "\"} " << count << "\n";
+            }
+            ss << "whisper_rtf_bucket{" << labels << ",le=\"+Inf\"} " << it.second.n_rtf << "\n";
+            ss << "whisper_rtf_sum{"    << labels << "} " << it.second.rtf_sum << "\n";
+            ss << "whisper_rtf_count{"  << labels << "} " << it.second.n_rtf << "\n";
+        }
 
-    const std::vector<std::vector<float>> * pcmf32s;
-    int progress_prev;
+        header("whisper_tokens_total", "counter", "Sampled tokens, tokens/s is its rate");
+        for (const auto & it : models) {
+            ss << "whisper_tokens_total{model=\"" << label(it.first) << "\"} " << it.second.n_tokens << "\n";
+        }
+
+        header("whisper_fallbacks_total", "counter", "Segments decoded again at a higher temperature, by the failed threshold");
+        for (const auto & it : models) {
+            ss << "whisper_fallbacks_total{model=\"" << label(it.first) << "\",reason=\"logprob\"} " << it.second.n_fail_p << "\n";
+            ss << "whisper_fallbacks_total{model=\"" << label(it.first) << "\",reason=\"entropy\"} " << it.second.n_fail_h << "\n";
+        }
+
+        header("whisper_phase_seconds", "histogram", "Duration of the calls of each phase of whisper_full");
+        for (const auto & it : models) {
+            const std::string labels = "model=\"" + label(it.first) + "\",phase=";
+            histogram("whisper_phase_seconds", labels + "\"mel\"",    it.second.mel);
+            histogram("whisper_phase_seconds", labels + "\"encode\"", it.second.encode);
+            histogram("whisper_phase_seconds", labels + "\"decode\"", it.second.decode);
+            histogram("whisper_phase_seconds", labels + "\"batchd\"", it.second.batchd);
+            histogram("whisper_phase_seconds", labels + "\"prompt\"", it.second.prompt);
+            histogram("whisper_phase_seconds", labels + "\"sample\"", it.second.sample);
+        }
+
+        return ss.str();
+    }
 };
 
+// models/ggml-base.en.bin -> ggml-base.en
+static std::string model_name_from_path(const std::string & path) {
+    std::string name = path.substr(path.find_last_of("/\\") + 1);
+    const size_t pos = name.rfind(".bin");
+    if (pos != std::string::npos && pos + 4 == name.size()) {
+        name = name.substr(0, pos);
+    }
+    return name;
+}
+
 void check_ffmpeg_availibility() {
     int result = system("ffmpeg -version");
 
@@ -306,11 +1231,11 @@ void whisper_print_progress_callback(struct whisper_context * /*ctx*/, struct wh
     }
 }
 
-void whisper_print_segment_callback(struct whisper_context * ctx, struct whisper_state * /*state*/, int n_new, void * user_data) {
+void whisper_print_segment_callback(struct whisper_context * ctx, struct whisper_state * state, int n_new, void * user_data) {
     const auto & params  = *((whisper_print_user_data *) user_data)->params;
     const auto & pcmf32s = *((whisper_print_user_data *) user_data)->pcmf32s;
 
-    const int n_segments = whisper_full_n_segments(ctx);
+    const int n_segments = whisper_full_n_segments_from_state(state);
 
     std::string speaker = "";
 
@@ -326,8 +1251,8 @@ void whisper_print_segment_callback(struct whisper_context * ctx, struct whisper
 
     for (int i = s0; i < n_segments; i++) {
         if (!params.no_timestamps || params.diarize) {
-            t0 = whisper_full_get_segment_t0(ctx, i);
-            t1 = whisper_full_get_segment_t1(ctx, i);
+            t0 = whisper_full_get_segment_t0_from_state(state, i);
+            t1 = whisper_full_get_segment_t1_from_state(state, i);
         }
 
         if (!params.no_timestamps) {
@@ -339,29 +1264,29 @@ void whisper_print_segment_callback(struct whisper_context * ctx, struct whisper
         }
 
         if (params.print_colors) {
-            for (int j = 0; j < whisper_full_n_tokens(ctx, i); ++j) {
+            for (int j = 0; j < whisper_full_n_tokens_from_state(state, i); ++j) {
                 if (params.print_special == false) {
-                    const whisper_token id = whisper_full_get_token_id(ctx, i, j);
+                    const whisper_token id = whisper_full_get_token_id_from_state(state, i, j);
                     if (id >= whisper_token_eot(ctx)) {
                         continue;
                     }
                 }
 
-                const char * text = whisper_full_get_token_text(ctx, i, j);
-                const float  p    = whisper_full_get_token_p   (ctx, i, j);
+                const char * text = whisper_full_get_token_text_from_state(ctx, state, i, j);
+                const float  p    = whisper_full_get_token_p_from_state(state, i, j);
 
                 const int col = std::max(0, std::min((int) k_colors.size() - 1, (int) (std::pow(p, 3)*float(k_colors.size()))));
 
                 printf("%s%s%s%s", speaker.c_str(), k_colors[col].c_str(), text, "\033[0m");
             }
         } else {
-            const char * text = whisper_full_get_segment_text(ctx, i);
+            const char * text = whisper_full_get_segment_text_from_state(state, i);
 
             printf("%s%s", speaker.c_str(), text);
         }
 
         if (params.tinydiarize) {
-            if (whisper_full_get_segment_speaker_turn_next(ctx, i)) {
+            if (whisper_full_get_segment_speaker_turn_next_from_state(state, i)) {
                 printf("%s", params.tdrz_speaker_turn.c_str());
             }
         }
@@ -374,17 +1299,17 @@ void whisper_print_segment_callback(struct whisper_context * ctx, struct whisper
     }
 }
 
-std::string output_str(struct whisper_context * ctx, const whisper_params & params, std::vector<std::vector<float>> pcmf32s) {
+std::string output_str(struct whisper_state * state, const whisper_params & params, const std::vector<std::vector<float>> & pcmf32s) {
     std::stringstream result;
-    const int n_segments = whisper_full_n_segments(ctx);
+    const int n_segments = whisper_full_n_segments_from_state(state);
     for (int i = 0; i < n_segments; ++i) {
-        const char * text = whisper_full_get_segment_text(ctx, i);
+        const char * text = whisper_full_get_segment_text_from_state(state, i);
         std::string speaker = "";
 
         if (params.diarize && pcmf32s.size() == 2)
         {
-            const int64_t t0 = whisper_full_get_segment_t0(ctx, i);
-            const int64_t t1 = whisper_full_get_segment_t1(ctx, i);
+            const int64_t t0 = whisper_full_get_segment_t0_from_state(state, i);
+            const int64_t t1 = whisper_full_get_segment_t1_from_state(state, i);
             speaker = estimate_diarization_speaker(pcmf32s, t0, t1);
         }
 
@@ -393,6 +1318,166 @@ std::string output_str(struct whisper_context * ctx, const whisper_params & para
     return result.str();
 }
 
+// set the result of a finished request in the requested response format
+void set_result(Response & res, struct whisper_state * state, const whisper_params & params, const std::vector<std::vector<float>> & pcmf32s) {
+    if (params.response_format == text_format)
+    {
+        std::string results = output_str(state, params, pcmf32s);
+        res.set_content(results.c_str(), "text/html");
+    }
+    else if (params.response_format == srt_format)
+    {
+        std::stringstream ss;
+        const int n_segments = whisper_full_n_segments_from_state(state);
+        for (int i = 0; i < n_segments; ++i) {
+            const char * text = whisper_full_get_segment_text_from_state(state, i);
+            const int64_t t0 = whisper_full_get_segment_t0_from_state(state, i);
+            const int64_t t1 = whisper_full_get_segment_t1_from_state(state, i);
+            std::string speaker = "";
+
+            if (params.diarize && pcmf32s.size() == 2)
+            {
+                speaker = estimate_diarization_speaker(pcmf32s, t0, t1);
+            }
+
+            ss << i + 1 + params.offset_n << "\n";
+            ss << to_timestamp(t0, true) << " --> " << to_timestamp(t1, true) << "\n";
+            ss << speaker << text << "\n\n";
+        }
+        res.set_content(ss.str(), "application/x-subrip");
+    } else if (params.response_format == vtt_format) {
+        std::stringstream ss;
+
+        ss << "WEBVTT\n\n";
+
+        const int n_segments = whisper_full_n_segments_from_state(state);
+        for (int i = 0; i < n_segments; ++i) {
+            const char * text = whisper_full_get_segment_text_from_state(state, i);
+            const int64_t t0 = whisper_full_get_segment_t0_from_state(state, i);
+            const int64_t t1 = whisper_full_get_segment_t1_from_state(state, i);
+            std::string speaker = "";
+
+            if (params.diarize && pcmf32s.size() == 2)
+            {
+                speaker = estimate_diarization_speaker(pcmf32s, t0, t1, true);
+                speaker.insert(0, "<v Speaker");
+                speaker.append(">");
+            }
+
+            ss << to_timestamp(t0) << " --> " << to_timestamp(t1) << "\n";
+            ss << speaker << text << "\n\n";
+        }
+        res.set_content(ss.str(), "text/vtt");
+    }
+    // TODO add more output formats
+    else
+    {
+        std::string results = output_str(state, params, pcmf32s);
+        json jres = json{
+            {"text", results}
+        };
+        res.set_content(jres.dump(-1, ' ', false, json::error_handler_t::replace),
+                        "application/json");
+    }
+}
+
+// an /inference request, with its audio - shared with the content provider of a streaming response, which runs
+// after the handler has returned
+struct server_request {
+    whisper_params params;
+
+    std::string filename;
+
+    std::vector<float>              pcmf32;  // mono-channel F32 PCM
+    std::vector<std::vector<float>> pcmf32s; // stereo-channel F32 PCM
+
+    std::shared_ptr<server_model> model;
+
+    int64_t t_received_us = 0;
+};
+
+// a Server-Sent Events response, written by the worker while whisper_full runs:
+//
+//   event: start     data: {"queue_wait_ms":0.1}
+//   event: progress  data: {"progress":45}
+//   event: segment   data: {"id":0,"start":0.0,"end":7.6,"text":" And so my fellow Americans"}
+//   event: done      data: {"text":" And so my fellow Americans ...\n","segments":2}
+//   event: error     data: {"error":"failed to process audio"}
+//
+// when the client goes away, the processing is aborted
+struct server_stream {
+    DataSink * sink = nullptr;
+
+    std::atomic<bool> closed{false};
+
+    bool send(const char * event, const json & data) {
+        if (closed) {
+            return false;
+        }
+
+        const std::string msg = std::string("event: ") + event + "\ndata: " + data.dump(-1, ' ', false, json::error_handler_t::replace) + "\n\n";
+
+        if (!sink->write(msg.data(), msg.size())) {
+            fprintf(stderr, "%s: the client closed the stream, aborting\n", __func__);
+            closed = true;
+            return false;
+        }
+
+        return true;
+    }
+};
+
+struct whisper_stream_user_data {
+    whisper_print_user_data print;
+
+    server_stream * stream;
+};
+
+void whisper_stream_progress_callback(struct whisper_context * ctx, struct whisper_state * state, int progress, void * user_data) {
+    auto & data = *((whisper_stream_user_data *) user_data);
+
+    if (data.print.params->print_progress) {
+        whisper_print_progress_callback(ctx, state, progress, &data.print);
+    }
+
+    data.stream->send("progress", json{{"progress", progress}});
+}
+
+void whisper_stream_segment_callback(struct whisper_context * ctx, struct whisper_state * state, int n_new, void * user_data) {
+    auto & data = *((whisper_stream_user_data *) user_data);
+
+    const auto & params  = *data.print.params;
+    const auto & pcmf32s = *data.print.pcmf32s;
+
+    if (params.print_realtime) {
+        whisper_print_segment_callback(ctx, state, n_new, &data.print);
+    }
+
+    const int n_segments = whisper_full_n_segments_from_state(state);
+
+    for (int i = n_segments - n_new; i < n_segments; i++) {
+        const int64_t t0 = whisper_full_get_segment_t0_from_state(state, i);
+        const int64_t t1 = whisper_full_get_segment_t1_from_state(state, i);
+
+        json jseg = json{
+            {"id",    i},
+            {"start", t0*0.01},
+            {"end",   t1*0.01},
+            {"text",  whisper_full_get_segment_text_from_state(state, i)},
+        };
+
+        if (params.diarize && pcmf32s.size() == 2) {
+            jseg["speaker"] = estimate_diarization_speaker(pcmf32s, t0, t1, true);
+        }
+
+        if (params.tinydiarize) {
+            jseg["speaker_turn_next"] = whisper_full_get_segment_speaker_turn_next_from_state(state, i);
+        }
+
+        data.stream->send("segment", jseg);
+    }
+}
+
 void get_req_parameters(const Request & req, whisper_params & params)
 {
     // user model configu.has_fileion
@@ -420,10 +1505,32 @@ void get_req_parameters(const Request & req, whisper_params & params)
     {
         params.response_format = req.get_file_value("response-format").content;
     }
+    if (req.has_file("audio-format"))
+    {
+        params.audio_format = req.get_file_value("audio-format").content;
+    }
+    if (req.has_file("sample-rate"))
+    {
+        params.sample_rate = std::stoi(req.get_file_value("sample-rate").content);
+    }
+    if (req.has_file("channels"))
+    {
+        params.channels = std::stoi(req.get_file_value("channels").content);
+    }
+    if (req.has_file("stream"))
+    {
+        const std::string stream = req.get_file_value("stream").content;
+        params.stream = stream == "true" || stream == "1";
+    }
     if (req.has_file("temperature"))
     {
         params.userdef_temp = std::stof(req.get_file_value("temperature").content);
     }
+    if (req.has_file("vad"))
+    {
+        const std::string vad = req.get_file_value("vad").content;
+        params.vad = vad == "true" || vad == "1";
+    }
 }
 
 }  // namespace
@@ -432,8 +1539,6 @@ int main(int argc, char ** argv) {
     whisper_params params;
     server_params sparams;
 
-    std::mutex whisper_mutex;
-
     if (whisper_params_parse(argc, argv, params, sparams) == false) {
         whisper_print_usage(argc, argv, params, sparams);
         return 1;
@@ -451,28 +1556,84 @@ int main(int argc, char ** argv) {
         exit(0);
     }
 
+    if (sparams.n_workers < 1 || sparams.queue_size < 0) {
+        fprintf(stderr, "error: --workers must be at least 1 and --queue-size cannot be negative\n");
+        whisper_print_usage(argc, argv, params, sparams);
+        exit(0);
+    }
+
+    if (sparams.encoder_batch < 0 || sparams.encoder_batch > sparams.n_workers) {
+        fprintf(stderr, "warning: --encoder-batch must be between 0 and --workers, using %d\n", sparams.n_workers);
+        sparams.encoder_batch = sparams.n_workers;
+    }
+
+    if (params.n_processors > 1) {
+        fprintf(stderr, "warning: --processors is not used by the server, requests are processed in parallel by --workers\n");
+    }
+
     if (sparams.ffmpeg_converter) {
         check_ffmpeg_availibility();
     }
     // whisper init
-    struct whisper_context_params cparams;
-    cparams.use_gpu = params.use_gpu;
+    server_registry registry;
 
-    struct whisper_context * ctx = whisper_init_from_file_with_params(params.model.c_str(), cparams);
+    registry.mparams.cparams.use_gpu        = params.use_gpu;
 
-    if (ctx == nullptr) {
-        fprintf(stderr, "error: failed to initialize whisper context\n");
-        return 3;
+    if (params.kv_type == "f16") {
+        registry.mparams.cparams.kv_type = WHISPER_KV_TYPE_F16;
+    } else if (params.kv_type == "q8_0") {
+        registry.mparams.cparams.kv_type = WHISPER_KV_TYPE_Q8_0;
+    } else if (params.kv_type != "default") {
+        fprintf(stderr, "error: unknown KV cache type '%s'\n", params.kv_type.c_str());
+        whisper_print_usage(argc, argv, params, sparams);
+        exit(0);
     }
 
-    // initialize openvino encoder. this has no effect on whisper.cpp builds that don't have OpenVINO configured
-    whisper_ctx_init_openvino_encoder(ctx, nullptr, params.openvino_encode_device.c_str(), nullptr);
+    registry.mparams.n_workers              = sparams.n_workers;
+    registry.mparams.n_threads              = params.n_threads;
+    registry.mparams.encoder_batch          = sparams.encoder_batch;
+    registry.mparams.batch_wait_ms          = sparams.batch_wait_ms;
+    registry.mparams.openvino_encode_device = params.openvino_encode_device;
+
+    registry.mem_max      = (size_t) sparams.models_mem_mb*1000*1000;
+    registry.name_default = model_name_from_path(params.model);
+
+    registry.add(registry.name_default, params.model);
+    for (const auto & m : sparams.models) {
+        registry.add(m.first, m.second);
+    }
+
+    // the default model is loaded right away, the others when they are first used
+    {
+        std::string error;
+        if (!registry.get("", error)) {
+            fprintf(stderr, "error: %s\n", error.c_str());
+            return 3;
+        }
+    }
+
+    server_pool pool;
+    pool.start(sparams.n_workers, sparams.queue_size);
+
+    fprintf(stderr, "%s: %d workers x %d threads, queue size = %d\n", __func__, sparams.n_workers, params.n_threads, sparams.queue_size);
+
+    if (sparams.encoder_batch > 0) {
+        fprintf(stderr, "%s: encoder batch size = %d, wait = %d ms\n", __func__, sparams.encoder_batch, sparams.batch_wait_ms);
+    }
+
+    // used for unique temporary file names
+    std::atomic<int64_t> n_requests(0);
 
     Server svr;
     svr.set_default_headers({{"Server", "whisper.cpp"},
                              {"Access-Control-Allow-Origin", "*"},
                              {"Access-Control-Allow-Headers", "content-type"}});
 
+    // the requests wait for a worker in the HTTP threads - make sure there are enough of them for a full queue
+    svr.new_task_queue = [&sparams] {
+        return new ThreadPool(std::max<int>(CPPHTTPLIB_THREAD_POOL_COUNT, sparams.n_workers + sparams.queue_size + 2));
+    };
+
     std::string const default_content = "<html>hello</html>";
 
     // this is only called if no index.html is found in the public --path
@@ -481,135 +1642,117 @@ int main(int argc, char ** argv) {
         return false;
     });
 
-    svr.Post("/inference", [&](const Request &req, Response &res){
-        // acquire whisper model mutex lock
-        whisper_mutex.lock();
-
-        // first check user requested fields of the request
-        if (!req.has_file("file"))
-        {
-            fprintf(stderr, "error: no 'file' field in the request\n");
-            const std::string error_resp = "{\"error\":\"no 'file' field in the request\"}";
-            res.set_content(error_resp, "application/json");
-            whisper_mutex.unlock();
-            return;
-        }
-        auto audio_file = req.get_file_value("file");
+    server_metrics metrics;
 
-        // check non-required fields
-        get_req_parameters(req, params);
+    const auto reject_busy = [&sparams, &metrics](Response & res) {
+        metrics.add_rejected();
+        fprintf(stderr, "error: all workers are busy and the queue is full, rejecting request\n");
+        res.status = 503;
+        res.set_header("Retry-After", std::to_string(sparams.retry_after));
+        res.set_content("{\"error\":\"server is busy, try again later\"}", "application/json");
+    };
 
-        std::string filename{audio_file.filename};
-        printf("Received request: %s\n", filename.c_str());
+    // run a request on a worker - when stream is not null, the segments and the progress are sent to it as they come
+    const auto transcribe = [&](server_worker & worker, server_request & request, server_stream * stream) {
+        whisper_context * ctx   = request.model->ctx;
+        whisper_state   * state = request.model->states[worker.id];
 
-        // audio arrays
-        std::vector<float> pcmf32;               // mono-channel F32 PCM
-        std::vector<std::vector<float>> pcmf32s; // stereo-channel F32 PCM
-
-        // write to temporary file
-        const std::string temp_filename = "whisper_server_temp_file.wav";
-        std::ofstream temp_file{temp_filename, std::ios::binary};
-        temp_file << audio_file.content;
-        temp_file.close();
-
-        // if file is not wav, convert to wav
-        
-        if (sparams.ffmpeg_converter) {
-            std::string error_resp = "{\"error\":\"Failed to execute ffmpeg command.\"}";
-            const bool is_converted = convert_to_wav(temp_filename, error_resp);
-            if (!is_converted) {
-                res.set_content(error_resp, "application/json");
-                whisper_mutex.unlock();
-                return;
-            }
-        }
+        server_batcher & batcher = request.model->batcher;
 
-        // read wav content into pcmf32
-        if (!::read_wav(temp_filename, pcmf32, pcmf32s, params.diarize)) {
-            fprintf(stderr, "error: failed to read WAV file '%s'\n", temp_filename.c_str());
-            const std::string error_resp = "{\"error\":\"failed to read WAV file\"}";
-            res.set_content(error_resp, "application/json");
-            std::remove(temp_filename.c_str());
-            whisper_mutex.unlock();
-            return;
-        }
-        // remove temp file
-        std::remove(temp_filename.c_str());
+        whisper_params & rparams = request.params;
 
-        printf("Successfully loaded %s\n", filename.c_str());
+        const auto & filename = request.filename;
+        const auto & pcmf32   = request.pcmf32;
+        const auto & pcmf32s  = request.pcmf32s;
 
         // print system information
         {
             fprintf(stderr, "\n");
-            fprintf(stderr, "system_info: n_threads = %d / %d | %s\n",
-                    params.n_threads*params.n_processors, std::thread::hardware_concurrency(), whisper_print_system_info());
+            fprintf(stderr, "system_info: worker %d, model = %s, n_threads = %d / %d | %s\n",
+                    worker.id, request.model->name.c_str(), rparams.n_threads, std::thread::hardware_concurrency(), whisper_print_system_info());
         }
 
         // print some info about the processing
         {
             fprintf(stderr, "\n");
             if (!whisper_is_multilingual(ctx)) {
-                if (params.language != "en" || params.translate) {
-                    params.language = "en";
-                    params.translate = false;
+                if (rparams.language != "en" || rparams.translate) {
+                    rparams.language = "en";
+                    rparams.translate = false;
                     fprintf(stderr, "%s: WARNING: model is not multilingual, ignoring language and translation options\n", __func__);
                 }
             }
-            if (params.detect_language) {
-                params.language = "auto";
+            if (rparams.detect_language) {
+                rparams.language = "auto";
             }
-            fprintf(stderr, "%s: processing '%s' (%d samples, %.1f sec), %d threads, %d processors, lang = %s, task = %s, %stimestamps = %d ...\n",
+            fprintf(stderr, "%s: processing '%s' (%d samples, %.1f sec), %d threads, lang = %s, task = %s, %stimestamps = %d ...\n",
                     __func__, filename.c_str(), int(pcmf32.size()), float(pcmf32.size())/WHISPER_SAMPLE_RATE,
-                    params.n_threads, params.n_processors,
-                    params.language.c_str(),
-                    params.translate ? "translate" : "transcribe",
-                    params.tinydiarize ? "tdrz = 1, " : "",
-                    params.no_timestamps ? 0 : 1);
+                    rparams.n_threads,
+                    rparams.language.c_str(),
+                    rparams.translate ? "translate" : "transcribe",
+                    rparams.tinydiarize ? "tdrz = 1, " : "",
+                    rparams.no_timestamps ? 0 : 1);
 
             fprintf(stderr, "\n");
         }
 
+        if (stream) {
+            stream->send("start", json{{"queue_wait_ms", (ggml_time_us() - request.t_received_us)/1000.0}});
+        }
+
         // run the inference
-        {
-            printf("Running whisper.cpp inference on %s\n", filename.c_str());
-            whisper_full_params wparams = whisper_full_default_params(WHISPER_SAMPLING_GREEDY);
+        printf("Running whisper.cpp inference on %s\n", filename.c_str());
+        whisper_full_params wparams = whisper_full_default_params(WHISPER_SAMPLING_GREEDY);
+
+        wparams.strategy = rparams.beam_size > 1 ? WHISPER_SAMPLING_BEAM_SEARCH : WHISPER_SAMPLING_GREEDY;
 
-            wparams.strategy = params.beam_size > 1 ? WHISPER_SAMPLING_BEAM_SEARCH : WHISPER_SAMPLING_GREEDY;
+        wparams.print_realtime   = false;
+        wparams.print_progress   = rparams.print_progress;
+        wparams.print_timestamps = !rparams.no_timestamps;
+        wparams.print_special    = rparams.print_special;
+        wparams.translate        = rparams.translate;
+        wparams.language         = rparams.language.c_str();
+        wparams.detect_language  = rparams.detect_language;
+        wparams.n_threads        = rparams.n_threads;
+        wparams.n_max_text_ctx   = rparams.max_context >= 0 ? rparams.max_context : wparams.n_max_text_ctx;
+        wparams.offset_ms        = rparams.offset_t_ms;
+        wparams.duration_ms      = rparams.duration_ms;
 
-            wparams.print_realtime   = false;
-            wparams.print_progress   = params.print_progress;
-            wparams.print_timestamps = !params.no_timestamps;
-            wparams.print_special    = params.print_special;
-            wparams.translate        = params.translate;
-            wparams.language         = params.language.c_str();
-            wparams.detect_language  = params.detect_language;
-            wparams.n_threads        = params.n_threads;
-            wparams.n_max_text_ctx   = params.max_context >= 0 ? params.max_context : wparams.n_max_text_ctx;
-            wparams.offset_ms        = params.offset_t_ms;
-            wparams.duration_ms      = params.duration_ms;
+        wparams.thold_pt         = rparams.word_thold;
+        wparams.max_len          = rparams.max_len == 0 ? 60 : rparams.max_len;
+        wparams.split_on_word    = rparams.split_on_word;
 
-            wparams.thold_pt         = params.word_thold;
-            wparams.max_len          = params.max_len == 0 ? 60 : params.max_len;
-            wparams.split_on_word    = params.split_on_word;
+        wparams.speed_up         = rparams.speed_up;
+        wparams.debug_mode       = rparams.debug_mode;
 
-            wparams.speed_up         = params.speed_up;
-            wparams.debug_mode       = params.debug_mode;
+        wparams.tdrz_enable      = rparams.tinydiarize; // [TDRZ]
 
-            wparams.tdrz_enable      = params.tinydiarize; // [TDRZ]
+        wparams.vad              = rparams.vad;
+        wparams.vad_thold        = rparams.vad_thold;
 
-            wparams.initial_prompt   = params.prompt.c_str();
+        wparams.initial_prompt   = rparams.prompt.c_str();
 
-            wparams.greedy.best_of        = params.best_of;
-            wparams.beam_search.beam_size = params.beam_size;
+        wparams.greedy.best_of        = rparams.best_of;
+        wparams.beam_search.beam_size = rparams.beam_size;
 
-            wparams.temperature_inc  = params.userdef_temp;
-            wparams.entropy_thold    = params.entropy_thold;
-            wparams.logprob_thold    = params.logprob_thold;
+        wparams.temperature_inc  = rparams.userdef_temp;
+        wparams.entropy_thold    = rparams.entropy_thold;
+        wparams.logprob_thold    = rparams.logprob_thold;
 
-            whisper_print_user_data user_data = { &params, &pcmf32s, 0 };
+        whisper_print_user_data user_data = { &rparams, &pcmf32s, 0 };
 
+        whisper_stream_user_data stream_data = { user_data, stream };
+
+        if (stream) {
+            // the callbacks print as well, if requested
+            wparams.new_segment_callback           = whisper_stream_segment_callback;
+            wparams.new_segment_callback_user_data = &stream_data;
+
+            wparams.progress_callback           = whisper_stream_progress_callback;
+            wparams.progress_callback_user_data = &stream_data;
+        } else {
             // this callback is called on each new segment
-            if (params.print_realtime) {
+            if (rparams.print_realtime) {
                 wparams.new_segment_callback           = whisper_print_segment_callback;
                 wparams.new_segment_callback_user_data = &user_data;
             }
@@ -618,113 +1761,235 @@ int main(int argc, char ** argv) {
                 wparams.progress_callback           = whisper_print_progress_callback;
                 wparams.progress_callback_user_data = &user_data;
             }
+        }
 
-            // examples for abort mechanism
-            // in examples below, we do not abort the processing, but we could if the flag is set to true
+        // the processing is aborted when the client of a streaming response goes away
+        std::atomic<bool> is_aborted(false);
+        std::atomic<bool> * aborted = stream ? &stream->closed : &is_aborted;
 
-            // the callback is called before every encoder run - if it returns false, the processing is aborted
-            {
-                static bool is_aborted = false; // NOTE: this should be atomic to avoid data race
+        // the callback is called before every encoder run - if it returns false, the processing is aborted
+        {
+            wparams.encoder_begin_callback = [](struct whisper_context * /*ctx*/, struct whisper_state * /*state*/, void * user_data) {
+                bool is_aborted = *(std::atomic<bool> *) user_data;
+                return !is_aborted;
+            };
+            wparams.encoder_begin_callback_user_data = aborted;
+        }
 
-                wparams.encoder_begin_callback = [](struct whisper_context * /*ctx*/, struct whisper_state * /*state*/, void * user_data) {
-                    bool is_aborted = *(bool*)user_data;
-                    return !is_aborted;
-                };
-                wparams.encoder_begin_callback_user_data = &is_aborted;
-            }
+        // the callback is called before every computation - if it returns true, the computation is aborted
+        {
+            wparams.abort_callback = [](void * user_data) {
+                bool is_aborted = *(std::atomic<bool> *) user_data;
+                return is_aborted;
+            };
+            wparams.abort_callback_user_data = aborted;
+        }
 
-            // the callback is called before every computation - if it returns true, the computation is aborted
-            {
-                static bool is_aborted = false; // NOTE: this should be atomic to avoid data race
+        if (batcher.batch) {
+            wparams.encode_callback = [](struct whisper_context * /*ctx*/, struct whisper_state * state, int offset, void * user_data) {
+                return ((server_batcher *) user_data)->encode(state, offset);
+            };
+            wparams.encode_callback_user_data = &batcher;
 
-                wparams.abort_callback = [](void * user_data) {
-                    bool is_aborted = *(bool*)user_data;
-                    return is_aborted;
-                };
-                wparams.abort_callback_user_data = &is_aborted;
-            }
+            batcher.begin();
+        }
 
-            if (whisper_full_parallel(ctx, wparams, pcmf32.data(), pcmf32.size(), params.n_processors) != 0) {
-                fprintf(stderr, "%s: failed to process audio\n", argv[0]);
-                const std::string error_resp = "{\"error\":\"failed to process audio\"}";
-                res.set_content(error_resp, "application/json");
-                whisper_mutex.unlock();
-                return;
-            }
+        const whisper_timings timings0 = whisper_get_timings_with_state(ctx, state);
+        const int64_t t_start_us = ggml_time_us();
+
+        const int ret = whisper_full_with_state(ctx, state, wparams, pcmf32.data(), pcmf32.size());
+
+        if (batcher.batch) {
+            batcher.end();
         }
 
-        // return results to user
-        if (params.response_format == text_format)
-        {
-            std::string results = output_str(ctx, params, pcmf32s);
-            res.set_content(results.c_str(), "text/html");
+        metrics.add_run(request.model->name, timings0, whisper_get_timings_with_state(ctx, state),
+                double(pcmf32.size())/WHISPER_SAMPLE_RATE, (ggml_time_us() - t_start_us)*1e-6);
+
+        if (ret != 0) {
+            fprintf(stderr, "%s: failed to process audio\n", argv[0]);
+            metrics.add_error();
+            return false;
         }
-        else if (params.response_format == srt_format)
+
+        metrics.add_ok();
+
+        return true;
+    };
+
+    svr.Post("/inference", [&](const Request &req, Response &res){
+        // first check user requested fields of the request
+        if (!req.has_file("file"))
         {
-            std::stringstream ss;
-            const int n_segments = whisper_full_n_segments(ctx);
-            for (int i = 0; i < n_segments; ++i) {
-                const char * text = whisper_full_get_segment_text(ctx, i);
-                const int64_t t0 = whisper_full_get_segment_t0(ctx, i);
-                const int64_t t1 = whisper_full_get_segment_t1(ctx, i);
-                std::string speaker = "";
-
-                if (params.diarize && pcmf32s.size() == 2)
-                {
-                    speaker = estimate_diarization_speaker(pcmf32s, t0, t1);
-                }
+            fprintf(stderr, "error: no 'file' field in the request\n");
+            metrics.add_error();
+            const std::string error_resp = "{\"error\":\"no 'file' field in the request\"}";
+            res.set_content(error_resp, "application/json");
+            return;
+        }
+
+        // do not bother reading the audio if the request cannot be queued
+        if (pool.check_full()) {
+            reject_busy(res);
+            return;
+        }
+
+        auto audio_file = req.get_file_value("file");
+
+        auto request = std::make_shared<server_request>();
+        request->t_received_us = ggml_time_us();
+
+        // check non-required fields
+        whisper_params & rparams = request->params;
+        rparams = params;
+        get_req_parameters(req, rparams);
+
+        std::string & filename = request->filename;
+        filename = audio_file.filename;
+        printf("Received request: %s\n", filename.c_str());
 
-                ss << i + 1 + params.offset_n << "\n";
-                ss << to_timestamp(t0, true) << " --> " << to_timestamp(t1, true) << "\n";
-                ss << speaker << text << "\n\n";
+        // audio arrays
+        std::vector<float>              & pcmf32  = request->pcmf32;
+        std::vector<std::vector<float>> & pcmf32s = request->pcmf32s;
+
+        // decode WAV and raw PCM from the request body
+        const std::string & content = audio_file.content;
+
+        const int64_t t_decode_start_us = ggml_time_us();
+
+        std::string error;
+        bool is_decoded = false;
+
+        if (!rparams.audio_format.empty()) {
+            is_decoded = audio_decode_raw(content.data(), content.size(), rparams.audio_format, rparams.sample_rate, rparams.channels,
+                    pcmf32, pcmf32s, rparams.diarize, error);
+        } else if (audio_is_wav(content.data(), content.size())) {
+            is_decoded = audio_decode_wav(content.data(), content.size(), pcmf32, pcmf32s, rparams.diarize, error);
+        } else {
+            error = "unsupported audio format, send WAV or raw PCM with 'audio-format'";
+        }
+
+        // other formats are converted to WAV by ffmpeg, through a temporary file
+        if (!is_decoded && rparams.audio_format.empty() && sparams.ffmpeg_converter) {
+            fprintf(stderr, "%s: '%s': %s, converting with ffmpeg\n", __func__, filename.c_str(), error.c_str());
+
+            // write to temporary file
+            const std::string temp_filename = "whisper_server_temp_file_" + std::to_string(n_requests++) + ".wav";
+            std::ofstream temp_file{temp_filename, std::ios::binary};
+            temp_file << content;
+            temp_file.close();
+
+            std::string error_resp = "{\"error\":\"Failed to execute ffmpeg command.\"}";
+            const bool is_converted = convert_to_wav(temp_filename, error_resp);
+            if (!is_converted) {
+                metrics.add_error();
+                res.set_content(error_resp, "application/json");
+                return;
             }
-            res.set_content(ss.str(), "application/x-subrip");
-        } else if (params.response_format == vtt_format) {
-            std::stringstream ss;
-
-            ss << "WEBVTT\n\n";
-
-            const int n_segments = whisper_full_n_segments(ctx);
-            for (int i = 0; i < n_segments; ++i) {
-                const char * text = whisper_full_get_segment_text(ctx, i);
-                const int64_t t0 = whisper_full_get_segment_t0(ctx, i);
-                const int64_t t1 = whisper_full_get_segment_t1(ctx, i);
-                std::string speaker = "";
-
-                if (params.diarize && pcmf32s.size() == 2)
-                {
-                    speaker = estimate_diarization_speaker(pcmf32s, t0, t1, true);
-                    speaker.insert(0, "<v Speaker");
-                    speaker.append(">");
-                }
 
-                ss << to_timestamp(t0) << " --> " << to_timestamp(t1) << "\n";
-                ss << speaker << text << "\n\n";
+            // read wav content into pcmf32
+            is_decoded = ::read_wav(temp_filename, pcmf32, pcmf32s, rparams.diarize);
+            if (!is_decoded) {
+                error = "failed to read WAV file";
             }
-            res.set_content(ss.str(), "text/vtt");
+
+            // remove temp file
+            std::remove(temp_filename.c_str());
         }
-        // TODO add more output formats
-        else
-        {
-            std::string results = output_str(ctx, params, pcmf32s);
+
+        metrics.add_decode_audio(ggml_time_us() - t_decode_start_us);
+
+        if (!is_decoded) {
+            fprintf(stderr, "error: failed to decode '%s': %s\n", filename.c_str(), error.c_str());
+            metrics.add_error();
             json jres = json{
-                {"text", results}
+                {"error", error}
             };
-            res.set_content(jres.dump(-1, ' ', false, json::error_handler_t::replace),
-                            "application/json");
+            res.set_content(jres.dump(), "application/json");
+            return;
+        }
+
+        printf("Successfully loaded %s\n", filename.c_str());
+
+        // the model selected by name, loaded if it is not resident
+        {
+            std::string error;
+            request->model = registry.get(req.has_file("model") ? req.get_file_value("model").content : "", error);
+            if (!request->model) {
+                fprintf(stderr, "error: %s\n", error.c_str());
+                metrics.add_error();
+                json jres = json{
+                    {"error", error}
+                };
+                res.set_content(jres.dump(), "application/json");
+                return;
+            }
+        }
+
+        // the request is queued when the response starts, the events are written by the worker
+        if (rparams.stream) {
+            res.set_header("Cache-Control", "no-cache");
+            res.set_chunked_content_provider("text/event-stream", [&, request](size_t /*offset*/, DataSink & sink) {
+                server_stream stream;
+                stream.sink = &sink;
+
+                int64_t t_wait_us = 0;
+
+                const bool accepted = pool.run([&](server_worker & worker) {
+                    if (!transcribe(worker, *request, &stream)) {
+                        stream.send("error", json{{"error", "failed to process audio"}});
+                        return;
+                    }
+
+                    stream.send("done", json{
+                        {"model",    request->model->name},
+                        {"text",     output_str(request->model->states[worker.id], request->params, request->pcmf32s)},
+                        {"segments", whisper_full_n_segments_from_state(request->model->states[worker.id])},
+                    });
+                }, t_wait_us);
+
+                if (!accepted) {
+                    fprintf(stderr, "error: all workers are busy and the queue is full, rejecting request\n");
+                    metrics.add_rejected();
+                    stream.send("error", json{{"error", "server is busy, try again later"}});
+                }
+
+                fprintf(stderr, "%s: '%s' waited %.1f ms for a worker\n", __func__, request->filename.c_str(), t_wait_us/1000.0);
+
+                sink.done();
+
+                return !stream.closed;
+            });
+            return;
+        }
+
+        int64_t t_wait_us = 0;
+
+        const bool accepted = pool.run([&](server_worker & worker) {
+            if (!transcribe(worker, *request, nullptr)) {
+                const std::string error_resp = "{\"error\":\"failed to process audio\"}";
+                res.set_content(error_resp, "application/json");
+                return;
+            }
+
+            // return results to user
+            set_result(res, request->model->states[worker.id], rparams, pcmf32s);
+        }, t_wait_us);
+
+        if (!accepted) {
+            reject_busy(res);
+            return;
         }
 
-        // return whisper model mutex lock
-        whisper_mutex.unlock();
+        fprintf(stderr, "%s: '%s' waited %.1f ms for a worker\n", __func__, filename.c_str(), t_wait_us/1000.0);
+        res.set_header("X-Queue-Wait-Ms", std::to_string(t_wait_us/1000));
     });
     svr.Post("/load", [&](const Request &req, Response &res){
-        whisper_mutex.lock();
         if (!req.has_file("model"))
         {
             fprintf(stderr, "error: no 'model' field in the request\n");
             const std::string error_resp = "{\"error\":\"no 'model' field in the request\"}";
             res.set_content(error_resp, "application/json");
-            whisper_mutex.unlock();
             return;
         }
         std::string model = req.get_file_value("model").content;
@@ -733,30 +1998,43 @@ int main(int argc, char ** argv) {
             fprintf(stderr, "error: 'model': %s not found!\n", model.c_str());
             const std::string error_resp = "{\"error\":\"model not found!\"}";
             res.set_content(error_resp, "application/json");
-            whisper_mutex.unlock();
             return;
         }
 
-        // clean up
-        whisper_free(ctx);
-
-        // whisper init
-        ctx = whisper_init_from_file_with_params(model.c_str(), cparams);
+        // the requests keep using the current model with this name until the new one is loaded
+        const std::string name = req.has_file("name") ? req.get_file_value("name").content : registry.name_default;
 
-        // TODO perhaps load prior model here instead of exit
-        if (ctx == nullptr) {
-            fprintf(stderr, "error: model init  failed, no model loaded must exit\n");
-            exit(1);
+        if (!registry.load(name, model)) {
+            fprintf(stderr, "error: failed to load model '%s' from '%s'\n", name.c_str(), model.c_str());
+            const std::string error_resp = "{\"error\":\"failed to load model\"}";
+            res.set_content(error_resp, "application/json");
+            return;
         }
 
-        // initialize openvino encoder. this has no effect on whisper.cpp builds that don't have OpenVINO configured
-        whisper_ctx_init_openvino_encoder(ctx, nullptr, params.openvino_encode_device.c_str(), nullptr);
-
         const std::string success = "Load was successful!";
         res.set_content(success, "application/text");
-
-        // check if the model is in the file system
-        whisper_mutex.unlock();
+    });
+    svr.Get("/stats", [&](const Request &, Response &res){
+        const server_pool_stats stats = pool.get_stats();
+
+        json jres = json{
+            {"workers",    stats.n_workers},
+            {"busy",       stats.n_busy},
+            {"queued",     stats.n_queued},
+            {"queue_size", stats.queue_size},
+            {"done",       stats.n_done},
+            {"rejected",   stats.n_rejected},
+            {"queue_wait_ms", {
+                {"total", stats.t_wait_us_total/1000.0},
+                {"max",   stats.t_wait_us_max/1000.0},
+                {"mean",  stats.n_done > 0 ? stats.t_wait_us_total/1000.0/stats.n_done : 0.0},
+            }},
+            {"models",     registry.to_json()},
+        };
+        res.set_content(jres.dump(), "application/json");
+    });
+    svr.Get("/metrics", [&](const Request &, Response &res){
+        res.set_content(metrics.to_prometheus(pool.get_stats(), registry.resident()), "text/plain; version=0.0.4");
     });
 
     svr.set_exception_handler([](const Request &, Response &res, std::exception_ptr ep) {
@@ -776,7 +2054,7 @@ int main(int argc, char ** argv) {
     svr.set_error_handler([](const Request &, Response &res) {
         if (res.status == 400) {
             res.set_content("Invalid request", "text/plain");
-        } else if (res.status != 500) {
+        } else if (res.status != 500 && res.status != 503) {
             res.set_content("File Not Found", "text/plain");
             res.status = 404;
         }
@@ -804,8 +2082,16 @@ int main(int argc, char ** argv) {
         return 1;
     }
 
-    whisper_print_timings(ctx);
-    whisper_free(ctx);
+    pool.stop();
+
+    {
+        std::shared_ptr<server_model> model = registry.get_default();
+        if (model) {
+            whisper_print_timings(model->ctx);
+        }
+    }
+
+    registry.clear();
 
     return 0;
 }
@@ -166,7 +166,7 @@ int main(int argc, char ** argv) {
         exit(0);
     }
 
-    struct whisper_context_params cparams;
+    struct whisper_context_params cparams = whisper_context_default_params();
     cparams.use_gpu = params.use_gpu;
 
     struct whisper_context * ctx = whisper_init_from_file_with_params(params.model.c_str(), cparams);
@@ -177,6 +177,13 @@ int main(int argc, char ** argv) {
 
     std::vector<whisper_token> prompt_tokens;
 
+    // in sliding window mode, the spectrogram is computed incrementally: each step only computes the frames of the new
+    // audio and the window is a view over the last frames
+    const bool use_mel_stream = !use_vad && !params.speed_up;
+    if (use_mel_stream) {
+        whisper_stream_mel_reset(ctx, (n_samples_keep + n_samples_len)/WHISPER_HOP_LENGTH + 1);
+    }
+
     // print some info about the processing
     {
         fprintf(stderr, "\n");
@@ -285,6 +292,11 @@ int main(int argc, char ** argv) {
             memcpy(pcmf32.data() + n_samples_take, pcmf32_new.data(), n_samples_new*sizeof(float));
 
             pcmf32_old = pcmf32;
+
+            if (use_mel_stream && whisper_stream_mel_push(ctx, pcmf32_new.data(), n_samples_new, params.n_threads) < 0) {
+                fprintf(stderr, "%s: failed to compute log mel spectrogram\n", argv[0]);
+                return 6;
+            }
         } else {
             const auto t_now  = std::chrono::high_resolution_clock::now();
             const auto t_diff = std::chrono::duration_cast<std::chrono::milliseconds>(t_now - t_last).count();
@@ -334,7 +346,15 @@ int main(int argc, char ** argv) {
             wparams.prompt_tokens    = params.no_context ? nullptr : prompt_tokens.data();
             wparams.prompt_n_tokens  = params.no_context ? 0       : prompt_tokens.size();
 
-            if (whisper_full(ctx, wparams, pcmf32.data(), pcmf32.size()) != 0) {
+            if (use_mel_stream) {
+                // the frames of the current window
+                whisper_stream_mel_view(ctx, 1 + ((int) pcmf32.size() - WHISPER_N_FFT/2)/WHISPER_HOP_LENGTH);
+
+                if (whisper_full(ctx, wparams, nullptr, 0) != 0) {
+                    fprintf(stderr, "%s: failed to process audio\n", argv[0]);
+                    return 6;
+                }
+            } else if (whisper_full(ctx, wparams, pcmf32.data(), pcmf32.size()) != 0) {
                 fprintf(stderr, "%s: failed to process audio\n", argv[0]);
                 return 6;
             }
@@ -0,0 +1,95 @@
+#pragma once
+
+// Write the performance information of a whisper context as JSON (--timings-json)
+//
+// Used by the main and bench examples, so that scripts like extra/bench.py get exact numbers instead of parsing the
+// output of whisper_print_timings()
+//
+// {
+//   "model": "models/ggml-base.en.bin", "backend": "CPU", "system_info": "AVX = 1 | ...",
+//   "n_threads": 4, "n_processors": 1,
+//   "load_ms": 95.1, "total_ms": 1403.2,
+//   "fallbacks": { "logprob": 0, "entropy": 0 },
+//   "phases": {
+//     "encode": { "total_ms": 1012.5, "runs": 1, "histogram": [ { "lo_us": 524288, "hi_us": 1048576, "count": 1 } ] },
+//     ...
+//   }
+// }
+//
+// "runs" is the count printed by whisper_print_timings() (tokens for batchd and prompt), the histograms count calls
+// and only list the non-empty buckets
+//
+
+#include "whisper.h"
+
+#include <cstdio>
+#include <cstdint>
+#include <string>
+
+static void whisper_timings_json_phase(FILE * f, const char * name, float total_ms, int32_t runs, const int32_t * hist, bool end) {
+    fprintf(f, "    \"%s\": { \"total_ms\": %.3f, \"runs\": %d", name, total_ms, runs);
+    if (hist) {
+        fprintf(f, ", \"histogram\": [");
+        bool first = true;
+        for (int i = 0; i < WHISPER_TIMINGS_N_BUCKETS; ++i) {
+            if (hist[i] == 0) {
+                continue;
+            }
+            fprintf(f, "%s { \"lo_us\": %lld, \"hi_us\": %lld, \"count\": %d }", first ? "" : ",",
+                    i == 0 ? 0LL : 1LL << i, 1LL << (i + 1), hist[i]);
+            first = false;
+        }
+        fprintf(f, " ]");
+    }
+    fprintf(f, " }%s\n", end ? "" : ",");
+}
+
+// fname: output file, "-" for stdout
+static bool whisper_timings_write_json(const std::string & fname, struct whisper_context * ctx, const std::string & model, int n_threads, int n_processors) {
+    FILE * f = fname == "-" ? stdout : fopen(fname.c_str(), "w");
+    if (f == nullptr) {
+        fprintf(stderr, "%s: failed to open '%s' for writing\n", __func__, fname.c_str());
+        return false;
+    }
+
+    const whisper_timings t = whisper_get_timings(ctx);
+
+    // the strings below do not need escaping, except for the model path
+    std::string model_esc;
+    for (char c : model) {
+        if (c == '"' || c == '\\') {
+            model_esc += '\\';
+        }
+        model_esc += c;
+    }
+
+    int32_t n_mel = 0;
+    for (int i = 0; i < WHISPER_TIMINGS_N_BUCKETS; ++i) {
+        n_mel += t.hist_mel[i];
+    }
+
+    fprintf(f, "{\n");
+    fprintf(f, "  \"model\": \"%s\",\n", model_esc.c_str());
+    fprintf(f, "  \"backend\": \"%s\",\n", t.backend);
+    fprintf(f, "  \"system_info\": \"%s\",\n", whisper_print_system_info());
+    fprintf(f, "  \"n_threads\": %d,\n", n_threads);
+    fprintf(f, "  \"n_processors\": %d,\n", n_processors);
+    fprintf(f, "  \"load_ms\": %.3f,\n", t.load_ms);
+    fprintf(f, "  \"total_ms\": %.3f,\n", t.total_ms);
+    fprintf(f, "  \"fallbacks\": { \"logprob\": %d, \"entropy\": %d },\n", t.n_fail_p, t.n_fail_h);
+    fprintf(f, "  \"phases\": {\n");
+    whisper_timings_json_phase(f, "mel",    t.mel_ms,    n_mel,      t.hist_mel,    false);
+    whisper_timings_json_phase(f, "sample", t.sample_ms, t.n_sample, t.hist_sample, false);
+    whisper_timings_json_phase(f, "encode", t.encode_ms, t.n_encode, t.hist_encode, false);
+    whisper_timings_json_phase(f, "decode", t.decode_ms, t.n_decode, t.hist_decode, false);
+    whisper_timings_json_phase(f, "batchd", t.batchd_ms, t.n_batchd, t.hist_batchd, false);
+    whisper_timings_json_phase(f, "prompt", t.prompt_ms, t.n_prompt, t.hist_prompt, true);
+    fprintf(f, "  }\n");
+    fprintf(f, "}\n");
+
+    if (f != stdout) {
+        fclose(f);
+    }
+
+    return true;
+}
@@ -5,6 +5,15 @@ import csv
 import wave
 import contextlib
 import argparse
+import json
+import math
+import shutil
+import sys
+import time
+import tempfile
+import statistics
+import threading
+import concurrent.futures
 
 
 # Custom action to handle comma-separated list
@@ -43,6 +52,120 @@ parser.add_argument(
     help="Relative path of the file to transcribe (default: ./samples/jfk.wav)",
 )
 
+parser.add_argument(
+    "-m",
+    "--models",
+    type=str,
+    default=None,
+    help="Comma-separated list of model files in ./models to benchmark (default: all standard models found)",
+)
+
+parser.add_argument(
+    "-w",
+    "--warmup",
+    type=int,
+    default=1,
+    help="Number of warm-up runs per configuration, not included in the results (default: 1)",
+)
+
+parser.add_argument(
+    "-n",
+    "--repetitions",
+    type=int,
+    default=5,
+    help="Number of measured runs per configuration (default: 5)",
+)
+
+parser.add_argument(
+    "-j",
+    "--jobs",
+    type=int,
+    default=1,
+    help="Maximum number of configurations to run concurrently, each on its own set of cores (default: 1). "
+    "Concurrent runs still share caches and memory bandwidth - use 1 for the most accurate numbers",
+)
+
+parser.add_argument(
+    "--no-pin",
+    dest="pin",
+    action="store_false",
+    help="Do not pin the runs to a set of cores",
+)
+
+parser.add_argument(
+    "-o",
+    "--output",
+    type=str,
+    default="benchmark_results.csv",
+    help="CSV file to write the results to (default: benchmark_results.csv)",
+)
+
+parser.add_argument(
+    "--corpus",
+    type=str,
+    default=None,
+    help="Benchmark over a corpus instead of a single file: a directory of .wav files, a JSON list of files or a text "
+    "file with one file per line",
+)
+
+parser.add_argument(
+    "--synthetic",
+    type=str,
+    default=None,
+    metavar="DIR",
+    help="Generate a corpus of the --durations from the sample file in DIR and benchmark over it",
+)
+
+parser.add_argument(
+    "--durations",
+    type=str,
+    default="5,15,30,60,120,300",
+    help="Comma-separated durations in seconds of the files of the synthetic corpus (default: 5,15,30,60,120,300)",
+)
+
+parser.add_argument(
+    "--history",
+    type=str,
+    default="bench_history.jsonl",
+    help="JSONL file the results of every run are appended to (default: bench_history.jsonl)",
+)
+
+parser.add_argument(
+    "--no-history",
+    dest="save_history",
+    action="store_false",
+    help="Do not append the results to the history file",
+)
+
+parser.add_argument(
+    "--label",
+    type=str,
+    default=None,
+    help="Name of the build in the history, e.g. 'ggml-sync' (default: the short git hash)",
+)
+
+parser.add_argument(
+    "--compare",
+    nargs=2,
+    metavar=("BASE", "NEW"),
+    default=None,
+    help="Do not run anything, compare the results of two builds (labels or commits) in the history instead",
+)
+
+parser.add_argument(
+    "--alpha",
+    type=float,
+    default=0.05,
+    help="Significance level of the comparison (default: 0.05)",
+)
+
+parser.add_argument(
+    "--threshold",
+    type=float,
+    default=2.0,
+    help="Minimum slowdown of the median in percent to report as a regression (default: 2.0)",
+)
+
 # Parse the command line arguments
 args = parser.parse_args()
 
@@ -64,6 +187,9 @@ models = [
     "ggml-large.bin",
 ]
 
+if args.models:
+    models = args.models.split(",")
+
 
 metal_device = ""
 
@@ -76,14 +202,27 @@ hardwareHeader = "Hardware"
 recordingLengthHeader = "Recording Length (seconds)"
 threadHeader = "Thread"
 processorCountHeader = "Processor Count"
-loadTimeHeader = "Load Time (ms)"
-sampleTimeHeader = "Sample Time (ms)"
-encodeTimeHeader = "Encode Time (ms)"
-decodeTimeHeader = "Decode Time (ms)"
-sampleTimePerRunHeader = "Sample Time per Run (ms)"
-encodeTimePerRunHeader = "Encode Time per Run (ms)"
-decodeTimePerRunHeader = "Decode Time per Run (ms)"
-totalTimeHeader = "Total Time (ms)"
+coresHeader = "Cores"
+runsHeader = "Runs"
+
+# the phases reported by whisper_print_timings
+# (metric, label in the log, has a number of runs)
+metrics = [
+    ("Load", "load", False),
+    ("Mel", "mel", False),
+    ("Sample", "sample", True),
+    ("Encode", "encode", True),
+    ("Decode", "decode", True),
+    ("Batchd", "batchd", True),
+    ("Prompt", "prompt", True),
+    ("Total", "total", False),
+]
+
+# the metrics that are summarized with median, p95 and standard deviation
+summary_metrics = ["Load", "Mel", "Encode", "Decode", "Total"]
+
+# the metrics that are also reported per run (per call of the encoder / decoder)
+per_run_metrics = ["Sample", "Encode", "Decode"]
 
 
 def check_file_exists(file: str) -> bool:
@@ -110,9 +249,9 @@ def wav_file_length(file: str = sample_file) -> float:
 
 
 def extract_metrics(output: str, label: str) -> tuple[float, float]:
-    match = re.search(rf"{label} \s*=\s*(\d+\.\d+)\s*ms\s*/\s*(\d+)\s*runs", output)
+    match = re.search(rf"{label} time\s*=\s*(\d+\.\d+)\s*ms(?:\s*/\s*(\d+)\s*runs)?", output)
     time = float(match.group(1)) if match else None
-    runs = float(match.group(2)) if match else None
+    runs = float(match.group(2)) if match and match.group(2) else None
     return time, runs
 
 
@@ -122,11 +261,367 @@ def extract_device(output: str) -> str:
     return device
 
 
-# Check if the sample file exists
-if not check_file_exists(sample_file):
-    raise FileNotFoundError(f"Sample file {sample_file} not found")
+def percentile(values: list[float], p: float) -> float:
+    """nearest-rank percentile"""
+    values = sorted(values)
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+
+def summarize(values: list[float]) -> tuple[float, float, float]:
+    """(median, p95, stddev) of the samples, ignoring missing values"""
+    values = [v for v in values if v is not None]
+    if not values:
+        return None, None, None
+    stddev = statistics.stdev(values) if len(values) > 1 else 0.0
+    return (
+        round(statistics.median(values), 2),
+        round(percentile(values, 95), 2),
+        round(stddev, 2),
+    )
+
+
+def can_pin() -> bool:
+    return shutil.which("taskset") is not None
+
+
+def available_cores() -> list[int]:
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def parse_timings_json(fname: str) -> dict:
+    """the timings written by ./main --timings-json, None if the file was not written"""
+    try:
+        with open(fname, "r") as f:
+            timings = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    sample = {"device": timings["backend"], "system_info": timings.get("system_info", "")}
+    for name, label, _ in metrics:
+        if label in timings["phases"]:
+            phase = timings["phases"][label]
+            sample[name] = phase["total_ms"]
+            sample[name + " runs"] = phase["runs"]
+        else:
+            sample[name] = timings.get(label + "_ms")
+            sample[name + " runs"] = None
+    return sample
+
+
+def run_once(model: str, thread: int, processor_count: int, cores: list[int], fname: str = None) -> dict:
+    """run ./main once on fname (default: the sample file) and return the timings, wall time and peak RSS"""
+    fname = fname or sample_file
+    with tempfile.TemporaryDirectory() as tmpdir:
+        fname_timings = os.path.join(tmpdir, "timings.json")
+        cmd = [
+            "./main", "-m", f"models/{model}", "-t", str(thread), "-p", str(processor_count), "-f", fname,
+            "--timings-json", fname_timings,
+        ]
+
+        # taskset sets the affinity before exec, so that all the threads of ./main inherit it - this is called from
+        # worker threads, where a preexec_fn is not safe
+        if cores is not None:
+            cmd = ["taskset", "-c", ",".join(str(core) for core in cores)] + cmd
+
+        # the output goes to a file, so that the process can be reaped with wait4() to get its resource usage
+        with open(os.path.join(tmpdir, "output.txt"), "w+b") as fout:
+            t_start = time.perf_counter()
+            process = subprocess.Popen(cmd, stdout=fout, stderr=subprocess.STDOUT)
+            _, status, rusage = os.wait4(process.pid, 0)
+            wall_ms = (time.perf_counter() - t_start) * 1000
+            process.returncode = os.waitstatus_to_exitcode(status)
+
+            fout.seek(0)
+            output = fout.read().decode(errors="replace")
+
+        if process.returncode != 0:
+            raise RuntimeError(f"{' '.join(cmd)} failed with exit code {process.returncode}")
+
+        sample = parse_timings_json(fname_timings)
+
+    if sample is None:
+        # fall back to parsing the log printed by whisper_print_timings
+        sample = {"device": extract_device(output), "system_info": ""}
+        for name, label, _ in metrics:
+            t, runs = extract_metrics(output, label)
+            sample[name] = t
+            sample[name + " runs"] = runs
+
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    sample["Wall"] = wall_ms
+    sample["Peak RSS"] = rusage.ru_maxrss / (1024 * 1024 if sys.platform == "darwin" else 1024)
+    return sample
+
+
+def run_config(model: str, thread: int, processor_count: int, cores: list[int]) -> list[dict]:
+    """warm-up runs followed by the measured runs, all on the same cores"""
+    for _ in range(args.warmup):
+        run_once(model, thread, processor_count, cores)
+    return [run_once(model, thread, processor_count, cores) for _ in range(args.repetitions)]
+
+
+def summarize_config(samples: list[dict]) -> dict:
+    times = {}
+    for name in summary_metrics:
+        median, p95, stddev = summarize([s[name] for s in samples])
+        times[f"{name} Time Median (ms)"] = median
+        times[f"{name} Time P95 (ms)"] = p95
+        times[f"{name} Time Stddev (ms)"] = stddev
+    for name in per_run_metrics:
+        times[f"{name} Time per Run Median (ms)"] = summarize(per_run_samples(samples, name))[0]
+    return times
+
+
+def per_run_samples(samples: list[dict], name: str) -> list[float]:
+    """the time per call of each measured run"""
+    return [
+        s[name] / s[name + " runs"]
+        for s in samples
+        if s[name] is not None and s[name + " runs"]
+    ]
 
-recording_length = wav_file_length()
+
+# Result history
+#
+# Every configuration that is run is appended to the history as one JSON line, with the raw samples, so that any two
+# builds can be compared later. The results are keyed by the build (label or commit), the model, the thread and
+# processor counts, the hardware and the ggml build flags (system info). Builds are compared with a two-sided
+# Mann-Whitney U test of the encode and decode times per run, which does not assume normally distributed timings.
+
+
+def history_record(model: str, thread: int, processor_count: int, cores: list[int], samples: list[dict]) -> dict:
+    commit = get_git_short_hash()
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "build": args.label or commit,
+        "commit": commit,
+        "model": model,
+        "threads": thread,
+        "processors": processor_count,
+        "cores": len(cores),
+        "hardware": samples[0]["device"],
+        "system_info": samples[0]["system_info"],
+        "sample_file": sample_file,
+        "samples": {
+            **{name: [s[name] for s in samples] for name in summary_metrics},
+            **{name + " per Run": per_run_samples(samples, name) for name in per_run_metrics},
+        },
+    }
+
+
+def append_history(record: dict):
+    with open(args.history, "a") as f:
+        f.write(json.dumps(record) + "\n")
+
+
+def load_history(fname: str) -> list[dict]:
+    records = []
+    with open(fname, "r") as f:
+        for line in f:
+            if line.strip():
+                records.append(json.loads(line))
+    return records
+
+
+def normal_sf(z: float) -> float:
+    """P(Z > z) for a standard normal Z"""
+    return 0.5 * math.erfc(z / math.sqrt(2))
+
+
+def mann_whitney_u(a: list[float], b: list[float]) -> float:
+    """two-sided p-value of the Mann-Whitney U test (normal approximation with tie and continuity correction)"""
+    n1, n2 = len(a), len(b)
+    if n1 == 0 or n2 == 0:
+        return 1.0
+
+    values = sorted([(v, 0) for v in a] + [(v, 1) for v in b])
+
+    # average ranks for ties
+    ranks = [0.0] * len(values)
+    tie_term = 0.0
+    i = 0
+    while i < len(values):
+        j = i
+        while j + 1 < len(values) and values[j + 1][0] == values[i][0]:
+            j += 1
+        for k in range(i, j + 1):
+            ranks[k] = (i + j) / 2 + 1
+        t = j - i + 1
+        tie_term += t**3 - t
+        i = j + 1
+
+    r1 = sum(r for r, (_, group) in zip(ranks, values) if group == 0)
+    u1 = r1 - n1 * (n1 + 1) / 2
+
+    n = n1 + n2
+    mu = n1 * n2 / 2
+    sigma = math.sqrt(n1 * n2 / 12 * ((n + 1) - tie_term / (n * (n - 1))))
+    if sigma == 0:
+        return 1.0
+
+    z = (abs(u1 - mu) - 0.5) / sigma
+    return min(1.0, 2 * normal_sf(max(0.0, z)))
+
+
+def select_build(records: list[dict], build: str) -> list[dict]:
+    """the records of a build, matched by label or commit prefix"""
+    return [r for r in records if r["build"] == build or r["commit"].startswith(build)]
+
+
+def compare_builds(base: str, new: str) -> int:
+    """print the comparison of two builds, returns the number of significant regressions"""
+    records = load_history(args.history)
+
+    groups = {}
+    for which, build in (("base", base), ("new", new)):
+        selected = select_build(records, build)
+        if not selected:
+            print(f"Error: no results for build '{build}' in {args.history}")
+            sys.exit(2)
+        for r in selected:
+            key = (r["model"], r["threads"], r["processors"], r["hardware"], r["system_info"], r["sample_file"])
+            group = groups.setdefault(key, {"base": {}, "new": {}})
+            # all runs of the same build and configuration are pooled
+            for name, values in r["samples"].items():
+                group[which].setdefault(name, []).extend(v for v in values if v is not None)
+
+    regressions = 0
+    compared = 0
+    print(f"Comparing {new} against {base} (alpha = {args.alpha}, threshold = {args.threshold}%)")
+    for (model, thread, processor_count, hardware, _, _), group in sorted(groups.items(), key=lambda x: x[0][:3]):
+        if not group["base"] or not group["new"]:
+            continue
+        for name in ("Encode per Run", "Decode per Run"):
+            a = group["base"].get(name, [])
+            b = group["new"].get(name, [])
+            if not a or not b:
+                continue
+            compared += 1
+
+            median_a = statistics.median(a)
+            median_b = statistics.median(b)
+            change = 100 * (median_b - median_a) / median_a if median_a else 0.0
+            p = mann_whitney_u(a, b)
+
+            status = ""
+            if p < args.alpha and change > args.threshold:
+                status = "REGRESSION"
+                regressions += 1
+            elif p < args.alpha and change < -args.threshold:
+                status = "improvement"
+
+            print(
+                f"  {model:24s} t={thread:<3d} p={processor_count:<2d} {hardware:10s} {name:15s} "
+                f"{median_a:9.3f} ms -> {median_b:9.3f} ms ({change:+6.1f}%, n={len(a)}/{len(b)}, p={p:.4f}) {status}"
+            )
+
+    if compared == 0:
+        print("No common configurations to compare")
+    elif regressions:
+        print(f"{regressions} significant regression(s)")
+    else:
+        print("No significant regressions")
+
+    return regressions
+
+
+if args.compare:
+    sys.exit(1 if compare_builds(*args.compare) else 0)
+
+
+# Corpus mode
+#
+# Every file of the corpus is transcribed in its own ./main process (each of the -n repetitions). Reported per
+# configuration:
+#
+#  - RTF:                       processing time (wall time minus model load) / audio duration, over the whole corpus
+#  - Audio Seconds per Second:  audio duration / wall time including the model load, i.e. the batch throughput
+#  - Latency P50/P90/P99:       percentiles of the per-file processing times
+#  - Peak RSS:                  the largest resident set size of any of the processes
+
+
+def generate_synthetic_corpus(dir_out: str, durations: list[float]) -> str:
+    """files of the given durations made by repeating the sample file - real speech, unlike noise or silence"""
+    os.makedirs(dir_out, exist_ok=True)
+    with contextlib.closing(wave.open(sample_file, "r")) as f:
+        params = f.getparams()
+        frames = f.readframes(f.getnframes())
+    for duration in durations:
+        fname = os.path.join(dir_out, f"synthetic-{duration:g}s.wav")
+        if os.path.isfile(fname):
+            continue
+        n_bytes = int(duration * params.framerate) * params.sampwidth * params.nchannels
+        data = (frames * (n_bytes // len(frames) + 1))[:n_bytes]
+        with contextlib.closing(wave.open(fname, "w")) as f:
+            f.setparams(params)
+            f.writeframes(data)
+    return dir_out
+
+
+def load_corpus(path: str) -> list[str]:
+    if os.path.isdir(path):
+        files = sorted(os.path.join(path, f) for f in os.listdir(path) if f.lower().endswith(".wav"))
+    else:
+        base = os.path.dirname(path)
+        with open(path, "r") as f:
+            if path.endswith(".json"):
+                files = json.load(f)
+            else:
+                files = [line.strip() for line in f if line.strip() and not line.startswith("#")]
+        files = [os.path.join(base, os.path.expanduser(fname)) for fname in files]
+    for fname in files:
+        if not check_file_exists(fname):
+            raise FileNotFoundError(f"Corpus file {fname} not found")
+    if not files:
+        raise FileNotFoundError(f"No audio files in corpus {path}")
+    return files
+
+
+def run_corpus(model: str, thread: int, processor_count: int, cores: list[int]) -> list[dict]:
+    """a warm-up run on the first file, then every file -n times"""
+    for _ in range(args.warmup):
+        run_once(model, thread, processor_count, cores, corpus_files[0])
+    samples = []
+    for _ in range(args.repetitions):
+        for fname in corpus_files:
+            sample = run_once(model, thread, processor_count, cores, fname)
+            sample["Audio"] = corpus_lengths[fname]
+            samples.append(sample)
+    return samples
+
+
+def summarize_corpus(samples: list[dict]) -> dict:
+    audio = sum(s["Audio"] for s in samples)
+    wall = sum(s["Wall"] for s in samples) / 1000
+    latencies = [s["Wall"] - (s["Load"] or 0.0) for s in samples]
+    return {
+        "RTF": round(sum(latencies) / 1000 / audio, 4),
+        "Audio Seconds per Second": round(audio / wall, 2),
+        "Latency P50 (ms)": round(percentile(latencies, 50), 2),
+        "Latency P90 (ms)": round(percentile(latencies, 90), 2),
+        "Latency P99 (ms)": round(percentile(latencies, 99), 2),
+        "Peak RSS (MB)": round(max(s["Peak RSS"] for s in samples), 1),
+    }
+
+
+# Check if the sample file exists - a given corpus does not use it, a synthetic one is made from it
+if args.synthetic or not args.corpus:
+    if not check_file_exists(sample_file):
+        raise FileNotFoundError(f"Sample file {sample_file} not found")
+
+if args.synthetic:
+    args.corpus = generate_synthetic_corpus(args.synthetic, [float(d) for d in args.durations.split(",")])
+
+if args.corpus:
+    corpus_files = load_corpus(args.corpus)
+    corpus_lengths = {fname: wav_file_length(fname) for fname in corpus_files}
+    sample_file = args.corpus
+    recording_length = round(sum(corpus_lengths.values()), 2)
+    print(f"Corpus {args.corpus}: {len(corpus_files)} files, {recording_length} seconds of audio")
+else:
+    recording_length = wav_file_length()
 
 
 # Check that all models exist
@@ -140,52 +635,99 @@ for model in models:
 
 models = filtered_models
 
-# Loop over each combination of parameters
-for model in filtered_models:
-    for thread in threads:
-        for processor_count in processors:
-            # Construct the command to run
-            cmd = f"./main -m models/{model} -t {thread} -p {processor_count} -f {sample_file}"
-            # Run the command and get the output
-            process = subprocess.Popen(
-                cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT
-            )
+if args.pin and not can_pin():
+    print("taskset is not available, the runs will not be pinned")
+    args.pin = False
+
+# Schedule the configurations on disjoint sets of cores
+#
+# Each configuration needs threads*processors cores. Up to --jobs configurations run at the same time, as long as
+# enough cores are free. A configuration that needs more cores than available runs alone on all of them.
+cores_all = available_cores()
+cores_free = list(cores_all)
+cores_cond = threading.Condition()
+
+configs = [
+    (model, thread, processor_count)
+    for model in filtered_models
+    for thread in threads
+    for processor_count in processors
+]
 
-            output = ""
-            while process.poll() is None:
-                output += process.stdout.read().decode()
 
-            # Parse the output
-            load_time_match = re.search(r"load time\s*=\s*(\d+\.\d+)\s*ms", output)
-            load_time = float(load_time_match.group(1)) if load_time_match else None
+def acquire_cores(n: int) -> list[int]:
+    n = min(n, len(cores_all))
+    with cores_cond:
+        cores_cond.wait_for(lambda: len(cores_free) >= n)
+        cores = cores_free[:n]
+        del cores_free[:n]
+        return cores
 
-            metal_device = extract_device(output)
-            sample_time, sample_runs = extract_metrics(output, "sample time")
-            encode_time, encode_runs = extract_metrics(output, "encode time")
-            decode_time, decode_runs = extract_metrics(output, "decode time")
 
-            total_time_match = re.search(r"total time\s*=\s*(\d+\.\d+)\s*ms", output)
-            total_time = float(total_time_match.group(1)) if total_time_match else None
+def release_cores(cores: list[int]):
+    with cores_cond:
+        cores_free.extend(cores)
+        cores_free.sort()
+        cores_cond.notify_all()
 
-            model_name = model.replace("ggml-", "").replace(".bin", "")
 
+def run_scheduled(config: tuple) -> tuple:
+    model, thread, processor_count = config
+    cores = acquire_cores(thread * processor_count)
+    try:
+        run = run_corpus if args.corpus else run_config
+        samples = run(model, thread, processor_count, cores if args.pin else None)
+    finally:
+        release_cores(cores)
+    return config, cores, samples
+
+
+with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, args.jobs)) as executor:
+    futures = [executor.submit(run_scheduled, config) for config in configs]
+    for future in concurrent.futures.as_completed(futures):
+        try:
+            (model, thread, processor_count), cores, samples = future.result()
+        except RuntimeError as e:
+            print(f"Error: {e}")
+            continue
+
+        metal_device = samples[0]["device"]
+        times = summarize_config(samples)
+
+        if args.save_history:
+            append_history(history_record(model, thread, processor_count, cores, samples))
+
+        model_name = model.replace("ggml-", "").replace(".bin", "")
+
+        if args.corpus:
+            times = summarize_corpus(samples)
             print(
-                f"Ran model={model_name} threads={thread} processor_count={processor_count}, took {total_time}ms"
+                f"Ran model={model_name} threads={thread} processor_count={processor_count} "
+                f"cores={','.join(map(str, cores))}, {len(samples)} files, "
+                f"RTF {times['RTF']} ({times['Audio Seconds per Second']} audio s/s), "
+                f"latency p50 {times['Latency P50 (ms)']}ms p99 {times['Latency P99 (ms)']}ms, "
+                f"peak RSS {times['Peak RSS (MB)']} MB"
             )
-            # Store the times in the results dictionary
-            results[(model_name, thread, processor_count)] = {
-                loadTimeHeader: load_time,
-                sampleTimeHeader: sample_time,
-                encodeTimeHeader: encode_time,
-                decodeTimeHeader: decode_time,
-                sampleTimePerRunHeader: round(sample_time / sample_runs, 2),
-                encodeTimePerRunHeader: round(encode_time / encode_runs, 2),
-                decodeTimePerRunHeader: round(decode_time / decode_runs, 2),
-                totalTimeHeader: total_time,
-            }
+        else:
+            print(
+                f"Ran model={model_name} threads={thread} processor_count={processor_count} "
+                f"cores={','.join(map(str, cores))}, {len(samples)} runs, "
+                f"total median {times['Total Time Median (ms)']}ms p95 {times['Total Time P95 (ms)']}ms "
+                f"stddev {times['Total Time Stddev (ms)']}ms"
+            )
+        # Store the times in the results dictionary
+        results[(model_name, thread, processor_count)] = {
+            coresHeader: len(cores),
+            runsHeader: len(samples),
+            **times,
+        }
+
+if not results:
+    print("No results")
+    exit(1)
 
 # Write the results to a CSV file
-with open("benchmark_results.csv", "w", newline="") as csvfile:
+with open(args.output, "w", newline="") as csvfile:
     fieldnames = [
         gitHashHeader,
         modelHeader,
@@ -193,22 +735,15 @@ with open("benchmark_results.csv", "w", newline="") as csvfile:
         recordingLengthHeader,
         threadHeader,
         processorCountHeader,
-        loadTimeHeader,
-        sampleTimeHeader,
-        encodeTimeHeader,
-        decodeTimeHeader,
-        sampleTimePerRunHeader,
-        encodeTimePerRunHeader,
-        decodeTimePerRunHeader,
-        totalTimeHeader,
+        *next(iter(results.values())).keys(),
     ]
     writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
 
     writer.writeheader()
 
     shortHash = get_git_short_hash()
-    # Sort the results by total time in ascending order
-    sorted_results = sorted(results.items(), key=lambda x: x[1].get(totalTimeHeader, 0))
+    # Sort the results by median total time (or real-time factor) in ascending order
+    sorted_results = sorted(results.items(), key=lambda x: x[1].get("Total Time Median (ms)") or x[1].get("RTF") or 0)
     for params, times in sorted_results:
         row = {
             gitHashHeader: shortHash,
@@ -220,3 +755,5 @@ with open("benchmark_results.csv", "w", newline="") as csvfile:
         }
         row.update(times)
         writer.writerow(row)
+
+print(f"Results written to {args.output}")
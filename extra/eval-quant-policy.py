@@ -0,0 +1,133 @@
+# Evaluate per-tensor quantization policies
+#
+# Quantizes a model with each policy (see examples/quantize/policy-mixed.txt) or plain ggml type, transcribes the test
+# audio of tests/run-tests.sh with each result and reports the model size, the encode and decode times and the word
+# error rate against the reference transcriptions in tests/*-ref.txt.
+#
+# Usage (from the repo root, after ./tests/run-tests.sh has downloaded the test audio):
+#
+#   python3 extra/eval-quant-policy.py -m models/ggml-base.en.bin q5_0 q8_0 examples/quantize/policy-mixed.txt
+#
+
+import argparse
+import csv
+import hashlib
+import json
+import re
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+DIR_TESTS = Path("tests")
+
+
+def normalize(text: str) -> list[str]:
+    """lowercase words without punctuation"""
+    return re.sub(r"[^\w\s']", " ", text.lower()).split()
+
+
+def word_error_rate(ref: list[str], hyp: list[str]) -> float:
+    """(substitutions + deletions + insertions) / reference words"""
+    prev = list(range(len(hyp) + 1))
+    for i, r in enumerate(ref, 1):
+        cur = [i] + [0]*len(hyp)
+        for j, h in enumerate(hyp, 1):
+            cur[j] = min(prev[j] + 1, cur[j - 1] + 1, prev[j - 1] + (r != h))
+        prev = cur
+    return prev[-1] / max(1, len(ref))
+
+
+def phase_time(timings: dict, label: str) -> float:
+    """total time of a phase in the timings written by ./main --timings-json"""
+    try:
+        return float(timings["phases"][label]["total_ms"])
+    except (KeyError, TypeError, ValueError):
+        raise RuntimeError(f"no '{label}' time in the timings of {timings.get('model', '?')}")
+
+
+def quantize(quantize_bin: str, model: Path, qtype: str, dir_out: Path) -> Path:
+    policy = Path(qtype)
+    if policy.is_file():
+        # the cached model is identified by the contents of the policy, so that an edited policy is quantized again
+        digest = hashlib.sha256(policy.read_bytes()).hexdigest()[:16]
+        fout   = dir_out / f"{model.stem}-{policy.stem}-{digest}.bin"
+    else:
+        fout   = dir_out / f"{model.stem}-{qtype}.bin"
+    if not fout.exists():
+        ftmp = fout.with_suffix(".tmp")
+        cmd  = [quantize_bin, str(model), str(ftmp)] + (["--policy", str(policy)] if policy.is_file() else [qtype])
+        try:
+            subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL)
+            ftmp.replace(fout)
+        finally:
+            ftmp.unlink(missing_ok=True)
+    return fout
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Evaluate quantization policies: size, speed and word error rate")
+    parser.add_argument("qtypes", nargs="+", help="policy files or ggml types (q5_0, q8_0, ...)")
+    parser.add_argument("-m", "--model", type=Path, required=True, help="f16 or f32 source model")
+    parser.add_argument("-t", "--threads", type=int, default=4, help="number of threads (default: 4)")
+    parser.add_argument("--main", default="./main", help="path to the main example (default: ./main)")
+    parser.add_argument("--quantize", default="./quantize", help="path to the quantize tool (default: ./quantize)")
+    parser.add_argument("--dir-out", type=Path, default=Path("models"), help="where to store the quantized models")
+    parser.add_argument("-o", "--output", type=Path, default=Path("quant_policy_results.csv"), help="CSV results")
+    args = parser.parse_args()
+
+    refs = sorted(DIR_TESTS.glob("*-ref.txt"))
+    if args.model.stem.endswith(".en"):
+        refs = [r for r in refs if r.name.startswith("en-")]
+    samples = [(r, DIR_TESTS / r.name.replace("-ref.txt", "-16khz.wav")) for r in refs]
+    samples = [(r, w) for r, w in samples if w.exists()]
+    if not samples:
+        print("Error: no test audio found - run ./tests/run-tests.sh first")
+        sys.exit(1)
+
+    models = [("source", args.model)] + [(q, quantize(args.quantize, args.model, q, args.dir_out)) for q in args.qtypes]
+
+    rows = []
+    for name, model in models:
+        t_encode = 0.0
+        t_decode = 0.0
+        n_errors = 0.0
+        n_words  = 0
+        for ref, wav in samples:
+            lang = ref.name.split("-")[0]
+            with tempfile.TemporaryDirectory() as tmpdir:
+                fname_timings = Path(tmpdir) / "timings.json"
+                cmd  = [args.main, "-m", str(model), "-t", str(args.threads), "-f", str(wav), "-l", lang, "-nt",
+                        "--timings-json", str(fname_timings)]
+                proc = subprocess.run(cmd, capture_output=True, text=True, check=True)
+                if not fname_timings.exists():
+                    raise RuntimeError(f"{' '.join(cmd)} did not write the timings")
+                timings = json.loads(fname_timings.read_text())
+
+            t_encode += phase_time(timings, "encode")
+            t_decode += phase_time(timings, "decode") + phase_time(timings, "batchd")
+
+            words = normalize(ref.read_text(encoding="utf8"))
+            n_errors += word_error_rate(words, normalize(proc.stdout))*len(words)
+            n_words  += len(words)
+
+        row = {
+            "Model":            name,
+            "Size (MB)":        round(model.stat().st_size/1024/1024, 2),
+            "Encode Time (ms)": round(t_encode, 2),
+            "Decode Time (ms)": round(t_decode, 2),
+            "WER (%)":          round(100*n_errors/max(1, n_words), 2),
+        }
+        rows.append(row)
+        print("  ".join(f"{k} = {v}" for k, v in row.items()))
+
+    with open(args.output, "w", newline="") as csvfile:
+        writer = csv.DictWriter(csvfile, fieldnames=list(rows[0]))
+        writer.writeheader()
+        writer.writerows(rows)
+
+    print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,265 @@
+# Convert a set of Whisper checkpoints to ggml format concurrently
+#
+# Usage:
+#
+#   python3 models/convert-batch.py manifest.json path-to-whisper-repo dir-output [options]
+#
+# The manifest is a JSON list of checkpoints. "input" is either an OpenAI .pt checkpoint (converted like
+# convert-pt-to-ggml.py) or a Hugging Face model directory (converted like convert-h5-to-ggml.py):
+#
+#   [
+#     { "name": "large-v3",  "input": "~/.cache/whisper/large-v3.pt" },
+#     { "name": "medium-nl", "input": "./whisper-medium-nl", "variants": [ "f16" ] }
+#   ]
+#
+# For each checkpoint, all requested variants are written in a single pass over the tensors:
+#
+#   dir-output/ggml-<name>.bin           (f16)
+#   dir-output/ggml-<name>-<variant>.bin (all other variants: f32, q4_0, q4_1, q5_0, q5_1, q8_0)
+#
+# Per-tensor precision policies (see ggml_format.QuantPolicy) can be given with --policy name=policy.txt and are
+# written as additional variants, ggml-<name>-<policy name>.bin.
+#
+# The checkpoints are converted in a process pool. The workers are reused, so torch/transformers are imported once
+# per worker rather than once per model, and new conversions are only started while the estimated memory of the ones
+# in flight stays under --max-memory.
+#
+# Outputs are stored in a content-addressed cache, keyed by the hash of the input checkpoint, the whisper assets, the
+# converter sources and the variant. Checkpoints that have not changed since the last run are not converted again -
+# the cached file is just linked (or copied) to the output directory.
+#
+
+import argparse
+import concurrent.futures
+import hashlib
+import importlib.util
+import json
+import os
+import shutil
+import sys
+import time
+from pathlib import Path
+
+from ggml_format import VARIANTS, QuantPolicy
+
+DIR_SCRIPTS = Path(__file__).resolve().parent
+
+CONVERTERS = {
+    "pt": DIR_SCRIPTS / "convert-pt-to-ggml.py",
+    "h5": DIR_SCRIPTS / "convert-h5-to-ggml.py",
+}
+
+HASH_CHUNK_SIZE = 16*1024*1024
+
+# converter modules, loaded at most once per worker process
+_converters = {}
+
+
+def load_converter(kind):
+    if kind not in _converters:
+        spec = importlib.util.spec_from_file_location(f"convert_{kind}_to_ggml", CONVERTERS[kind])
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        _converters[kind] = module
+    return _converters[kind]
+
+
+def hash_path(path, h=None):
+    """sha256 of a file, or of all files in a directory (names and contents, in sorted order)"""
+    h = h or hashlib.sha256()
+    path = Path(path)
+    files = sorted(p for p in path.rglob("*") if p.is_file()) if path.is_dir() else [path]
+    for fname in files:
+        h.update(str(fname.relative_to(path) if path.is_dir() else fname.name).encode("utf-8"))
+        with open(fname, "rb") as f:
+            while chunk := f.read(HASH_CHUNK_SIZE):
+                h.update(chunk)
+    return h
+
+
+def tool_digest(dir_whisper):
+    """hash of everything besides the checkpoint that affects the output"""
+    h = hashlib.sha256()
+    for fname in [ *CONVERTERS.values(), DIR_SCRIPTS / "ggml_format.py", DIR_SCRIPTS / "ggml_quants.py" ]:
+        hash_path(fname, h)
+    hash_path(Path(dir_whisper) / "whisper" / "assets", h)
+    return h.hexdigest()
+
+
+def path_size(path):
+    path = Path(path)
+    if path.is_dir():
+        return sum(p.stat().st_size for p in path.rglob("*") if p.is_file())
+    return path.stat().st_size
+
+
+def output_name(name, variant):
+    return f"ggml-{name}.bin" if variant == "f16" else f"ggml-{name}-{variant}.bin"
+
+
+def materialize(src, dst):
+    """hard link src to dst, falling back to a copy across file systems"""
+    if dst.exists():
+        if dst.samefile(src):
+            return
+        dst.unlink()
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+def convert_job(job):
+    """runs in a worker process - returns (name, list of converted variants, list of cached variants, seconds)"""
+    t_start = time.time()
+
+    name     = job["name"]
+    inp      = Path(job["input"])
+    dir_out  = Path(job["dir_out"])
+    variants = job["variants"]
+    policies = { p: QuantPolicy.load(fname, p) for p, fname in job["policies"].items() }
+
+    def converter_outputs(files):
+        return { policies.get(v, v): fname for v, fname in files.items() }
+
+    if job["cache_dir"] is None:
+        targets = { v: dir_out / output_name(name, v) for v in variants }
+        load_converter(job["kind"]).convert(inp, Path(job["dir_whisper"]), converter_outputs(targets), fma=job["fma"], align=job["align"])
+        return name, variants, [], time.time() - t_start
+
+    cache_dir = Path(job["cache_dir"])
+
+    digest_inp = hash_path(inp).hexdigest()
+    cached = {}
+    for v in variants:
+        # a policy is identified by its contents rather than its name
+        v_key = hash_path(job["policies"][v]).hexdigest() if v in policies else v
+        key = hashlib.sha256(f"{digest_inp}:{job['tool_digest']}:{v_key}:{job['fma']}:{job['align']}".encode("utf-8")).hexdigest()
+        cached[v] = cache_dir / key[:2] / f"{key}.bin"
+
+    missing = [v for v in variants if not cached[v].is_file()]
+    if missing:
+        # convert into temporary files next to the cache entries and move them in place only when complete
+        tmp = {}
+        for v in missing:
+            cached[v].parent.mkdir(parents=True, exist_ok=True)
+            tmp[v] = cached[v].with_suffix(f".tmp{os.getpid()}")
+        try:
+            load_converter(job["kind"]).convert(inp, Path(job["dir_whisper"]), converter_outputs(tmp), fma=job["fma"], align=job["align"])
+            for v in missing:
+                os.replace(tmp[v], cached[v])
+        finally:
+            for f in tmp.values():
+                if f.exists():
+                    f.unlink()
+
+    for v in variants:
+        materialize(cached[v], dir_out / output_name(name, v))
+
+    return name, missing, [v for v in variants if v not in missing], time.time() - t_start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert a set of Whisper checkpoints to ggml format")
+    parser.add_argument("manifest",    type=Path, help="JSON list of { \"name\", \"input\" [, \"variants\"] }")
+    parser.add_argument("dir_whisper", type=Path, help="path to the openai/whisper repo")
+    parser.add_argument("dir_out",     type=Path, help="output directory")
+    parser.add_argument("-j", "--jobs", type=int, default=max(1, (os.cpu_count() or 1)//2),
+                        help="number of worker processes (default: half of the cores)")
+    parser.add_argument("--max-memory", type=float, default=0.0,
+                        help="memory budget in GB for the conversions in flight, estimated from the checkpoint sizes (default: unlimited)")
+    parser.add_argument("--variants", type=str, default="f16",
+                        help=f"comma-separated default output variants (supported: {', '.join(VARIANTS)}, default: f16)")
+    parser.add_argument("--policy", action="append", default=[], metavar="NAME=FILE",
+                        help="additionally write a variant with a per-tensor precision policy, can be repeated")
+    parser.add_argument("--cache-dir", type=Path, default=Path.home() / ".cache" / "whisper.cpp" / "convert",
+                        help="content-addressed cache of converted models")
+    parser.add_argument("--no-cache", action="store_true", help="always convert and write directly to the output directory")
+    parser.add_argument("--fma", action="store_true",
+                        help="quantize like a ggml build with fused multiply-add contraction (CMake builds on FMA CPUs)")
+    parser.add_argument("--align", action="store_true",
+                        help="align the tensor data so that whisper.cpp can map the models (older builds cannot read them)")
+    args = parser.parse_args()
+
+    entries = json.load(args.manifest.open("r", encoding="utf8"))
+
+    args.dir_out.mkdir(parents=True, exist_ok=True)
+
+    digest_tool = None if args.no_cache else tool_digest(args.dir_whisper)
+
+    policies = {}
+    for arg in args.policy:
+        name, sep, fname = arg.partition("=")
+        if not sep or name in VARIANTS:
+            print(f"Error: invalid policy '{arg}', expected NAME=FILE with a name that is not a variant")
+            sys.exit(1)
+        try:
+            QuantPolicy.load(fname, name)
+        except (OSError, ValueError) as e:
+            print(f"Error: {e}")
+            sys.exit(1)
+        policies[name] = str(Path(fname).resolve())
+
+    jobs = []
+    for entry in entries:
+        inp = Path(entry["input"]).expanduser()
+        if not inp.exists():
+            print(f"Error: input {inp} for '{entry['name']}' not found")
+            sys.exit(1)
+
+        variants = entry.get("variants", args.variants.split(","))
+        for v in variants:
+            if v not in VARIANTS:
+                print(f"Error: unknown variant '{v}' for '{entry['name']}' (supported: {', '.join(VARIANTS)})")
+                sys.exit(1)
+        variants = variants + [p for p in policies if p not in variants]
+
+        jobs.append({
+            "name":        entry["name"],
+            "input":       str(inp),
+            "kind":        "h5" if inp.is_dir() else "pt",
+            "variants":    variants,
+            "policies":    policies,
+            "dir_whisper": str(args.dir_whisper),
+            "dir_out":     str(args.dir_out),
+            "cache_dir":   None if args.no_cache else str(args.cache_dir),
+            "tool_digest": digest_tool,
+            "fma":         args.fma,
+            "align":       args.align,
+            "size":        path_size(inp),
+        })
+
+    # start the largest checkpoints first so that the small ones fill the gaps at the end
+    jobs.sort(key=lambda job: job["size"], reverse=True)
+
+    budget = args.max_memory*1024*1024*1024
+    failed = 0
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs) as executor:
+        pending = {}
+        in_flight = 0
+
+        while jobs or pending:
+            # submit while the memory estimate allows - a job that alone exceeds the budget still runs, just alone
+            while jobs and len(pending) < args.jobs and \
+                    (budget <= 0 or not pending or in_flight + jobs[0]["size"] <= budget):
+                job = jobs.pop(0)
+                pending[executor.submit(convert_job, job)] = job
+                in_flight += job["size"]
+
+            done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                job = pending.pop(future)
+                in_flight -= job["size"]
+                try:
+                    name, converted, cached, t = future.result()
+                    print(f"{name}: converted [{', '.join(converted)}], up to date [{', '.join(cached)}] in {t:.1f} s")
+                except Exception as e:
+                    print(f"Error: failed to convert '{job['name']}': {e}")
+                    failed += 1
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -18,13 +18,14 @@
 import io
 import os
 import sys
-import struct
 import json
 import code
 import torch
 import numpy as np
 from pathlib import Path
 
+from ggml_format import VARIANTS, QuantPolicy, write_model_variants
+
 from transformers import WhisperForConditionalGeneration
 
 conv_map = {
@@ -72,137 +73,125 @@ def bytes_to_unicode():
     cs = [chr(n) for n in cs]
     return dict(zip(bs, cs))
 
-if len(sys.argv) < 4:
-    print("Usage: convert-h5-to-ggml.py dir_model path-to-whisper-repo dir-output [use-f32]\n")
-    sys.exit(1)
+def h5_hparams(config):
+    return {
+        "n_vocab":       config["vocab_size"],
+        "n_audio_ctx":   config["max_source_positions"],
+        "n_audio_state": config["d_model"],
+        "n_audio_head":  config["encoder_attention_heads"],
+        "n_audio_layer": config["encoder_layers"],
+        "n_text_ctx":    config["max_length"],
+        "n_text_state":  config["d_model"],
+        "n_text_head":   config["decoder_attention_heads"],
+        "n_text_layer":  config["decoder_layers"],
+        "n_mels":        config["num_mel_bins"],
+    }
 
-dir_model   = Path(sys.argv[1])
-dir_whisper = Path(sys.argv[2])
-dir_out     = Path(sys.argv[3])
 
-encoder = json.load((dir_model / "vocab.json").open("r", encoding="utf8"))
-encoder_added = json.load((dir_model / "added_tokens.json").open( "r", encoding="utf8"))
-hparams = json.load((dir_model / "config.json").open("r", encoding="utf8") )
+def load_filters(dir_whisper, n_mels):
+    with np.load(os.path.join(dir_whisper, "whisper/assets", "mel_filters.npz")) as f:
+        return f[f"mel_{n_mels}"].astype(np.float32)
 
-model = WhisperForConditionalGeneration.from_pretrained(dir_model)
 
-#code.interact(local=locals())
+def load_tokens(dir_tokenizer):
+    tokens = json.load(open(dir_tokenizer / "vocab.json", "r", encoding="utf8"))
 
-n_mels = hparams["num_mel_bins"]
-with np.load(os.path.join(dir_whisper, "whisper/assets", "mel_filters.npz")) as f:
-    filters = torch.from_numpy(f[f"mel_{n_mels}"])
+    byte_encoder = bytes_to_unicode()
+    byte_decoder = {v:k for k, v in byte_encoder.items()}
 
-dir_tokenizer = dir_model
+    tokens = sorted(tokens.items(), key=lambda x: x[1])
+    return [bytes([byte_decoder[c] for c in key[0]]) for key in tokens]
 
-fname_out = dir_out / "ggml-model.bin"
 
-tokens = json.load(open(dir_tokenizer / "vocab.json", "r", encoding="utf8"))
+def h5_tensors(list_vars):
+    for name in list_vars.keys():
+        # this seems to not be used
+        # ref: https://github.com/huggingface/transformers/blob/9a5b84a0076a04fe9596da72e8668069d4f09ea0/src/transformers/models/whisper/modeling_whisper.py#L1099-L1106
+        if name == "proj_out.weight":
+            print('Skipping', name)
+            continue
 
-# use 16-bit or 32-bit floats
-use_f16 = True
-if len(sys.argv) > 4:
-    use_f16 = False
-    fname_out = dir_out / "ggml-model-f32.bin"
+        src = name
 
-fout = open(fname_out, "wb")
+        nn = name
+        if name != "proj_out.weight":
+            nn = nn.split(".")[1:]
+        else:
+            nn = nn.split(".")
+
+        if nn[1] == "layers":
+            nn[1] = "blocks"
+            if ".".join(nn[3:-1]) == "encoder_attn.k_proj":
+                mapped = "attn.key" if nn[0] == "encoder" else "cross_attn.key"
+            else:
+                mapped = conv_map[".".join(nn[3:-1])]
+            name = ".".join(nn[:3] + [mapped] + nn[-1:])
+        else:
+            name = ".".join(nn)
+            name = conv_map[name] if name in conv_map else name
 
-fout.write(struct.pack("i", 0x67676d6c)) # magic: ggml in hex
-fout.write(struct.pack("i", hparams["vocab_size"]))
-fout.write(struct.pack("i", hparams["max_source_positions"]))
-fout.write(struct.pack("i", hparams["d_model"]))
-fout.write(struct.pack("i", hparams["encoder_attention_heads"]))
-fout.write(struct.pack("i", hparams["encoder_layers"]))
-fout.write(struct.pack("i", hparams["max_length"]))
-fout.write(struct.pack("i", hparams["d_model"]))
-fout.write(struct.pack("i", hparams["decoder_attention_heads"]))
-fout.write(struct.pack("i", hparams["decoder_layers"]))
-fout.write(struct.pack("i", hparams["num_mel_bins"]))
-fout.write(struct.pack("i", use_f16))
+        print(src, ' -> ', name)
+        data = list_vars[src].squeeze().numpy()
+        data = data.astype(np.float16)
 
-fout.write(struct.pack("i", filters.shape[0]))
-fout.write(struct.pack("i", filters.shape[1]))
-for i in range(filters.shape[0]):
-    for j in range(filters.shape[1]):
-        fout.write(struct.pack("f", filters[i][j]))
+        # reshape conv bias from [n] to [n, 1]
+        if name in ["encoder.conv1.bias", "encoder.conv2.bias"]:
+            data = data.reshape(data.shape[0], 1)
+            print("  Reshaped variable: " , name , " to shape: ", data.shape)
 
-byte_encoder = bytes_to_unicode()
-byte_decoder = {v:k for k, v in byte_encoder.items()}
+        print(name, data.ndim, data.shape)
 
-fout.write(struct.pack("i", len(tokens)))
+        yield name, data
 
-tokens = sorted(tokens.items(), key=lambda x: x[1])
-for key in tokens:
-    text = bytearray([byte_decoder[c] for c in key[0]])
-    fout.write(struct.pack("i", len(text)))
-    fout.write(text)
 
-list_vars = model.state_dict()
-for name in list_vars.keys():
-    # this seems to not be used
-    # ref: https://github.com/huggingface/transformers/blob/9a5b84a0076a04fe9596da72e8668069d4f09ea0/src/transformers/models/whisper/modeling_whisper.py#L1099-L1106
-    if name == "proj_out.weight":
-        print('Skipping', name)
-        continue
+def convert(dir_model, dir_whisper, outputs, fma=False, align=False):
+    """
+    Convert a Hugging Face model, writing one output file per variant in a single pass over the tensors.
+    outputs: dict variant -> output file name, see ggml_format.write_model_variants
+    fma:     see ggml_quants.quantize
+    align:   see ggml_format.write_model_variants
+    """
+    config = json.load((dir_model / "config.json").open("r", encoding="utf8"))
 
-    src = name
+    model = WhisperForConditionalGeneration.from_pretrained(dir_model)
 
-    nn = name
-    if name != "proj_out.weight":
-        nn = nn.split(".")[1:]
-    else:
-        nn = nn.split(".")
+    hparams = h5_hparams(config)
+    filters = load_filters(dir_whisper, hparams["n_mels"])
+    tokens  = load_tokens(dir_model)
 
-    if nn[1] == "layers":
-        nn[1] = "blocks"
-        if ".".join(nn[3:-1]) == "encoder_attn.k_proj":
-            mapped = "attn.key" if nn[0] == "encoder" else "cross_attn.key"
-        else:
-            mapped = conv_map[".".join(nn[3:-1])]
-        name = ".".join(nn[:3] + [mapped] + nn[-1:])
-    else:
-        name = ".".join(nn)
-        name = conv_map[name] if name in conv_map else name
-
-    print(src, ' -> ', name)
-    data = list_vars[src].squeeze().numpy()
-    data = data.astype(np.float16)
-
-    # reshape conv bias from [n] to [n, 1]
-    if name in ["encoder.conv1.bias", "encoder.conv2.bias"]:
-        data = data.reshape(data.shape[0], 1)
-        print("  Reshaped variable: " , name , " to shape: ", data.shape)
-
-    n_dims = len(data.shape)
-    print(name, n_dims, data.shape)
-
-    # looks like the whisper models are in f16 by default
-    # so we need to convert the small tensors to f32 until we fully support f16 in ggml
-    # ftype == 0 -> float32, ftype == 1 -> float16
-    ftype = 1
-    if use_f16:
-        if n_dims < 2 or \
-                name == "encoder.conv1.bias"   or \
-                name == "encoder.conv2.bias"   or \
-                name == "encoder.positional_embedding" or \
-                name == "decoder.positional_embedding":
-            print("  Converting to float32")
-            data = data.astype(np.float32)
-            ftype = 0
-    else:
-        data = data.astype(np.float32)
-        ftype = 0
+    write_model_variants(outputs, hparams, filters, tokens, h5_tensors(model.state_dict()), fma=fma, align=align)
+
+
+if __name__ == "__main__":
+    # --fma: quantize like a ggml build with fused multiply-add contraction, see ggml_quants
+    # --align: pad the tensor data for mmap, older whisper.cpp builds cannot read such files
+    fma   = "--fma"   in sys.argv[4:]
+    align = "--align" in sys.argv[4:]
+    argv  = sys.argv[:4] + [arg for arg in sys.argv[4:] if arg not in ("--fma", "--align")]
 
-    # header
-    str_ = name.encode('utf-8')
-    fout.write(struct.pack("iii", n_dims, len(str_), ftype))
-    for i in range(n_dims):
-        fout.write(struct.pack("i", data.shape[n_dims - 1 - i]))
-    fout.write(str_)
+    if len(argv) < 4:
+        print("Usage: convert-h5-to-ggml.py dir_model path-to-whisper-repo dir-output [use-f32 | q4_0 | q4_1 | q5_0 | q5_1 | q8_0 | --policy policy.txt] [--fma] [--align]\n")
+        sys.exit(1)
 
-    # data
-    data.tofile(fout)
+    dir_model   = Path(argv[1])
+    dir_whisper = Path(argv[2])
+    dir_out     = Path(argv[3])
+
+    # use 16-bit or 32-bit floats, or quantize directly to one of the ggml block formats
+    # or pick the type of each tensor with a per-tensor precision policy, see ggml_format.QuantPolicy
+    variant = "f16"
+    if len(argv) > 5 and argv[4] == "--policy":
+        variant = QuantPolicy.load(argv[5])
+    elif len(argv) > 4:
+        variant = argv[4] if argv[4] in VARIANTS else "f32"
+
+    if isinstance(variant, QuantPolicy):
+        outputs = { variant: dir_out / f"ggml-model-{variant.name}.bin" }
+    else:
+        outputs = { variant: dir_out / ("ggml-model.bin" if variant == "f16" else f"ggml-model-{variant}.bin") }
 
-fout.close()
+    convert(dir_model, dir_whisper, outputs, fma=fma, align=align)
 
-print("Done. Output file: " , fname_out)
-print("")
+    for fname_out in outputs.values():
+        print("Done. Output file: " , fname_out)
+    print("")
@@ -31,16 +31,16 @@
 #  - Data (float[n_dims])
 #
 
-import io
 import os
 import sys
-import struct
 import json
 import code
 import torch
 import numpy as np
 import base64
 from pathlib import Path
+
+from ggml_format import VARIANTS, QuantPolicy, write_model_variants
 #from transformers import GPTJForCausalLM
 #from transformers import GPT2TokenizerFast
 
@@ -190,153 +190,120 @@ def bytes_to_unicode():
     return dict(zip(bs, cs))
 
 
-if len(sys.argv) < 4:
-    print("Usage: convert-pt-to-ggml.py model.pt path-to-whisper-repo dir-output [use-f32]\n")
-    sys.exit(1)
-
-fname_inp   = Path(sys.argv[1])
-dir_whisper = Path(sys.argv[2])
-dir_out     = Path(sys.argv[3])
-
-# try to load PyTorch binary data
-try:
-    model_bytes = open(fname_inp, "rb").read()
-    with io.BytesIO(model_bytes) as fp:
-        checkpoint = torch.load(fp, map_location="cpu")
-except Exception:
-    print("Error: failed to load PyTorch model file:" , fname_inp)
-    sys.exit(1)
-
-hparams = checkpoint["dims"]
-print("hparams:", hparams)
-
-list_vars = checkpoint["model_state_dict"]
+def load_checkpoint(fname_inp):
+    # memory-map the checkpoint when supported (torch >= 2.1, zipfile format) so that tensor data stays in the page
+    # cache instead of being copied into RAM - older torch versions and legacy checkpoints fall back to a regular load
+    try:
+        return torch.load(fname_inp, map_location="cpu", mmap=True)
+    except (TypeError, RuntimeError):
+        return torch.load(fname_inp, map_location="cpu")
 
-#print(list_vars['encoder.positional_embedding'])
-#print(list_vars['encoder.conv1.weight'])
-#print(list_vars['encoder.conv1.weight'].shape)
 
-# load mel filters
-n_mels = hparams["n_mels"]
-with np.load(dir_whisper / "whisper" / "assets" / "mel_filters.npz") as f:
-    filters = torch.from_numpy(f[f"mel_{n_mels}"])
-    #print (filters)
+def load_filters(dir_whisper, n_mels):
+    with np.load(dir_whisper / "whisper" / "assets" / "mel_filters.npz") as f:
+        return f[f"mel_{n_mels}"].astype(np.float32)
 
-#code.interact(local=locals())
 
-# load tokenizer
-# for backwards compatibility, also check for older hf_transformers format tokenizer files
-# old format: dir_whisper/whisper/assets/[multilingual/gpt2]/vocab.json
-# new format: dir_whisper/whisper/assets/[multilingual/gpt2].tiktoken
-multilingual = hparams["n_vocab"] >= 51865
-tokenizer = dir_whisper / "whisper" / "assets" / (multilingual and "multilingual.tiktoken" or "gpt2.tiktoken")
-tokenizer_type = "tiktoken"
-if not tokenizer.is_file():
-    tokenizer = dir_whisper / "whisper" / "assets" / (multilingual and "multilingual" or "gpt2") / "vocab.json"
-    tokenizer_type = "hf_transformers"
+def load_tokens(dir_whisper, n_vocab):
+    # for backwards compatibility, also check for older hf_transformers format tokenizer files
+    # old format: dir_whisper/whisper/assets/[multilingual/gpt2]/vocab.json
+    # new format: dir_whisper/whisper/assets/[multilingual/gpt2].tiktoken
+    multilingual = n_vocab >= 51865
+    tokenizer = dir_whisper / "whisper" / "assets" / (multilingual and "multilingual.tiktoken" or "gpt2.tiktoken")
+    tokenizer_type = "tiktoken"
     if not tokenizer.is_file():
-        print("Error: failed to find either tiktoken or hf_transformers tokenizer file:", tokenizer)
-        sys.exit(1)
-
-byte_encoder = bytes_to_unicode()
-byte_decoder = {v:k for k, v in byte_encoder.items()}
-
-if tokenizer_type == "tiktoken":
-    with open(tokenizer, "rb") as f:
-        contents = f.read()
-        tokens = {base64.b64decode(token): int(rank) for token, rank in (line.split() for line in contents.splitlines() if line)}
-elif tokenizer_type == "hf_transformers":
-    with open(tokenizer, "r", encoding="utf8") as f:
-        _tokens_raw = json.load(f)
-        if '<|endoftext|>' in _tokens_raw:
-            # ensures exact same model as tokenizer_type == tiktoken
-            # details: https://github.com/ggerganov/whisper.cpp/pull/725
-            del _tokens_raw['<|endoftext|>']
-        tokens = {bytes([byte_decoder[c] for c in token]): int(idx) for token, idx in _tokens_raw.items()}
-
-# output in the same directory as the model
-fname_out = dir_out / "ggml-model.bin"
-
-# use 16-bit or 32-bit floats
-use_f16 = True
-if len(sys.argv) > 4:
-    use_f16 = False
-    fname_out = dir_out / "ggml-model-f32.bin"
-
-fout = fname_out.open("wb")
-
-fout.write(struct.pack("i", 0x67676d6c)) # magic: ggml in hex
-fout.write(struct.pack("i", hparams["n_vocab"]))
-fout.write(struct.pack("i", hparams["n_audio_ctx"]))
-fout.write(struct.pack("i", hparams["n_audio_state"]))
-fout.write(struct.pack("i", hparams["n_audio_head"]))
-fout.write(struct.pack("i", hparams["n_audio_layer"]))
-fout.write(struct.pack("i", hparams["n_text_ctx"]))
-fout.write(struct.pack("i", hparams["n_text_state"]))
-fout.write(struct.pack("i", hparams["n_text_head"]))
-fout.write(struct.pack("i", hparams["n_text_layer"]))
-fout.write(struct.pack("i", hparams["n_mels"]))
-fout.write(struct.pack("i", use_f16))
+        tokenizer = dir_whisper / "whisper" / "assets" / (multilingual and "multilingual" or "gpt2") / "vocab.json"
+        tokenizer_type = "hf_transformers"
+        if not tokenizer.is_file():
+            raise FileNotFoundError(f"failed to find either tiktoken or hf_transformers tokenizer file: {tokenizer}")
+
+    byte_encoder = bytes_to_unicode()
+    byte_decoder = {v:k for k, v in byte_encoder.items()}
+
+    if tokenizer_type == "tiktoken":
+        with open(tokenizer, "rb") as f:
+            contents = f.read()
+            tokens = {base64.b64decode(token): int(rank) for token, rank in (line.split() for line in contents.splitlines() if line)}
+    elif tokenizer_type == "hf_transformers":
+        with open(tokenizer, "r", encoding="utf8") as f:
+            _tokens_raw = json.load(f)
+            if '<|endoftext|>' in _tokens_raw:
+                # ensures exact same model as tokenizer_type == tiktoken
+                # details: https://github.com/ggerganov/whisper.cpp/pull/725
+                del _tokens_raw['<|endoftext|>']
+            tokens = {bytes([byte_decoder[c] for c in token]): int(idx) for token, idx in _tokens_raw.items()}
+
+    return list(tokens.keys())
+
+
+# stream the tensors out one at a time - each entry is removed from the state dict once consumed so that at most one
+# converted tensor is alive at any point
+def pt_tensors(list_vars):
+    for name in list(list_vars.keys()):
+        data = list_vars.pop(name).squeeze().numpy()
+        print("Processing variable: " , name ,  " with shape: ", data.shape)
+
+        # reshape conv bias from [n] to [n, 1]
+        if name in ["encoder.conv1.bias", "encoder.conv2.bias"]:
+            data = data.reshape(data.shape[0], 1)
+            print(f"  Reshaped variable: {name} to shape: ", data.shape)
+
+        yield name, data
+
+
+def convert(fname_inp, dir_whisper, outputs, fma=False, align=False):
+    """
+    Convert a checkpoint, writing one output file per variant in a single pass over the tensors.
+    outputs: dict variant -> output file name, see ggml_format.write_model_variants
+    fma:     see ggml_quants.quantize
+    align:   see ggml_format.write_model_variants
+    """
+    checkpoint = load_checkpoint(fname_inp)
 
-# write mel filters
-fout.write(struct.pack("i", filters.shape[0]))
-fout.write(struct.pack("i", filters.shape[1]))
-for i in range(filters.shape[0]):
-    for j in range(filters.shape[1]):
-        fout.write(struct.pack("f", filters[i][j]))
+    hparams = checkpoint["dims"]
+    print("hparams:", hparams)
 
-# write tokenizer
-fout.write(struct.pack("i", len(tokens)))
+    filters = load_filters(dir_whisper, hparams["n_mels"])
+    tokens  = load_tokens(dir_whisper, hparams["n_vocab"])
 
-for key in tokens:
-    fout.write(struct.pack("i", len(key)))
-    fout.write(key)
+    write_model_variants(outputs, hparams, filters, tokens, pt_tensors(checkpoint["model_state_dict"]), fma=fma, align=align)
 
-for name in list_vars.keys():
-    data = list_vars[name].squeeze().numpy()
-    print("Processing variable: " , name ,  " with shape: ", data.shape)
 
-    # reshape conv bias from [n] to [n, 1]
-    if name in ["encoder.conv1.bias", "encoder.conv2.bias"]:
-        data = data.reshape(data.shape[0], 1)
-        print(f"  Reshaped variable: {name} to shape: ", data.shape)
+if __name__ == "__main__":
+    # --fma: quantize like a ggml build with fused multiply-add contraction, see ggml_quants
+    # --align: pad the tensor data for mmap, older whisper.cpp builds cannot read such files
+    fma   = "--fma"   in sys.argv[4:]
+    align = "--align" in sys.argv[4:]
+    argv  = sys.argv[:4] + [arg for arg in sys.argv[4:] if arg not in ("--fma", "--align")]
 
-    n_dims = len(data.shape)
+    if len(argv) < 4:
+        print("Usage: convert-pt-to-ggml.py model.pt path-to-whisper-repo dir-output [use-f32 | q4_0 | q4_1 | q5_0 | q5_1 | q8_0 | --policy policy.txt] [--fma] [--align]\n")
+        sys.exit(1)
 
-    # looks like the whisper models are in f16 by default
-    # so we need to convert the small tensors to f32 until we fully support f16 in ggml
-    # ftype == 0 -> float32, ftype == 1 -> float16
-    ftype = 1
-    if use_f16:
-        if n_dims < 2 or \
-                name == "encoder.conv1.bias"   or \
-                name == "encoder.conv2.bias"   or \
-                name == "encoder.positional_embedding" or \
-                name == "decoder.positional_embedding":
-            print("  Converting to float32")
-            data = data.astype(np.float32)
-            ftype = 0
+    fname_inp   = Path(argv[1])
+    dir_whisper = Path(argv[2])
+    dir_out     = Path(argv[3])
+
+    # output in the same directory as the model
+    # use 16-bit or 32-bit floats, or quantize directly to one of the ggml block formats
+    # or pick the type of each tensor with a per-tensor precision policy, see ggml_format.QuantPolicy
+    variant = "f16"
+    if len(argv) > 5 and argv[4] == "--policy":
+        variant = QuantPolicy.load(argv[5])
+    elif len(argv) > 4:
+        variant = argv[4] if argv[4] in VARIANTS else "f32"
+
+    if isinstance(variant, QuantPolicy):
+        outputs = { variant: dir_out / f"ggml-model-{variant.name}.bin" }
     else:
-        data = data.astype(np.float32)
-        ftype = 0
+        outputs = { variant: dir_out / ("ggml-model.bin" if variant == "f16" else f"ggml-model-{variant}.bin") }
 
-    #if name.startswith("encoder"):
-    #    if name.endswith("mlp.0.weight") or \
-    #       name.endswith("mlp.2.weight"):
-    #        print("  Transposing")
-    #        data = data.transpose()
-
-    # header
-    str_ = name.encode('utf-8')
-    fout.write(struct.pack("iii", n_dims, len(str_), ftype))
-    for i in range(n_dims):
-        fout.write(struct.pack("i", data.shape[n_dims - 1 - i]))
-    fout.write(str_)
-
-    # data
-    data.tofile(fout)
-
-fout.close()
+    try:
+        convert(fname_inp, dir_whisper, outputs, fma=fma, align=align)
+    except FileNotFoundError as e:
+        print("Error:", e)
+        sys.exit(1)
 
-print("Done. Output file: " , fname_out)
-print("")
+    for fname_out in outputs.values():
+        print("Done. Output file: " , fname_out)
+    print("")
@@ -0,0 +1,499 @@
+# Reader and writer for the whisper.cpp ggml model format
+#
+# Shared by the conversion scripts in this folder. The file layout is:
+#
+#  - hparams      (int32[12]: magic, n_vocab, n_audio_ctx, n_audio_state, n_audio_head, n_audio_layer,
+#                             n_text_ctx, n_text_state, n_text_head, n_text_layer, n_mels, ftype)
+#  - mel filters  (int32 n_mel, int32 n_fft, float32[n_mel*n_fft])
+#  - vocab        (int32 n_vocab, then for each token: int32 len, char[len])
+#  - tensors      until EOF, for each tensor:
+#
+#    - Number of dimensions (int)
+#    - Name length (int)
+#    - Type (int, ggml_type - 0 = f32, 1 = f16, ...)
+#    - Dimensions (int[n_dims], innermost first)
+#    - Name (char[name_length])
+#    - Data
+#
+#    With align=True, the writer pads the name with '\0' so that the data starts at a multiple of GGML_TENSOR_ALIGNMENT
+#    bytes, which lets whisper.cpp map the file and use the tensor data in place. Older whisper.cpp builds do not strip
+#    the padding and reject such files, so it is opt-in. The readers here strip the padding.
+#
+
+import mmap
+import os
+import re
+import struct
+import sys
+from collections import OrderedDict, namedtuple
+
+import numpy as np
+
+import ggml_quants
+
+GGML_FILE_MAGIC = 0x67676d6c # "ggml" in hex
+
+# offset alignment of the tensor data, see WHISPER_TENSOR_ALIGNMENT in whisper.cpp
+GGML_TENSOR_ALIGNMENT = 32
+
+HPARAMS_KEYS = [
+    "n_vocab",
+    "n_audio_ctx",
+    "n_audio_state",
+    "n_audio_head",
+    "n_audio_layer",
+    "n_text_ctx",
+    "n_text_state",
+    "n_text_head",
+    "n_text_layer",
+    "n_mels",
+]
+
+# ggml_type -> numpy dtype for the non-quantized tensor types
+GGML_TYPE_F32 = 0
+GGML_TYPE_F16 = 1
+
+GGML_DTYPES = {
+    GGML_TYPE_F32: np.dtype(np.float32),
+    GGML_TYPE_F16: np.dtype(np.float16),
+}
+
+# ggml_type -> (name, block size, bytes per block), see ggml.c type_traits
+GGML_TYPES = {
+    0:  ("f32",  1,   4),
+    1:  ("f16",  1,   2),
+    2:  ("q4_0", 32,  18),
+    3:  ("q4_1", 32,  20),
+    6:  ("q5_0", 32,  22),
+    7:  ("q5_1", 32,  24),
+    8:  ("q8_0", 32,  34),
+    9:  ("q8_1", 32,  36),
+    10: ("q2_K", 256, 84),
+    11: ("q3_K", 256, 110),
+    12: ("q4_K", 256, 144),
+    13: ("q5_K", 256, 176),
+    14: ("q6_K", 256, 210),
+    15: ("q8_K", 256, 292),
+}
+
+
+def tensor_nbytes(shape, ftype):
+    """size in bytes of the data of a tensor with the given (numpy order) shape and ggml_type"""
+    if ftype not in GGML_TYPES:
+        raise ValueError(f"unsupported tensor type {ftype}")
+    _, blck_size, type_size = GGML_TYPES[ftype]
+    n = int(np.prod(shape, dtype=np.int64))
+    return n//blck_size*type_size
+
+
+_hparams_struct = struct.Struct("<12i")
+_i32_struct     = struct.Struct("<i")
+_i32x2_struct   = struct.Struct("<2i")
+_tensor_struct  = struct.Struct("<3i")
+_dims_structs   = [struct.Struct(f"<{n}i") for n in range(5)]
+
+DEFAULT_BUFFER_SIZE = 16*1024*1024
+
+
+def tensor_ftype(name, n_dims, use_f16):
+    """
+    The type a tensor is stored with. Whisper checkpoints are in f16, but ggml needs the small tensors, the conv biases
+    and the positional embeddings in f32.
+    """
+    if not use_f16:
+        return GGML_TYPE_F32
+    if n_dims < 2 or \
+            name == "encoder.conv1.bias"   or \
+            name == "encoder.conv2.bias"   or \
+            name == "encoder.positional_embedding" or \
+            name == "decoder.positional_embedding":
+        return GGML_TYPE_F32
+    return GGML_TYPE_F16
+
+
+# the model ftype of quantized models carries the quantization version, see GGML_QNT_VERSION in ggml.h
+GGML_QNT_VERSION        = 2
+GGML_QNT_VERSION_FACTOR = 1000
+
+# output variants of the converters: variant -> (model ftype, ggml_type of the quantized tensors)
+# the model ftype is a ggml_ftype, see ggml.h
+VARIANTS = {
+    "f32":  (0, GGML_TYPE_F32),
+    "f16":  (1, GGML_TYPE_F16),
+    "q4_0": (GGML_QNT_VERSION*GGML_QNT_VERSION_FACTOR + 2, ggml_quants.GGML_TYPE_Q4_0),
+    "q4_1": (GGML_QNT_VERSION*GGML_QNT_VERSION_FACTOR + 3, ggml_quants.GGML_TYPE_Q4_1),
+    "q5_0": (GGML_QNT_VERSION*GGML_QNT_VERSION_FACTOR + 8, ggml_quants.GGML_TYPE_Q5_0),
+    "q5_1": (GGML_QNT_VERSION*GGML_QNT_VERSION_FACTOR + 9, ggml_quants.GGML_TYPE_Q5_1),
+    "q8_0": (GGML_QNT_VERSION*GGML_QNT_VERSION_FACTOR + 7, ggml_quants.GGML_TYPE_Q8_0),
+}
+
+# tensors that are never quantized - same as in examples/quantize/quantize.cpp
+QUANTIZE_SKIP = [
+    "encoder.conv1.bias",
+    "encoder.conv2.bias",
+    "encoder.positional_embedding",
+    "decoder.positional_embedding",
+]
+
+
+def variant_tensor_type(variant, name, n_dims):
+    """
+    The ggml_type a tensor is stored with in the given output variant. Quantized variants quantize the 2D tensors
+    and keep the rest as in the f16 model, same as the quantize tool.
+    """
+    _, qtype = VARIANTS[variant]
+    if ggml_quants.is_quantized(qtype) and n_dims == 2 and name not in QUANTIZE_SKIP:
+        return qtype
+    return tensor_ftype(name, n_dims, qtype != GGML_TYPE_F32)
+
+
+class QuantPolicy:
+    """
+    Per-tensor precision policy - the same text format as `quantize --policy`, one rule per line:
+
+        <regex> <type>
+
+    The first rule whose regex matches the full tensor name decides the ggml_type of the tensor, tensors that no rule
+    matches are stored as in the f16 model. The 1D tensors and QUANTIZE_SKIP are never converted, and the quantization
+    types only apply to 2D tensors with a row size that is a multiple of the block size. The model ftype is the type
+    of a final catch-all ".*" rule, if there is one, otherwise f16.
+    """
+
+    def __init__(self, rules, name="policy"):
+        """rules: list of (regex, type name)"""
+        types = { type_name.lower(): ttype for ttype, (type_name, _, _) in GGML_TYPES.items() }
+
+        self.name  = name
+        self.rules = []
+        for pattern, type_name in rules:
+            if type_name.lower() not in types:
+                raise ValueError(f"unknown type '{type_name}' in policy '{name}'")
+            ttype = types[type_name.lower()]
+            if ttype not in GGML_DTYPES and not ggml_quants.is_quantized(ttype):
+                raise ValueError(f"type '{type_name}' in policy '{name}' is not supported by the converters - "
+                                 f"convert to f16 and use `quantize --policy` instead")
+            self.rules.append((pattern, re.compile(pattern), ttype))
+
+        self.ftype = 1
+        if self.rules and self.rules[-1][0] == ".*":
+            ttype = self.rules[-1][2]
+            self.ftype = next((ftype for ftype, qtype in VARIANTS.values() if qtype == ttype), self.ftype)
+
+    @classmethod
+    def load(cls, fname, name=None):
+        rules = []
+        with open(fname, "r", encoding="utf8") as f:
+            for n_line, line in enumerate(f, 1):
+                fields = line.split("#", 1)[0].split() if not line.lstrip().startswith("#") else []
+                if not fields:
+                    continue
+                if len(fields) != 2:
+                    raise ValueError(f"{fname}:{n_line}: expected '<regex> <type>'")
+                rules.append((fields[0], fields[1]))
+        return cls(rules, name or os.path.splitext(os.path.basename(fname))[0])
+
+    def tensor_type(self, name, shape):
+        if len(shape) < 2 or name in QUANTIZE_SKIP:
+            return tensor_ftype(name, len(shape), True)
+        for _, regex, ttype in self.rules:
+            if regex.fullmatch(name):
+                if ggml_quants.is_quantized(ttype) and (len(shape) != 2 or shape[-1] % ggml_quants.QK != 0):
+                    break
+                return ttype
+        return tensor_ftype(name, len(shape), True)
+
+
+class GgmlWriter:
+    """
+    Sequential writer for ggml model files. Everything goes through a large buffered sink and array data is written
+    from a memoryview, so the cost is dominated by I/O rather than per-element packing.
+    """
+
+    def __init__(self, fname, buffer_size=DEFAULT_BUFFER_SIZE, align=False):
+        self.fname = fname
+        self.fout  = open(fname, "wb", buffering=buffer_size)
+        self.pos   = 0
+        self.align = align
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if not self.fout.closed:
+            self.fout.close()
+
+    def write(self, buf):
+        self.pos += self.fout.write(buf)
+
+    def write_array(self, data):
+        self.write(memoryview(np.ascontiguousarray(data)).cast("B"))
+
+    def write_hparams(self, hparams, ftype):
+        self.write(_hparams_struct.pack(GGML_FILE_MAGIC, *[hparams[key] for key in HPARAMS_KEYS], ftype))
+
+    def write_filters(self, filters):
+        filters = np.asarray(filters, dtype=np.float32)
+        self.write(_i32x2_struct.pack(filters.shape[0], filters.shape[1]))
+        self.write_array(filters)
+
+    def write_vocab(self, tokens):
+        """tokens: a list of byte strings, in token id order"""
+        buf = bytearray(_i32_struct.pack(len(tokens)))
+        for token in tokens:
+            buf += _i32_struct.pack(len(token))
+            buf += token
+        self.write(buf)
+
+    def write_tensor(self, name, data, ftype, shape=None):
+        """
+        data must already have the dtype that corresponds to ftype. For quantized types, data is the raw block data
+        and shape the shape of the tensor. With align, the name is padded so that the data is aligned.
+        """
+        shape  = data.shape if shape is None else shape
+        name_  = name.encode("utf-8")
+        n_dims = len(shape)
+        if self.align:
+            pos    = self.pos + _tensor_struct.size + _dims_structs[n_dims].size + len(name_)
+            name_ += b"\0"*(-pos % GGML_TENSOR_ALIGNMENT)
+        self.write(_tensor_struct.pack(n_dims, len(name_), ftype))
+        self.write(_dims_structs[n_dims].pack(*shape[::-1]))
+        self.write(name_)
+        self.write_array(data)
+
+    def write_tensors(self, tensors):
+        """tensors: any iterable of (name, data, ftype) - consumed lazily, one tensor at a time"""
+        for name, data, ftype in tensors:
+            self.write_tensor(name, data, ftype)
+
+
+def write_model_variants(outputs, hparams, filters, tokens, tensors, fma=False, align=False):
+    """
+    Write several variants of the same model in a single pass over the source tensors.
+
+    outputs: dict variant -> output file name, the variant is either a name in VARIANTS or a QuantPolicy
+    tensors: iterable of (name, data) in the source precision, consumed one tensor at a time
+    fma:     see ggml_quants.quantize
+    align:   pad the tensor names so that the data can be mapped, see GgmlWriter.write_tensor
+    """
+    writers = {}
+    try:
+        for variant, fname in outputs.items():
+            if not isinstance(variant, QuantPolicy) and variant not in VARIANTS:
+                raise ValueError(f"unknown output variant '{variant}' (supported: {', '.join(VARIANTS)})")
+            writers[variant] = GgmlWriter(fname, align=align)
+            writers[variant].write_hparams(hparams, variant.ftype if isinstance(variant, QuantPolicy) else VARIANTS[variant][0])
+            writers[variant].write_filters(filters)
+            writers[variant].write_vocab(tokens)
+
+        for name, data in tensors:
+            for variant, writer in writers.items():
+                if isinstance(variant, QuantPolicy):
+                    ftype = variant.tensor_type(name, data.shape)
+                else:
+                    ftype = variant_tensor_type(variant, name, data.ndim)
+                if ggml_quants.is_quantized(ftype):
+                    writer.write_tensor(name, ggml_quants.quantize(data, ftype, fma=fma), ftype, shape=data.shape)
+                else:
+                    writer.write_tensor(name, data.astype(GGML_DTYPES[ftype], copy=False), ftype)
+    finally:
+        for writer in writers.values():
+            writer.close()
+
+
+class GgmlReader:
+    """
+    Sequential reader for ggml model files - the counterpart of GgmlWriter.
+    """
+
+    def __init__(self, fname, buffer_size=DEFAULT_BUFFER_SIZE):
+        self.fname = fname
+        self.fin   = open(fname, "rb", buffering=buffer_size)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if not self.fin.closed:
+            self.fin.close()
+
+    def _unpack(self, s):
+        buf = self.fin.read(s.size)
+        if len(buf) != s.size:
+            raise EOFError(f"unexpected end of file in {self.fname}")
+        return s.unpack(buf)
+
+    def read_array(self, dtype, shape):
+        dtype = np.dtype(dtype)
+        count = int(np.prod(shape))
+        buf   = self.fin.read(count*dtype.itemsize)
+        if len(buf) != count*dtype.itemsize:
+            raise EOFError(f"unexpected end of file in {self.fname}")
+        return np.frombuffer(buf, dtype=dtype).reshape(shape)
+
+    def read_hparams(self):
+        """returns (hparams, ftype)"""
+        magic, *values, ftype = self._unpack(_hparams_struct)
+        if magic != GGML_FILE_MAGIC:
+            raise ValueError(f"invalid model file {self.fname} (bad magic 0x{magic:08x})")
+        return dict(zip(HPARAMS_KEYS, values)), ftype
+
+    def read_filters(self):
+        n_mel, n_fft = self._unpack(_i32x2_struct)
+        return self.read_array(np.float32, (n_mel, n_fft))
+
+    def read_vocab(self):
+        n_vocab, = self._unpack(_i32_struct)
+        tokens = []
+        for _ in range(n_vocab):
+            n, = self._unpack(_i32_struct)
+            tokens.append(self.fin.read(n))
+        return tokens
+
+    def read_tensor(self):
+        """returns (name, data, ftype) or None at the end of the file"""
+        header = self.fin.read(_tensor_struct.size)
+        if len(header) == 0:
+            return None
+        if len(header) != _tensor_struct.size:
+            raise EOFError(f"unexpected end of file in {self.fname}")
+        n_dims, name_len, ftype = _tensor_struct.unpack(header)
+        dims = self._unpack(_dims_structs[n_dims])[::-1]
+        name = self.fin.read(name_len).decode("utf-8").rstrip("\0")
+        if ftype in GGML_DTYPES:
+            return name, self.read_array(GGML_DTYPES[ftype], dims), ftype
+        # quantized - raw blocks, one row per innermost dimension
+        data = self.read_array(np.uint8, (tensor_nbytes(dims, ftype),))
+        return name, data.reshape(*dims[:-1], -1), ftype
+
+    def read_tensors(self):
+        while True:
+            tensor = self.read_tensor()
+            if tensor is None:
+                return
+            yield tensor
+
+
+GgmlTensorInfo = namedtuple("GgmlTensorInfo", ["name", "shape", "ftype", "offset", "nbytes"])
+
+
+class GgmlModelFile:
+    """
+    Memory-mapped, lazily evaluated view of a ggml model file.
+
+    Opening the file does a single pass over the headers only - the tensor data is skipped and its offset recorded in
+    the `tensors` index. Tensor data is returned as zero-copy numpy views into the mapping, so only the pages that are
+    actually touched are read from disk. The mapping is copy-on-write: the views are writable, but changes never reach
+    the file. Release the views before close(), which raises BufferError while any of them is still alive.
+
+    Quantized tensors are returned as raw uint8 block data of shape (..., n_blocks*bytes_per_block).
+    """
+
+    def __init__(self, fname):
+        self.fname = fname
+        with open(fname, "rb") as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+
+        mm  = self.mm
+        pos = 0
+
+        magic, *values, self.ftype = _hparams_struct.unpack_from(mm, pos)
+        pos += _hparams_struct.size
+        if magic != GGML_FILE_MAGIC:
+            raise ValueError(f"invalid model file {fname} (bad magic 0x{magic:08x})")
+        self.hparams = dict(zip(HPARAMS_KEYS, values))
+
+        n_mel, n_fft = _i32x2_struct.unpack_from(mm, pos)
+        pos += _i32x2_struct.size
+        # a copy, so that the filters do not pin the mapping
+        self.filters = np.frombuffer(mm, dtype=np.float32, count=n_mel*n_fft, offset=pos).reshape(n_mel, n_fft).copy()
+        pos += self.filters.nbytes
+
+        n_vocab, = _i32_struct.unpack_from(mm, pos)
+        pos += _i32_struct.size
+        self.vocab = []
+        for _ in range(n_vocab):
+            n, = _i32_struct.unpack_from(mm, pos)
+            pos += _i32_struct.size
+            self.vocab.append(mm[pos:pos + n])
+            pos += n
+
+        self.tensors = OrderedDict()
+        while pos < len(mm):
+            n_dims, name_len, ftype = _tensor_struct.unpack_from(mm, pos)
+            pos += _tensor_struct.size
+            shape = _dims_structs[n_dims].unpack_from(mm, pos)[::-1]
+            pos += _dims_structs[n_dims].size
+            name = mm[pos:pos + name_len].decode("utf-8").rstrip("\0")
+            pos += name_len
+            nbytes = tensor_nbytes(shape, ftype)
+            if pos + nbytes > len(mm):
+                raise EOFError(f"tensor '{name}' is truncated in {fname}")
+            self.tensors[name] = GgmlTensorInfo(name, shape, ftype, pos, nbytes)
+            pos += nbytes
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.mm.close()
+
+    def __len__(self):
+        return len(self.tensors)
+
+    def __contains__(self, name):
+        return name in self.tensors
+
+    def __iter__(self):
+        return iter(self.tensors)
+
+    def keys(self):
+        return self.tensors.keys()
+
+    def __getitem__(self, name):
+        info = self.tensors[name]
+        if info.ftype in GGML_DTYPES:
+            dtype = GGML_DTYPES[info.ftype]
+            return np.frombuffer(self.mm, dtype=dtype, count=info.nbytes//dtype.itemsize, offset=info.offset).reshape(info.shape)
+        # quantized - raw blocks, one row per innermost dimension
+        data = np.frombuffer(self.mm, dtype=np.uint8, count=info.nbytes, offset=info.offset)
+        return data.reshape(*info.shape[:-1], -1)
+
+    def items(self):
+        for name in self.tensors:
+            yield name, self[name]
+
+    def torch_tensor(self, name):
+        """zero-copy torch.Tensor for a non-quantized tensor - it does not keep the mapping alive, use it before close()"""
+        import torch
+
+        info = self.tensors[name]
+        dtype = { GGML_TYPE_F32: torch.float32, GGML_TYPE_F16: torch.float16 }[info.ftype]
+        return torch.frombuffer(self.mm, dtype=dtype, count=info.nbytes//GGML_DTYPES[info.ftype].itemsize, offset=info.offset).reshape(info.shape)
+
+
+if __name__ == "__main__":
+    # print the tensor index of a model file
+    #
+    # Usage: python models/ggml_format.py models/ggml-base.en.bin
+    #
+    if len(sys.argv) < 2:
+        print("Usage: ggml_format.py model.bin\n")
+        sys.exit(1)
+
+    with GgmlModelFile(sys.argv[1]) as model:
+        print("hparams:", model.hparams, "ftype:", model.ftype)
+        print("filters:", model.filters.shape, "vocab:", len(model.vocab))
+        total = 0
+        for info in model.tensors.values():
+            print(f"{info.name:48s} {GGML_TYPES[info.ftype][0]:5s} {str(list(info.shape)):20s} {info.nbytes/1024/1024:9.3f} MB")
+            total += info.nbytes
+        print(f"{len(model)} tensors, {total/1024/1024:.3f} MB")
@@ -0,0 +1,154 @@
+# NumPy implementation of the ggml block quantization formats
+#
+# Mirrors the reference (scalar) quantize_row_*_reference functions in ggml-quants.c, so that the converters can
+# write quantized models directly. The results are bit-for-bit identical to the output of the quantize tool for the
+# q4_0, q4_1, q5_0, q5_1 and q8_0 formats - of a quantize tool built the way selected by fma, see below.
+#
+# All computations are done in float32 - the same as the C code - with the rounding steps replicated exactly. Note
+# that the C result depends on whether the compiler contracts `x*id + 0.5f` into a fused multiply-add: the Makefile
+# build (-std=c11) does not, while the CMake build (GNU C mode) does on CPUs with FMA. The two builds round some
+# blocks of q4_0, q4_1, q5_0 and q5_1 differently. The default fma=False matches the Makefile build, pass fma=True
+# (--fma for the converters) to match the latter - the fused operation is emulated in float64, which is exact up to
+# double rounding corner cases. The build of a given quantize binary cannot be detected from here.
+#
+
+import numpy as np
+
+GGML_TYPE_Q4_0 = 2
+GGML_TYPE_Q4_1 = 3
+GGML_TYPE_Q5_0 = 6
+GGML_TYPE_Q5_1 = 7
+GGML_TYPE_Q8_0 = 8
+
+QK = 32
+
+# number of blocks quantized at once - bounds the size of the temporaries
+CHUNK_BLOCKS = 64*1024
+
+_f32 = np.float32
+
+
+def _fp16_bytes(x):
+    """GGML_FP32_TO_FP16 (round to nearest even), as raw little-endian bytes"""
+    return x.astype("<f2").view(np.uint8).reshape(-1, 2)
+
+
+def _inv(d):
+    """d ? 1.0f/d : 0.0f"""
+    return np.divide(_f32(1.0), d, out=np.zeros_like(d), where=d != 0)
+
+
+def _absmax(x):
+    """the value with the largest magnitude in each block - first one wins on ties, +0.0 for all-zero blocks"""
+    v = np.take_along_axis(x, np.argmax(np.abs(x), axis=1)[:, None], axis=1)[:, 0]
+    return np.where(v == 0, _f32(0.0), v)
+
+
+def _minmax(x):
+    """per block min and max - first occurrence wins, as in the C loops"""
+    mn = np.take_along_axis(x, np.argmin(x, axis=1)[:, None], axis=1)[:, 0]
+    mx = np.take_along_axis(x, np.argmax(x, axis=1)[:, None], axis=1)[:, 0]
+    return mn, mx
+
+
+def _madd(a, b, c, fma):
+    """a*b + c in float32, optionally fused"""
+    if fma:
+        return (a.astype(np.float64)*b.astype(np.float64) + c).astype(np.float32)
+    return a*b + _f32(c)
+
+
+def _pack_nibbles(xi):
+    return (xi[:, :QK//2] & 0x0F) | ((xi[:, QK//2:] & 0x0F) << 4)
+
+
+def _pack_qh(xi):
+    """the 5-th bit of each quant, packed into a little-endian uint32 per block"""
+    bits = ((xi.astype(np.uint32) >> 4) & 1) << np.arange(QK, dtype=np.uint32)
+    return np.bitwise_or.reduce(bits, axis=1).astype("<u4").view(np.uint8).reshape(-1, 4)
+
+
+def quantize_q4_0(x, fma=False):
+    d  = _absmax(x) / _f32(-8)
+    id = _inv(d)
+
+    xi = np.minimum(15, _madd(x, id[:, None], 8.5, fma).astype(np.int8)).astype(np.uint8)
+
+    return np.concatenate([_fp16_bytes(d), _pack_nibbles(xi)], axis=1)
+
+
+def quantize_q4_1(x, fma=False):
+    mn, mx = _minmax(x)
+
+    d  = (mx - mn) / _f32((1 << 4) - 1)
+    id = _inv(d)
+
+    xi = np.minimum(15, _madd(x - mn[:, None], id[:, None], 0.5, fma).astype(np.int8)).astype(np.uint8)
+
+    return np.concatenate([_fp16_bytes(d), _fp16_bytes(mn), _pack_nibbles(xi)], axis=1)
+
+
+def quantize_q5_0(x, fma=False):
+    d  = _absmax(x) / _f32(-16)
+    id = _inv(d)
+
+    xi = np.minimum(31, _madd(x, id[:, None], 16.5, fma).astype(np.int8)).astype(np.uint8)
+
+    return np.concatenate([_fp16_bytes(d), _pack_qh(xi), _pack_nibbles(xi)], axis=1)
+
+
+def quantize_q5_1(x, fma=False):
+    mn, mx = _minmax(x)
+
+    d  = (mx - mn) / _f32((1 << 5) - 1)
+    id = _inv(d)
+
+    xi = _madd(x - mn[:, None], id[:, None], 0.5, fma).astype(np.uint8)
+
+    return np.concatenate([_fp16_bytes(d), _fp16_bytes(mn), _pack_qh(xi), _pack_nibbles(xi)], axis=1)
+
+
+def quantize_q8_0(x, fma=False):
+    d  = np.abs(x).max(axis=1) / _f32((1 << 7) - 1)
+    id = _inv(d)
+
+    # roundf() rounds half away from zero - done in float64, where adding 0.5 to a float32 value is exact
+    x0 = (x*id[:, None]).astype(np.float64)
+    qs = (np.sign(x0)*np.floor(np.abs(x0) + 0.5)).astype(np.int8).view(np.uint8)
+
+    return np.concatenate([_fp16_bytes(d), qs], axis=1)
+
+
+QUANTIZE_FNS = {
+    GGML_TYPE_Q4_0: quantize_q4_0,
+    GGML_TYPE_Q4_1: quantize_q4_1,
+    GGML_TYPE_Q5_0: quantize_q5_0,
+    GGML_TYPE_Q5_1: quantize_q5_1,
+    GGML_TYPE_Q8_0: quantize_q8_0,
+}
+
+
+def is_quantized(ttype):
+    return ttype in QUANTIZE_FNS
+
+
+def quantize(data, qtype, fma=False):
+    """
+    Quantize a tensor to the given ggml_type. Returns the raw block data as a uint8 array with one row per row of
+    the input, i.e. of shape (*data.shape[:-1], row_size).
+    fma: match a ggml build that contracts multiply-adds, see the note at the top
+    """
+    if qtype not in QUANTIZE_FNS:
+        raise ValueError(f"unsupported quantization type {qtype}")
+    if data.shape[-1] % QK != 0:
+        raise ValueError(f"row size {data.shape[-1]} is not a multiple of the block size {QK}")
+
+    fn = QUANTIZE_FNS[qtype]
+
+    x = data.reshape(-1, QK)
+    blocks = []
+    for i in range(0, x.shape[0], CHUNK_BLOCKS):
+        blocks.append(fn(np.asarray(x[i:i + CHUNK_BLOCKS], dtype=np.float32), fma=fma))
+    blocks = np.concatenate(blocks, axis=0)
+
+    return blocks.reshape(*data.shape[:-1], -1)
@@ -30,14 +30,31 @@
 #include <cstring>
 #include <fstream>
 #include <map>
+#include <mutex>
 #include <set>
 #include <string>
 #include <thread>
 #include <vector>
-#include <regex>
 #include <random>
 #include <functional>
 
+#if defined(_WIN32)
+#ifndef WIN32_LEAN_AND_MEAN
+#define WIN32_LEAN_AND_MEAN
+#endif
+#ifndef NOMINMAX
+#define NOMINMAX
+#endif
+#include <windows.h>
+#define WHISPER_MMAP_SUPPORTED
+#elif defined(__unix__) || defined(__APPLE__)
+#include <fcntl.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
+#include <unistd.h>
+#define WHISPER_MMAP_SUPPORTED
+#endif
+
 #if defined(_MSC_VER)
 #pragma warning(disable: 4244 4267) // possible loss of data
 #endif
@@ -151,6 +168,10 @@ static void whisper_log_callback_default(ggml_log_level level, const char * text
 #define WHISPER_MAX_DECODERS 8
 #define WHISPER_MAX_NODES 4096
 
+// the KV cells of the decoded prompt of whisper_full_with_state() - the decoders use the sequences
+// [0, WHISPER_MAX_DECODERS) and the beam search [WHISPER_MAX_DECODERS, 2*WHISPER_MAX_DECODERS)
+#define WHISPER_SEQ_PROMPT (2*WHISPER_MAX_DECODERS)
+
 //
 // ggml helpers
 //
@@ -358,6 +379,9 @@ struct whisper_mel {
     std::vector<float> data;
 };
 
+// state of the incremental log mel spectrogram, see whisper_stream_mel_push()
+struct whisper_mel_stream;
+
 struct whisper_filters {
     int32_t n_mel;
     int32_t n_fft;
@@ -365,6 +389,103 @@ struct whisper_filters {
     std::vector<float> data;
 };
 
+// byte trie of the token texts, for the longest-match lookups of tokenize()
+//
+// the children of a node are a linked list of siblings in byte order, except for the children of the root, that are
+// looked up directly by their first byte
+struct whisper_token_trie {
+    struct node {
+        int32_t id    = -1; // the token that ends at this node, if any
+        int32_t child = -1; // first child
+        int32_t next  = -1; // next sibling
+        uint8_t c     = 0;
+    };
+
+    std::vector<node> nodes;
+
+    int32_t root[256];
+
+    // token_to_id is sorted, so the child that the next token continues with is always the last one added
+    void build(const std::map<std::string, int32_t> & token_to_id) {
+        nodes.clear();
+        std::fill(root, root + 256, -1);
+
+        std::vector<int32_t> last; // last child of each node
+
+        for (const auto & kv : token_to_id) {
+            const std::string & text = kv.first;
+            if (text.empty()) {
+                continue;
+            }
+
+            int32_t cur = -1;
+            for (size_t i = 0; i < text.size(); ++i) {
+                const uint8_t c = text[i];
+
+                int32_t nxt = cur < 0 ? root[c] : last[cur];
+                if (nxt < 0 || nodes[nxt].c != c) {
+                    node n;
+                    n.c = c;
+                    nodes.push_back(n);
+                    last.push_back(-1);
+
+                    nxt = nodes.size() - 1;
+                    if (cur < 0) {
+                        root[c] = nxt;
+                    } else if (last[cur] < 0) {
+                        nodes[cur].child = nxt;
+                    } else {
+                        nodes[last[cur]].next = nxt;
+                    }
+                    if (cur >= 0) {
+                        last[cur] = nxt;
+                    }
+                }
+
+                cur = nxt;
+            }
+
+            nodes[cur].id = kv.second;
+        }
+    }
+
+    // the length of the longest token that str starts with, or 0 if there is none
+    int match(const char * str, int n, int32_t & id) const {
+        int len = 0;
+
+        int32_t cur = n > 0 ? root[(uint8_t) str[0]] : -1;
+        for (int i = 1; cur >= 0; ++i) {
+            if (nodes[cur].id >= 0) {
+                id  = nodes[cur].id;
+                len = i;
+            }
+            if (i == n) {
+                break;
+            }
+
+            const uint8_t c = str[i];
+
+            cur = nodes[cur].child;
+            while (cur >= 0 && nodes[cur].c < c) {
+                cur = nodes[cur].next;
+            }
+            if (cur >= 0 && nodes[cur].c != c) {
+                cur = -1;
+            }
+        }
+
+        return len;
+    }
+};
+
+// ref: https://github.com/openai/whisper/blob/7858aa9c08d98f75575035ecd6481f462d66ca27/whisper/tokenizer.py#L224-L253
+static const std::vector<std::string> non_speech_tokens = {
+    "\"", "#", "(", ")", "*", "+", "/", ":", ";", "<", "=", ">", "@", "[", "\\", "]", "^",
+    "_", "`", "{", "|", "}", "~", "「", "」", "『", "』", "<<", ">>", "<<<", ">>>", "--",
+    "---", "-(", "-[", "('", "(\"", "((", "))", "(((", ")))", "[[", "]]", "{{", "}}", "♪♪",
+    "♪♪♪","♩", "♪", "♫", "♬", "♭", "♮", "♯"
+};
+
 struct whisper_vocab {
     using id    = int32_t;
     using token = std::string;
@@ -374,6 +495,11 @@ struct whisper_vocab {
     std::map<token, id> token_to_id;
     std::map<id, token> id_to_token;
 
+    whisper_token_trie trie;
+
+    // ids of the non_speech_tokens, with and without a leading space, and of " -" and " '"
+    std::vector<id> non_speech;
+
     // reference: https://github.com/openai/whisper/blob/248b6cb124225dd263bb9bd32d060b6517e067f8/whisper/tokenizer.py#L334-L349
     id token_eot        = 50256;
     id token_sot        = 50257;
@@ -478,10 +604,17 @@ struct whisper_allocr {
 
     std::vector<uint8_t> meta;
 
-    ggml_backend_buffer_t buffer;
+    ggml_backend_buffer_t buffer = nullptr;
 };
 
 static size_t whisper_allocr_size(struct whisper_allocr & allocr) {
+    if (!allocr.alloc) {
+        return 0;
+    }
+    // once the buffer is allocated, the allocr only knows the peak of the graphs computed since
+    if (allocr.buffer) {
+        return allocr.meta.size() + ggml_backend_buffer_get_size(allocr.buffer);
+    }
     return allocr.meta.size() + ggml_allocr_max_size(allocr.alloc);
 }
 
@@ -518,7 +651,8 @@ static void whisper_allocr_free(struct whisper_allocr & allocr) {
     if (allocr.alloc) {
         ggml_allocr_free(allocr.alloc);
         ggml_backend_buffer_free(allocr.buffer);
-        allocr.alloc = nullptr;
+        allocr.alloc  = nullptr;
+        allocr.buffer = nullptr;
     }
 }
 
@@ -706,6 +840,9 @@ struct whisper_model {
     // the model backend data is read-only and can be shared between processors
     struct ggml_backend_buffer * buffer;
 
+    // the mapped model file, when the tensors point into it - see whisper_context_params.use_mmap
+    struct whisper_mmap * mapping = nullptr;
+
     // tensors
     int n_loaded;
     std::map<std::string, struct ggml_tensor *> tensors;
@@ -785,6 +922,14 @@ struct whisper_state {
     int32_t n_fail_p = 0; // number of logprob threshold failures
     int32_t n_fail_h = 0; // number of entropy threshold failures
 
+    // per-call duration histograms, see whisper_timings
+    int32_t hist_mel   [WHISPER_TIMINGS_N_BUCKETS] = {};
+    int32_t hist_encode[WHISPER_TIMINGS_N_BUCKETS] = {};
+    int32_t hist_decode[WHISPER_TIMINGS_N_BUCKETS] = {};
+    int32_t hist_batchd[WHISPER_TIMINGS_N_BUCKETS] = {};
+    int32_t hist_prompt[WHISPER_TIMINGS_N_BUCKETS] = {};
+    int32_t hist_sample[WHISPER_TIMINGS_N_BUCKETS] = {}; // per decoding step
+
     // unified self-attention KV cache for all decoders
     whisper_kv_cache kv_self;
 
@@ -794,6 +939,9 @@ struct whisper_state {
 
     whisper_mel mel;
 
+    // incremental log mel spectrogram, allocated by the first whisper_stream_mel_reset/push()
+    whisper_mel_stream * mel_stream = nullptr;
+
     whisper_batch batch;
 
     whisper_decoder decoders[WHISPER_MAX_DECODERS];
@@ -863,6 +1011,10 @@ struct whisper_context {
     ggml_backend_t backend = nullptr;
 
     std::string path_model; // populated by whisper_init_from_file_with_params()
+
+    // tokens of the recent texts passed to whisper_tokenize(), so that a long initial prompt is tokenized once
+    std::mutex tokenize_mutex;
+    std::map<std::string, std::vector<whisper_token>> tokenize_cache;
 };
 
 struct whisper_global {
@@ -879,11 +1031,17 @@ static void read_safe(whisper_model_loader * loader, T & dest) {
     BYTESWAP_VALUE(dest);
 }
 
+// size in bytes of ne elements of the given type - ne is a multiple of the block size
+static size_t whisper_row_size(ggml_type type, int64_t ne) {
+    return ggml_type_size(type)*ne/ggml_blck_size(type);
+}
+
 static bool kv_cache_init(
         const struct whisper_hparams & hparams,
              struct whisper_kv_cache & cache,
                       ggml_backend_t   backend,
-                           ggml_type   wtype,
+                           ggml_type   ktype,
+                           ggml_type   vtype,
                                  int   n_ctx) {
     const int64_t n_text_state = hparams.n_text_state;
     const int64_t n_text_layer = hparams.n_text_layer;
@@ -910,10 +1068,11 @@ static bool kv_cache_init(
         return false;
     }
 
-    cache.k = ggml_new_tensor_1d(cache.ctx, wtype, n_elements);
-    cache.v = ggml_new_tensor_1d(cache.ctx, wtype, n_elements);
+    cache.k = ggml_new_tensor_1d(cache.ctx, ktype, n_elements);
+    cache.v = ggml_new_tensor_1d(cache.ctx, vtype, n_elements);
 
-    const size_t mem_bytes = ggml_nbytes(cache.k) + ggml_nbytes(cache.v);
+    // the size of a block format cache is not a multiple of the alignment of the tensors
+    const size_t mem_bytes = ggml_nbytes(cache.k) + ggml_nbytes(cache.v) + ggml_backend_get_alignment(backend);
 
     cache.buffer = ggml_backend_alloc_buffer(backend, mem_bytes);
 
@@ -1038,6 +1197,26 @@ static void whisper_kv_cache_seq_rm(
     if (new_head != cache.size) cache.head = new_head;
 }
 
+static void whisper_kv_cache_seq_keep(
+        struct whisper_kv_cache & cache,
+                 whisper_seq_id   seq_id) {
+    uint32_t new_head = cache.size;
+
+    for (uint32_t i = 0; i < cache.size; ++i) {
+        if (!cache.cells[i].has_seq_id(seq_id)) {
+            cache.cells[i].pos = -1;
+            cache.cells[i].seq_id.clear();
+            if (new_head == cache.size) new_head = i;
+        } else {
+            cache.cells[i].seq_id.clear();
+            cache.cells[i].seq_id.insert(seq_id);
+        }
+    }
+
+    // If we freed up a slot, set head to it so searching can start there.
+    if (new_head != cache.size) cache.head = new_head;
+}
+
 static void whisper_kv_cache_seq_cp(
         struct whisper_kv_cache & cache,
                  whisper_seq_id   seq_id_src,
@@ -1056,6 +1235,15 @@ static void whisper_kv_cache_seq_cp(
     }
 }
 
+// record the duration of a call in a histogram with power-of-2 buckets
+static void whisper_timings_hist_add(int32_t * hist, int64_t t_us) {
+    int i = 0;
+    while (i < WHISPER_TIMINGS_N_BUCKETS - 1 && t_us >= (int64_t(2) << i)) {
+        i++;
+    }
+    hist[i]++;
+}
+
 static ggml_backend_t whisper_backend_init(const whisper_context_params & params) {
     ggml_backend_t backend_gpu = NULL;
 
@@ -1091,6 +1279,254 @@ static ggml_backend_t whisper_backend_init(const whisper_context_params & params
     return ggml_backend_cpu_init();
 }
 
+template<typename T>
+static void read_safe(std::istream & fin, T & dest) {
+    fin.read((char *) &dest, sizeof(T));
+    BYTESWAP_VALUE(dest);
+}
+
+// with --align, the scripts in the models folder and quantize start the data of each tensor at a multiple of this many
+// bytes - the tensor names are padded with '\0' to get there, so that the format is otherwise unchanged
+#define WHISPER_TENSOR_ALIGNMENT 32
+
+static std::string whisper_tensor_name(const char * name, size_t length) {
+    return std::string(name, strnlen(name, length));
+}
+
+// read-only mapping of a model file
+//
+// with the CPU backend, the tensors point into the mapping instead of being copied to a buffer, so that the processes
+// that load the same file share a single copy of the weights in the page cache, and a model that is already cached
+// is loaded without reading the file
+struct whisper_mmap {
+    void * addr = nullptr;
+    size_t size = 0;
+
+    size_t pos = 0; // read position of whisper_mmap_loader()
+
+    static whisper_mmap * open(const char * path) {
+#if defined(_WIN32)
+        HANDLE hfile = CreateFileA(path, GENERIC_READ, FILE_SHARE_READ, NULL, OPEN_EXISTING, FILE_ATTRIBUTE_NORMAL, NULL);
+        if (hfile == INVALID_HANDLE_VALUE) {
+            return nullptr;
+        }
+
+        LARGE_INTEGER file_size;
+        if (!GetFileSizeEx(hfile, &file_size) || file_size.QuadPart == 0) {
+            CloseHandle(hfile);
+            return nullptr;
+        }
+
+        HANDLE hmap = CreateFileMappingA(hfile, NULL, PAGE_READONLY, 0, 0, NULL);
+        CloseHandle(hfile);
+        if (hmap == NULL) {
+            return nullptr;
+        }
+
+        void * addr = MapViewOfFile(hmap, FILE_MAP_READ, 0, 0, 0);
+        CloseHandle(hmap);
+        if (addr == NULL) {
+            return nullptr;
+        }
+
+        whisper_mmap * mapping = new whisper_mmap;
+        mapping->addr = addr;
+        mapping->size = (size_t) file_size.QuadPart;
+
+        return mapping;
+#elif defined(WHISPER_MMAP_SUPPORTED)
+        const int fd = ::open(path, O_RDONLY);
+        if (fd < 0) {
+            return nullptr;
+        }
+
+        struct stat st;
+        if (fstat(fd, &st) != 0 || st.st_size == 0) {
+            close(fd);
+            return nullptr;
+        }
+
+        void * addr = mmap(NULL, st.st_size, PROT_READ, MAP_SHARED, fd, 0);
+        close(fd);
+        if (addr == MAP_FAILED) {
+            return nullptr;
+        }
+
+        whisper_mmap * mapping = new whisper_mmap;
+        mapping->addr = addr;
+        mapping->size = (size_t) st.st_size;
+
+        return mapping;
+#else
+        GGML_UNUSED(path);
+        return nullptr;
+#endif
+    }
+
+    ~whisper_mmap() {
+#if defined(_WIN32)
+        UnmapViewOfFile(addr);
+#elif defined(WHISPER_MMAP_SUPPORTED)
+        munmap(addr, size);
+#endif
+    }
+};
+
+// a loader that reads the mapping sequentially, from its current position
+static whisper_model_loader whisper_mmap_loader(whisper_mmap * mapping) {
+    whisper_model_loader loader = {};
+
+    loader.context = mapping;
+
+    loader.read = [](void * ctx, void * output, size_t read_size) {
+        whisper_mmap * mapping = (whisper_mmap *) ctx;
+
+        const size_t size_to_copy = std::min(read_size, mapping->size - mapping->pos);
+
+        memcpy(output, (const char *) mapping->addr + mapping->pos, size_to_copy);
+        mapping->pos += size_to_copy;
+
+        return size_to_copy;
+    };
+
+    loader.eof = [](void * ctx) {
+        whisper_mmap * mapping = (whisper_mmap *) ctx;
+        return mapping->pos >= mapping->size;
+    };
+
+    loader.close = [](void * /*ctx*/) {
+    };
+
+    return loader;
+}
+
+// check that the data of all tensor records from the current position of the mapping are aligned, so that the tensors
+// can point into it
+static bool whisper_mmap_is_aligned(const whisper_mmap & mapping) {
+    const char * data = (const char *) mapping.addr;
+
+    size_t pos = mapping.pos;
+    int n_tensors = 0;
+
+    while (pos + 3*sizeof(int32_t) <= mapping.size) {
+        int32_t hdr[3]; // n_dims, length, ttype
+        memcpy(hdr, data + pos, sizeof(hdr));
+        pos += sizeof(hdr);
+
+        if (hdr[0] < 1 || hdr[0] > 4 || hdr[1] < 0 || hdr[2] < 0 || hdr[2] >= GGML_TYPE_COUNT) {
+            return false;
+        }
+
+        // a truncated or corrupt file - the normal loader reports the error
+        if (pos + hdr[0]*sizeof(int32_t) + hdr[1] > mapping.size) {
+            return false;
+        }
+
+        // no type has less than one bit per element, which also keeps nelements from overflowing
+        const int64_t nelements_max = (int64_t) mapping.size*8;
+
+        int64_t nelements = 1;
+        for (int i = 0; i < hdr[0]; ++i) {
+            int32_t ne = 0;
+            memcpy(&ne, data + pos, sizeof(ne));
+            pos += sizeof(ne);
+            if (ne < 0 || (ne > 0 && nelements > nelements_max/ne)) {
+                return false;
+            }
+            nelements *= ne;
+        }
+
+        pos += hdr[1];
+
+        if (pos % WHISPER_TENSOR_ALIGNMENT != 0) {
+            return false;
+        }
+
+        const size_t nbytes = nelements*ggml_type_size((ggml_type) hdr[2])/ggml_blck_size((ggml_type) hdr[2]);
+        if (nbytes > mapping.size - pos) {
+            return false;
+        }
+
+        pos += nbytes;
+        n_tensors++;
+    }
+
+    return n_tensors > 0 && pos == mapping.size;
+}
+
+// scan a model file for the types of its tensors, skipping over the tensor data
+//
+// models quantized with a per-tensor precision policy (see examples/quantize) do not store all weights in the type
+// given by the model ftype, so the types have to be known before the tensors are allocated
+// the scan is only possible for seekable sources - for models loaded through a custom whisper_model_loader, all
+// weights are assumed to be of the model ftype
+//
+static bool whisper_model_scan_tensor_types(std::istream & fin, std::map<std::string, ggml_type> & types) {
+    uint32_t magic;
+    read_safe(fin, magic);
+    if (!fin || magic != GGML_FILE_MAGIC) {
+        return false;
+    }
+
+    // hparams
+    fin.seekg(11*sizeof(int32_t), std::ios::cur);
+
+    // mel filters
+    {
+        int32_t n_mel = 0;
+        int32_t n_fft = 0;
+        read_safe(fin, n_mel);
+        read_safe(fin, n_fft);
+        fin.seekg((size_t) n_mel*n_fft*sizeof(float), std::ios::cur);
+    }
+
+    // vocab
+    {
+        int32_t n_vocab = 0;
+        read_safe(fin, n_vocab);
+        for (int i = 0; i < n_vocab && fin; i++) {
+            uint32_t len = 0;
+            read_safe(fin, len);
+            fin.seekg(len, std::ios::cur);
+        }
+    }
+
+    // tensor records
+    while (true) {
+        int32_t n_dims;
+        int32_t length;
+        int32_t ttype;
+
+        read_safe(fin, n_dims);
+        read_safe(fin, length);
+        read_safe(fin, ttype);
+
+        if (fin.eof()) {
+            break;
+        }
+
+        if (!fin || n_dims < 1 || n_dims > 4 || length < 0 || ttype < 0 || ttype >= GGML_TYPE_COUNT) {
+            return false;
+        }
+
+        int64_t nelements = 1;
+        for (int i = 0; i < n_dims; ++i) {
+            int32_t ne = 0;
+            read_safe(fin, ne);
+            nelements *= ne;
+        }
+
+        std::vector<char> tmp(length);
+        fin.read(tmp.data(), length);
+
+        types[whisper_tensor_name(tmp.data(), tmp.size())] = (ggml_type) ttype;
+
+        fin.seekg(nelements*ggml_type_size((ggml_type) ttype)/ggml_blck_size((ggml_type) ttype), std::ios::cur);
+    }
+
+    return true;
+}
+
 // load the model from a ggml file
 //
 // file format:
@@ -1102,7 +1538,9 @@ static ggml_backend_t whisper_backend_init(const whisper_context_params & params
 //
 // see the convert-pt-to-ggml.py script for details
 //
-static bool whisper_model_load(struct whisper_model_loader * loader, whisper_context & wctx) {
+// tensor_types: the types of the tensors in the file if known, see whisper_model_scan_tensor_types()
+//
+static bool whisper_model_load(struct whisper_model_loader * loader, whisper_context & wctx, const std::map<std::string, ggml_type> & tensor_types, whisper_mmap * mapping) {
     WHISPER_LOG_INFO("%s: loading model\n", __func__);
 
     const int64_t t_start_us = ggml_time_us();
@@ -1291,6 +1729,25 @@ static bool whisper_model_load(struct whisper_model_loader * loader, whisper_con
             }
         }
 
+        vocab.trie.build(vocab.token_to_id);
+
+        for (const std::string & token : non_speech_tokens) {
+            for (const std::string & suppress_token : { token, " " + token }) {
+                const auto it = vocab.token_to_id.find(suppress_token);
+                if (it != vocab.token_to_id.end()) {
+                    vocab.non_speech.push_back(it->second);
+                }
+            }
+        }
+
+        // allow hyphens "-" and single quotes "'" between words, but not at the beginning of a word
+        for (const char * suppress_token : { " -", " '" }) {
+            const auto it = vocab.token_to_id.find(suppress_token);
+            if (it != vocab.token_to_id.end()) {
+                vocab.non_speech.push_back(it->second);
+            }
+        }
+
         WHISPER_LOG_INFO("%s: n_langs       = %d\n", __func__, vocab.num_languages());
     }
 
@@ -1515,9 +1972,49 @@ static bool whisper_model_load(struct whisper_model_loader * loader, whisper_con
         }
     }
 
+    // weights stored in a different type than the model ftype (per-tensor precision policy)
+    for (const auto & kv : tensor_types) {
+        const auto it = model.tensors.find(kv.first);
+        if (it == model.tensors.end() || it->second->type == kv.second) {
+            continue;
+        }
+
+        ggml_tensor * tensor = it->second;
+
+        if (tensor->ne[0] % ggml_blck_size(kv.second) != 0) {
+            WHISPER_LOG_ERROR("%s: tensor '%s' cannot be stored as %s\n", __func__, kv.first.c_str(), ggml_type_name(kv.second));
+            return false;
+        }
+
+        tensor->type  = kv.second;
+        tensor->nb[0] = ggml_type_size(kv.second);
+        tensor->nb[1] = tensor->nb[0]*(tensor->ne[0]/ggml_blck_size(kv.second));
+        for (int i = 2; i < GGML_MAX_DIMS; i++) {
+            tensor->nb[i] = tensor->nb[i - 1]*tensor->ne[i - 1];
+        }
+    }
+
     wctx.backend = whisper_backend_init(wctx.params);
 
-    {
+    // the tensors point into the mapped file - the data is read from the file in the other cases
+    bool use_mmap = false;
+
+#if !defined(GGML_BIG_ENDIAN)
+    if (mapping && ggml_backend_is_cpu(wctx.backend)) {
+        use_mmap = whisper_mmap_is_aligned(*mapping);
+        if (!use_mmap) {
+            WHISPER_LOG_INFO("%s: reading the model into memory (models written with --align can be mapped)\n", __func__);
+        }
+    }
+#endif
+
+    ggml_allocr * alloc = nullptr;
+
+    if (use_mmap) {
+        model.buffer = ggml_backend_cpu_buffer_from_ptr(mapping->addr, mapping->size);
+
+        WHISPER_LOG_INFO("%s: %8s buffer size = %8.2f MB (mmap)\n", __func__, ggml_backend_name(wctx.backend), mapping->size / 1e6);
+    } else {
         size_t size_main = 0;
 
         for (const auto & t : model.tensors) {
@@ -1527,12 +2024,10 @@ static bool whisper_model_load(struct whisper_model_loader * loader, whisper_con
         model.buffer = ggml_backend_alloc_buffer(wctx.backend, size_main);
 
         WHISPER_LOG_INFO("%s: %8s buffer size = %8.2f MB\n", __func__, ggml_backend_name(wctx.backend), size_main / 1e6);
-    }
 
-    ggml_allocr * alloc = ggml_allocr_new_from_buffer(model.buffer);
+        alloc = ggml_allocr_new_from_buffer(model.buffer);
 
-    // allocate tensors in the backend buffers
-    {
+        // allocate tensors in the backend buffers
         for (const auto & t : model.tensors) {
             ggml_allocr_alloc(alloc, t.second);
         }
@@ -1566,10 +2061,9 @@ static bool whisper_model_load(struct whisper_model_loader * loader, whisper_con
                 nelements *= ne[i];
             }
 
-            std::string name;
             std::vector<char> tmp(length); // create a buffer
             loader->read(loader->context, &tmp[0], tmp.size()); // read to buffer
-            name.assign(&tmp[0], tmp.size());
+            const std::string name = whisper_tensor_name(tmp.data(), tmp.size());
 
             if (model.tensors.find(name) == model.tensors.end()) {
                 WHISPER_LOG_ERROR("%s: unknown tensor '%s' in model file\n", __func__, name.data());
@@ -1603,7 +2097,13 @@ static bool whisper_model_load(struct whisper_model_loader * loader, whisper_con
 
             //printf("%s: [%5.5s] %s\n", __func__, ggml_backend_name(backend), name.c_str());
 
-            if ((ggml_backend_is_cpu(backend)
+            if (use_mmap) {
+                // the loader reads the mapping - point the tensor to the data and skip over it
+                tensor->data   = (char *) mapping->addr + mapping->pos;
+                tensor->buffer = model.buffer;
+
+                mapping->pos += ggml_nbytes(tensor);
+            } else if ((ggml_backend_is_cpu(backend)
 #ifdef GGML_USE_METAL
                 || ggml_backend_is_metal(backend)
 #endif
@@ -1635,7 +2135,13 @@ static bool whisper_model_load(struct whisper_model_loader * loader, whisper_con
         }
     }
 
-    ggml_allocr_free(alloc);
+    if (alloc) {
+        ggml_allocr_free(alloc);
+    }
+
+    if (use_mmap) {
+        model.mapping = mapping;
+    }
 
     wctx.t_load_us = ggml_time_us() - t_start_us;
 
@@ -1660,6 +2166,47 @@ static bool whisper_encode_external(const whisper_state & wstate) {
     return use_coreml || use_openvino;
 }
 
+// copy the 2*n_ctx frames of the spectrogram starting at mel_offset to the input of the encoder, zero padded
+static void whisper_mel_input(const whisper_mel & mel_inp, int mel_offset, int n_ctx, float * dst) {
+    memset(dst, 0, 2*n_ctx*mel_inp.n_mel*sizeof(float));
+
+    const int i0 = std::min(mel_offset,           mel_inp.n_len);
+    const int i1 = std::min(mel_offset + 2*n_ctx, mel_inp.n_len);
+
+    for (int j = 0; j < mel_inp.n_mel; ++j) {
+        for (int i = i0; i < i1; ++i) {
+            dst[j*2*n_ctx + (i - i0)] = mel_inp.data[j*mel_inp.n_len + i];
+        }
+    }
+}
+
+// convolution + gelu - mel: [2*n_ctx, n_mels, n_batch] -> [n_ctx, n_state, n_batch]
+static struct ggml_tensor * whisper_conv_1d_ph(struct ggml_context * ctx0, struct ggml_tensor * a, struct ggml_tensor * b, int s) {
+    struct ggml_tensor * cur = ggml_conv_1d_ph(ctx0, a, b, s, 1);
+
+    if (b->ne[2] > 1) {
+        // ggml_conv_1d() lays out a batched result as [OL, N, OC] - bring it to [OL, OC, N]
+        cur = ggml_reshape_3d(ctx0, cur, cur->ne[0], cur->ne[2], cur->ne[1]);
+        cur = ggml_cont(ctx0, ggml_permute(ctx0, cur, 0, 2, 1, 3));
+    }
+
+    return cur;
+}
+
+static struct ggml_tensor * whisper_build_conv(struct ggml_context * ctx0, const whisper_model & model, struct ggml_tensor * mel) {
+    struct ggml_tensor * cur = whisper_conv_1d_ph(ctx0, model.e_conv_1_w, mel, 1);
+    cur = ggml_add(ctx0, cur, model.e_conv_1_b);
+
+    cur = ggml_gelu(ctx0, cur);
+
+    cur = whisper_conv_1d_ph(ctx0, model.e_conv_2_w, cur, 2);
+    cur = ggml_add(ctx0, cur, model.e_conv_2_b);
+
+    cur = ggml_gelu(ctx0, cur);
+
+    return cur;
+}
+
 static struct ggml_cgraph * whisper_build_graph_conv(
         whisper_context & wctx,
           whisper_state & wstate,
@@ -1694,17 +2241,7 @@ static struct ggml_cgraph * whisper_build_graph_conv(
 
         wstate.inp_mel.resize(ggml_nelements(mel));
 
-        float * dst = wstate.inp_mel.data();
-        memset(dst, 0, ggml_nbytes(mel));
-
-        const int i0 = std::min(mel_offset,           mel_inp.n_len);
-        const int i1 = std::min(mel_offset + 2*n_ctx, mel_inp.n_len);
-
-        for (int j = 0; j < mel_inp.n_mel; ++j) {
-            for (int i = i0; i < i1; ++i) {
-                dst[j*2*n_ctx + (i - i0)] = mel_inp.data[j*mel_inp.n_len + i];
-            }
-        }
+        whisper_mel_input(mel_inp, mel_offset, n_ctx, wstate.inp_mel.data());
 
         ggml_backend_tensor_set(mel, wstate.inp_mel.data(), 0, ggml_nelements(mel)*sizeof(float));
     }
@@ -1712,18 +2249,7 @@ static struct ggml_cgraph * whisper_build_graph_conv(
     struct ggml_tensor * cur = nullptr;
 
     if (!whisper_encode_external(wstate)) {
-        // convolution + gelu
-        {
-            cur = ggml_conv_1d_ph(ctx0, model.e_conv_1_w, mel, 1, 1);
-            cur = ggml_add(ctx0, cur, model.e_conv_1_b);
-
-            cur = ggml_gelu(ctx0, cur);
-
-            cur = ggml_conv_1d_ph(ctx0, model.e_conv_2_w, cur, 2, 1);
-            cur = ggml_add(ctx0, cur, model.e_conv_2_b);
-
-            cur = ggml_gelu(ctx0, cur);
-        }
+        cur = whisper_build_conv(ctx0, model, mel);
 
         ggml_set_name(cur, "embd_conv");
         wstate.embd_conv = cur;
@@ -1756,20 +2282,25 @@ static struct ggml_cgraph * whisper_build_graph_conv(
     return gf;
 }
 
+// the encoder over n_batch windows of n_ctx frames at once - embd_conv: [n_ctx, n_state, n_batch]
+// the windows are independent, the result is [n_state, n_ctx*n_batch]
 static struct ggml_cgraph * whisper_build_graph_encoder(
         whisper_context & wctx,
-          whisper_state & wstate) {
+         whisper_allocr & allocr,
+     struct ggml_tensor * embd_conv,
+              const int   n_ctx,
+              const int   n_batch,
+    struct ggml_tensor ** embd_enc) {
     const auto & model   = wctx.model;
     const auto & hparams = model.hparams;
 
-    const int n_ctx   = wstate.exp_n_audio_ctx > 0 ? wstate.exp_n_audio_ctx : hparams.n_audio_ctx;
     const int n_state = hparams.n_audio_state;
     const int n_head  = hparams.n_audio_head;
     const int n_layer = hparams.n_audio_layer;
 
     struct ggml_init_params params = {
-        /*.mem_size   =*/ wstate.alloc_encode.meta.size(),
-        /*.mem_buffer =*/ wstate.alloc_encode.meta.data(),
+        /*.mem_size   =*/ allocr.meta.size(),
+        /*.mem_buffer =*/ allocr.meta.data(),
         /*.no_alloc   =*/ true,
     };
 
@@ -1777,7 +2308,7 @@ static struct ggml_cgraph * whisper_build_graph_encoder(
 
     ggml_cgraph * gf = ggml_new_graph_custom(ctx0, WHISPER_MAX_NODES, false);
 
-    ggml_allocr * alloc = wstate.alloc_encode.alloc;
+    ggml_allocr * alloc = allocr.alloc;
 
     //struct ggml_tensor * cur = ggml_new_tensor_2d(ctx0, GGML_TYPE_F32, n_ctx, n_state);
     //ggml_allocr_alloc(alloc, cur);
@@ -1785,7 +2316,7 @@ static struct ggml_cgraph * whisper_build_graph_encoder(
     //if (!ggml_allocr_is_measure(alloc)) {
     //    ggml_backend_tensor_copy(wstate.embd_conv, cur);
     //}
-    struct ggml_tensor * cur = ggml_view_tensor(ctx0, wstate.embd_conv);
+    struct ggml_tensor * cur = ggml_view_tensor(ctx0, embd_conv);
 
     struct ggml_tensor * KQscale = ggml_new_tensor_1d(ctx0, GGML_TYPE_F32, 1);
     ggml_allocr_alloc(alloc, KQscale);
@@ -1813,7 +2344,8 @@ static struct ggml_cgraph * whisper_build_graph_encoder(
     const size_t e_pe_offset = model.e_pe->ne[0]*ggml_element_size(model.e_pe)*n_ctx*iter;
 
     struct ggml_tensor * e_pe = ggml_view_2d(ctx0, model.e_pe, model.e_pe->ne[0], n_ctx, e_pe_stride, e_pe_offset);
-    cur = ggml_add(ctx0, e_pe, ggml_cont(ctx0, ggml_transpose(ctx0, cur)));
+    cur = ggml_add(ctx0, ggml_cont(ctx0, ggml_transpose(ctx0, cur)), e_pe);
+    cur = ggml_reshape_2d(ctx0, cur, n_state, n_ctx*n_batch);
 
     // ===================================================================
 
@@ -1865,24 +2397,24 @@ static struct ggml_cgraph * whisper_build_graph_encoder(
                 ggml_permute(ctx0,
                         ggml_cpy(ctx0,
                             Qcur,
-                            ggml_new_tensor_3d(ctx0, wctx.itype, n_state/n_head, n_head, n_ctx)),
+                            ggml_new_tensor_4d(ctx0, wctx.itype, n_state/n_head, n_head, n_ctx, n_batch)),
                         0, 2, 1, 3);
 
             struct ggml_tensor * K =
                 ggml_permute(ctx0,
                         ggml_cpy(ctx0,
                             Kcur,
-                            ggml_new_tensor_3d(ctx0, wctx.itype, n_state/n_head, n_head, n_ctx)),
+                            ggml_new_tensor_4d(ctx0, wctx.itype, n_state/n_head, n_head, n_ctx, n_batch)),
                         0, 2, 1, 3);
 
             struct ggml_tensor * V =
                 ggml_cpy(ctx0,
                         ggml_permute(ctx0,
-                            ggml_reshape_3d(ctx0,
+                            ggml_reshape_4d(ctx0,
                                 Vcur,
-                                n_state/n_head, n_head, n_ctx),
+                                n_state/n_head, n_head, n_ctx, n_batch),
                             1, 2, 0, 3),
-                        ggml_new_tensor_3d(ctx0, wctx.itype, n_ctx, n_state/n_head, n_head));
+                        ggml_new_tensor_4d(ctx0, wctx.itype, n_ctx, n_state/n_head, n_head, n_batch));
 
             struct ggml_tensor * KQV = ggml_flash_attn(ctx0, Q, K, V, false);
 #else
@@ -1890,14 +2422,14 @@ static struct ggml_cgraph * whisper_build_graph_encoder(
                 ggml_permute(ctx0,
                         ggml_cpy(ctx0,
                             Qcur,
-                            ggml_new_tensor_3d(ctx0, GGML_TYPE_F32, n_state/n_head, n_head, n_ctx)),
+                            ggml_new_tensor_4d(ctx0, GGML_TYPE_F32, n_state/n_head, n_head, n_ctx, n_batch)),
                         0, 2, 1, 3);
 
             struct ggml_tensor * K =
                 ggml_permute(ctx0,
                         ggml_cpy(ctx0,
                             Kcur,
-                            ggml_new_tensor_3d(ctx0, wctx.itype, n_state/n_head, n_head, n_ctx)),
+                            ggml_new_tensor_4d(ctx0, wctx.itype, n_state/n_head, n_head, n_ctx, n_batch)),
                         0, 2, 1, 3);
 
             // K * Q
@@ -1910,11 +2442,11 @@ static struct ggml_cgraph * whisper_build_graph_encoder(
             struct ggml_tensor * V =
                 ggml_cpy(ctx0,
                         ggml_permute(ctx0,
-                            ggml_reshape_3d(ctx0,
+                            ggml_reshape_4d(ctx0,
                                 Vcur,
-                                n_state/n_head, n_head, n_ctx),
+                                n_state/n_head, n_head, n_ctx, n_batch),
                             1, 2, 0, 3),
-                        ggml_new_tensor_3d(ctx0, wctx.itype, n_ctx, n_state/n_head, n_head)
+                        ggml_new_tensor_4d(ctx0, wctx.itype, n_ctx, n_state/n_head, n_head, n_batch)
                         );
 
             struct ggml_tensor * KQV = ggml_mul_mat(ctx0, V, KQ_soft_max);
@@ -1923,7 +2455,7 @@ static struct ggml_cgraph * whisper_build_graph_encoder(
 
             cur = ggml_cpy(ctx0,
                     KQV_merged,
-                    ggml_new_tensor_2d(ctx0, GGML_TYPE_F32, n_state, n_ctx));
+                    ggml_new_tensor_2d(ctx0, GGML_TYPE_F32, n_state, n_ctx*n_batch));
         }
 
         // projection
@@ -1954,7 +2486,7 @@ static struct ggml_cgraph * whisper_build_graph_encoder(
 
 #ifdef WHISPER_USE_FLASH_FF
             cur = ggml_flash_ff(ctx0,
-                    ggml_cpy(ctx0, cur, ggml_new_tensor_2d(ctx0, wstate.itype, n_state, n_ctx)),
+                    ggml_cpy(ctx0, cur, ggml_new_tensor_2d(ctx0, wctx.itype, n_state, n_ctx*n_batch)),
                     layer.mlp_0_w, layer.mlp_0_b, layer.mlp_1_w, layer.mlp_1_b);
 #else
             // fully connected
@@ -1993,7 +2525,7 @@ static struct ggml_cgraph * whisper_build_graph_encoder(
 
     ggml_build_forward_expand(gf, cur);
 
-    wstate.embd_enc = cur;
+    *embd_enc = cur;
 
     //ggml_graph_print(gf);
 
@@ -2071,7 +2603,7 @@ static struct ggml_cgraph * whisper_build_graph_cross(
 
         struct ggml_tensor * k = ggml_view_1d(ctx0, wstate.kv_cross.k,
                 n_state*n_ctx,
-                (ggml_element_size(wstate.kv_cross.k)*n_state)*(il*n_ctx));
+                whisper_row_size(wstate.kv_cross.k->type, n_state)*(il*n_ctx));
 
         struct ggml_tensor * v = ggml_view_2d(ctx0, wstate.kv_cross.v, n_ctx, n_state,
                 (   n_ctx)*ggml_element_size(wstate.kv_cross.v),
@@ -2088,6 +2620,19 @@ static struct ggml_cgraph * whisper_build_graph_cross(
     return gf;
 }
 
+// compute the cross-attention KV cache of the state from wstate.embd_enc
+static void whisper_encode_cross(whisper_context & wctx, whisper_state & wstate, const int n_threads) {
+    auto & alloc = wstate.alloc_cross.alloc;
+
+    ggml_allocr_reset(alloc);
+
+    ggml_cgraph * gf = whisper_build_graph_cross(wctx, wstate);
+
+    ggml_allocr_alloc_graph(alloc, gf);
+
+    ggml_graph_compute_helper(wstate.backend, gf, n_threads);
+}
+
 // evaluate the encoder with the given state
 //
 // given audio recording (more specifically, its log mel spectrogram), runs forward pass of the encoder
@@ -2128,30 +2673,91 @@ static bool whisper_encode_internal(
 
         ggml_allocr_reset(alloc);
 
-        ggml_cgraph * gf = whisper_build_graph_encoder(wctx, wstate);
+        const int n_ctx = wstate.exp_n_audio_ctx > 0 ? wstate.exp_n_audio_ctx : wctx.model.hparams.n_audio_ctx;
+
+        ggml_cgraph * gf = whisper_build_graph_encoder(wctx, wstate.alloc_encode, wstate.embd_conv, n_ctx, 1, &wstate.embd_enc);
 
         ggml_allocr_alloc_graph(alloc, gf);
 
         ggml_graph_compute_helper(wstate.backend, gf, n_threads);
     }
 
-    // cross
-    {
-        auto & alloc = wstate.alloc_cross.alloc;
+    whisper_encode_cross(wctx, wstate, n_threads);
 
-        ggml_allocr_reset(alloc);
+    const int64_t t_encode_us = ggml_time_us() - t_start_us;
 
-        ggml_cgraph * gf = whisper_build_graph_cross(wctx, wstate);
+    wstate.t_encode_us += t_encode_us;
+    wstate.n_encode++;
+    whisper_timings_hist_add(wstate.hist_encode, t_encode_us);
 
-        ggml_allocr_alloc_graph(alloc, gf);
+    return !(abort_callback && abort_callback(abort_callback_data));
+}
 
-        ggml_graph_compute_helper(wstate.backend, gf, n_threads);
+// compute buffers for running the encoder over the spectrograms of several states at once, see whisper_encode_batch()
+struct whisper_encoder_batch {
+    int n_batch_max = 0;
+
+    ggml_backend_t backend = nullptr;
+
+    whisper_allocr alloc_conv;
+    whisper_allocr alloc_encode;
+
+    struct ggml_tensor * embd_conv = nullptr;
+    struct ggml_tensor * embd_enc  = nullptr;
+
+    std::vector<float> inp_mel;
+
+    // views of the encoder output of each state, for the cross-attention
+    std::vector<uint8_t> meta_views;
+};
+
+static struct ggml_cgraph * whisper_build_graph_conv_batch(
+          whisper_context & wctx,
+    whisper_encoder_batch & batch,
+    whisper_state * const * states,
+                const int * mel_offsets,
+                const int   n_batch,
+                const int   n_ctx) {
+    const auto & model   = wctx.model;
+    const auto & hparams = model.hparams;
+
+    const int n_mels = hparams.n_mels;
+
+    struct ggml_init_params params = {
+        /*.mem_size   =*/ batch.alloc_conv.meta.size(),
+        /*.mem_buffer =*/ batch.alloc_conv.meta.data(),
+        /*.no_alloc   =*/ true,
+    };
+
+    struct ggml_context * ctx0 = ggml_init(params);
+
+    ggml_cgraph * gf = ggml_new_graph(ctx0);
+
+    ggml_allocr * alloc = batch.alloc_conv.alloc;
+
+    struct ggml_tensor * mel = ggml_new_tensor_3d(ctx0, GGML_TYPE_F32, 2*n_ctx, n_mels, n_batch);
+    ggml_allocr_alloc(alloc, mel);
+
+    if (!ggml_allocr_is_measure(alloc)) {
+        batch.inp_mel.resize(ggml_nelements(mel));
+
+        for (int i = 0; i < n_batch; ++i) {
+            whisper_mel_input(states[i]->mel, mel_offsets[i], n_ctx, batch.inp_mel.data() + i*2*n_ctx*n_mels);
+        }
+
+        ggml_backend_tensor_set(mel, batch.inp_mel.data(), 0, ggml_nelements(mel)*sizeof(float));
     }
 
-    wstate.t_encode_us += ggml_time_us() - t_start_us;
-    wstate.n_encode++;
+    struct ggml_tensor * cur = whisper_build_conv(ctx0, model, mel);
 
-    return !(abort_callback && abort_callback(abort_callback_data));
+    ggml_set_name(cur, "embd_conv");
+    batch.embd_conv = cur;
+
+    ggml_build_forward_expand(gf, cur);
+
+    ggml_free(ctx0);
+
+    return gf;
 }
 
 static struct ggml_cgraph * whisper_build_graph_decoder(
@@ -2294,7 +2900,7 @@ static struct ggml_cgraph * whisper_build_graph_decoder(
 
                 Vcur = ggml_transpose(ctx0, ggml_reshape_2d(ctx0, Vcur, n_state, n_tokens));
 
-                struct ggml_tensor * k = ggml_view_1d(ctx0, kv_self.k, n_tokens*n_state, (ggml_element_size(kv_self.k)*n_state)*(il*n_ctx + kv_head));
+                struct ggml_tensor * k = ggml_view_1d(ctx0, kv_self.k, n_tokens*n_state, whisper_row_size(kv_self.k->type, n_state)*(il*n_ctx + kv_head));
                 struct ggml_tensor * v = ggml_view_2d(ctx0, kv_self.v, n_tokens, n_state,
                         (   n_ctx)*ggml_element_size(kv_self.v),
                         (il*n_ctx)*ggml_element_size(kv_self.v)*n_state + kv_head*ggml_element_size(kv_self.v));
@@ -2313,9 +2919,9 @@ static struct ggml_cgraph * whisper_build_graph_decoder(
             struct ggml_tensor * K =
                 ggml_view_3d(ctx0, kv_self.k,
                         n_state/n_head, n_kv, n_head,
-                        ggml_element_size(kv_self.k)*n_state,
-                        ggml_element_size(kv_self.k)*n_state/n_head,
-                        ggml_element_size(kv_self.k)*n_state*n_ctx*il);
+                        whisper_row_size(kv_self.k->type, n_state),
+                        whisper_row_size(kv_self.k->type, n_state/n_head),
+                        whisper_row_size(kv_self.k->type, n_state)*n_ctx*il);
 
             // K * Q
             struct ggml_tensor * KQ = ggml_mul_mat(ctx0, K, Q);
@@ -2385,9 +2991,9 @@ static struct ggml_cgraph * whisper_build_graph_decoder(
             struct ggml_tensor * Kcross =
                 ggml_view_3d(ctx0, wstate.kv_cross.k,
                         n_state/n_head, n_audio_ctx, n_head,
-                        ggml_element_size(wstate.kv_cross.k)*n_state,
-                        ggml_element_size(wstate.kv_cross.k)*n_state/n_head,
-                        ggml_element_size(wstate.kv_cross.k)*n_state*n_audio_ctx*il);
+                        whisper_row_size(wstate.kv_cross.k->type, n_state),
+                        whisper_row_size(wstate.kv_cross.k->type, n_state/n_head),
+                        whisper_row_size(wstate.kv_cross.k->type, n_state)*n_audio_ctx*il);
 
             //struct ggml_tensor * Vcross =
             //    ggml_reshape_3d(ctx0,
@@ -2593,15 +3199,20 @@ static bool whisper_decode_internal(
         //        wstate.get_buf_max_mem(3)/1e6);
     }
 
+    const int64_t t_decode_us = ggml_time_us() - t_start_us;
+
     if (batch.n_tokens == 1) {
-        wstate.t_decode_us += ggml_time_us() - t_start_us;
+        wstate.t_decode_us += t_decode_us;
         wstate.n_decode++;
+        whisper_timings_hist_add(wstate.hist_decode, t_decode_us);
     } else if (batch.n_tokens < 16) {
-        wstate.t_batchd_us += ggml_time_us() - t_start_us;
+        wstate.t_batchd_us += t_decode_us;
         wstate.n_batchd += n_tokens;
+        whisper_timings_hist_add(wstate.hist_batchd, t_decode_us);
     } else {
-        wstate.t_prompt_us += ggml_time_us() - t_start_us;
+        wstate.t_prompt_us += t_decode_us;
         wstate.n_prompt += n_tokens;
+        whisper_timings_hist_add(wstate.hist_prompt, t_decode_us);
     }
 
     return !(abort_callback && abort_callback(abort_callback_data));
@@ -2624,101 +3235,271 @@ static std::string to_timestamp(int64_t t, bool comma = false) {
     return std::string(buf);
 }
 
-#define SIN_COS_N_COUNT WHISPER_N_FFT
-static float sin_vals[SIN_COS_N_COUNT];
-static float cos_vals[SIN_COS_N_COUNT];
+// mixed-radix FFT
+//
+// the frame sizes used for the spectrogram are 400 = 2^4 * 5^2 (and 800 for the phase vocoder), so a radix-2 FFT does
+// not apply. the plan factors the size into radix 4, 2, 3 and 5 butterflies (with a generic butterfly for any other
+// prime factor) and precomputes all twiddle factors. the transform itself is allocation-free - the callers own the
+// scratch buffers
+//
+// the real input of even size N is transformed as a complex sequence of size N/2 (even samples in the real part, odd
+// samples in the imaginary part), followed by a split step that recovers the N/2 + 1 bins of the real spectrum
+//
+struct whisper_fft_cpx {
+    float r;
+    float i;
+};
+
+struct whisper_fft_plan {
+    int n = 0; // size of the complex transform
+
+    std::vector<int> factors;             // pairs (radix, remaining size)
+    std::vector<whisper_fft_cpx> twiddles; // exp(-2*pi*i*k/n), k = 0 .. n - 1
+
+    // real transform of size n_real = 2*n
+    int n_real = 0;
+    std::vector<whisper_fft_cpx> twiddles_real; // exp(-2*pi*i*k/n_real), k = 0 .. n
 
-// In FFT, we frequently use sine and cosine operations with the same values.
-// We can use precalculated values to speed up the process.
-static void fill_sin_cos_table() {
-    static bool is_filled = false;
-    if (is_filled) return;
-    for (int i = 0; i < SIN_COS_N_COUNT; i++) {
-        double theta = (2*M_PI*i)/SIN_COS_N_COUNT;
-        sin_vals[i] = sinf(theta);
-        cos_vals[i] = cosf(theta);
+    void init(int n_real_in) {
+        GGML_ASSERT(n_real_in % 2 == 0);
+
+        n_real = n_real_in;
+        n      = n_real/2;
+
+        twiddles.resize(n);
+        for (int k = 0; k < n; ++k) {
+            const double phase = -2.0*M_PI*k/n;
+            twiddles[k] = { (float) cos(phase), (float) sin(phase) };
+        }
+
+        twiddles_real.resize(n + 1);
+        for (int k = 0; k <= n; ++k) {
+            const double phase = -2.0*M_PI*k/n_real;
+            twiddles_real[k] = { (float) cos(phase), (float) sin(phase) };
+        }
+
+        factors.clear();
+        if (n == 1) {
+            factors = { 1, 1 };
+        }
+        int m = n;
+        int p = 4;
+        while (m > 1) {
+            while (m % p != 0) {
+                switch (p) {
+                    case 4:  p = 2; break;
+                    case 2:  p = 3; break;
+                    default: p += 2; break;
+                }
+            }
+            m /= p;
+            factors.push_back(p);
+            factors.push_back(m);
+        }
+    }
+};
+
+static void whisper_fft_bfly2(whisper_fft_cpx * out, const whisper_fft_plan & plan, int fstride, int m) {
+    const whisper_fft_cpx * tw = plan.twiddles.data();
+    for (int k = 0; k < m; ++k) {
+        const whisper_fft_cpx a = out[k];
+        const whisper_fft_cpx b = out[k + m];
+        const whisper_fft_cpx w = tw[k*fstride];
+
+        const whisper_fft_cpx t = { b.r*w.r - b.i*w.i, b.r*w.i + b.i*w.r };
+
+        out[k]     = { a.r + t.r, a.i + t.i };
+        out[k + m] = { a.r - t.r, a.i - t.i };
+    }
+}
+
+static void whisper_fft_bfly4(whisper_fft_cpx * out, const whisper_fft_plan & plan, int fstride, int m) {
+    const whisper_fft_cpx * tw = plan.twiddles.data();
+    for (int k = 0; k < m; ++k) {
+        const whisper_fft_cpx w1 = tw[k*fstride];
+        const whisper_fft_cpx w2 = tw[k*fstride*2];
+        const whisper_fft_cpx w3 = tw[k*fstride*3];
+
+        const whisper_fft_cpx a0 = out[k];
+        const whisper_fft_cpx a1 = { out[k +   m].r*w1.r - out[k +   m].i*w1.i, out[k +   m].r*w1.i + out[k +   m].i*w1.r };
+        const whisper_fft_cpx a2 = { out[k + 2*m].r*w2.r - out[k + 2*m].i*w2.i, out[k + 2*m].r*w2.i + out[k + 2*m].i*w2.r };
+        const whisper_fft_cpx a3 = { out[k + 3*m].r*w3.r - out[k + 3*m].i*w3.i, out[k + 3*m].r*w3.i + out[k + 3*m].i*w3.r };
+
+        const whisper_fft_cpx s0 = { a0.r + a2.r, a0.i + a2.i };
+        const whisper_fft_cpx s1 = { a0.r - a2.r, a0.i - a2.i };
+        const whisper_fft_cpx s2 = { a1.r + a3.r, a1.i + a3.i };
+        const whisper_fft_cpx s3 = { a1.r - a3.r, a1.i - a3.i };
+
+        // multiplication by -i for the forward transform
+        out[k]       = { s0.r + s2.r, s0.i + s2.i };
+        out[k +   m] = { s1.r + s3.i, s1.i - s3.r };
+        out[k + 2*m] = { s0.r - s2.r, s0.i - s2.i };
+        out[k + 3*m] = { s1.r - s3.i, s1.i + s3.r };
     }
-    is_filled = true;
 }
 
-// naive Discrete Fourier Transform
-// input is real-valued
-// output is complex-valued
-static void dft(const std::vector<float> & in, std::vector<float> & out) {
-    int N = in.size();
+static void whisper_fft_bfly3(whisper_fft_cpx * out, const whisper_fft_plan & plan, int fstride, int m) {
+    const whisper_fft_cpx * tw = plan.twiddles.data();
+    const float s = -0.86602540378443864676f; // sin(-2*pi/3)
+    for (int k = 0; k < m; ++k) {
+        const whisper_fft_cpx w1 = tw[k*fstride];
+        const whisper_fft_cpx w2 = tw[k*fstride*2];
+
+        const whisper_fft_cpx a0 = out[k];
+        const whisper_fft_cpx a1 = { out[k +   m].r*w1.r - out[k +   m].i*w1.i, out[k +   m].r*w1.i + out[k +   m].i*w1.r };
+        const whisper_fft_cpx a2 = { out[k + 2*m].r*w2.r - out[k + 2*m].i*w2.i, out[k + 2*m].r*w2.i + out[k + 2*m].i*w2.r };
+
+        const whisper_fft_cpx t1 = { a1.r + a2.r, a1.i + a2.i };
+        const whisper_fft_cpx t2 = { a0.r - 0.5f*t1.r, a0.i - 0.5f*t1.i };
+        const whisper_fft_cpx t3 = { s*(a1.i - a2.i), -s*(a1.r - a2.r) };
+
+        out[k]       = { a0.r + t1.r, a0.i + t1.i };
+        out[k +   m] = { t2.r - t3.r, t2.i - t3.i };
+        out[k + 2*m] = { t2.r + t3.r, t2.i + t3.i };
+    }
+}
 
-    out.resize(N*2);
-    const int sin_cos_step = SIN_COS_N_COUNT / N;
+static void whisper_fft_bfly5(whisper_fft_cpx * out, const whisper_fft_plan & plan, int fstride, int m) {
+    const whisper_fft_cpx * tw = plan.twiddles.data();
 
-    for (int k = 0; k < N; k++) {
-        float re = 0;
-        float im = 0;
+    // exp(-2*pi*i/5), exp(-4*pi*i/5)
+    const whisper_fft_cpx ya = {  0.30901699437494742410f, -0.95105651629515357212f };
+    const whisper_fft_cpx yb = { -0.80901699437494742410f, -0.58778525229247312917f };
 
-        for (int n = 0; n < N; n++) {
-            int idx = (k * n * sin_cos_step) % (SIN_COS_N_COUNT); // t = 2*M_PI*k*n/N
-            re += in[n]*cos_vals[idx]; // cos(t)
-            im -= in[n]*sin_vals[idx]; // sin(t)
+    for (int k = 0; k < m; ++k) {
+        whisper_fft_cpx a[5];
+        a[0] = out[k];
+        for (int q = 1; q < 5; ++q) {
+            const whisper_fft_cpx w = tw[q*k*fstride];
+            const whisper_fft_cpx x = out[k + q*m];
+            a[q] = { x.r*w.r - x.i*w.i, x.r*w.i + x.i*w.r };
         }
 
-        out[k*2 + 0] = re;
-        out[k*2 + 1] = im;
+        const whisper_fft_cpx s7  = { a[1].r + a[4].r, a[1].i + a[4].i };
+        const whisper_fft_cpx s10 = { a[1].r - a[4].r, a[1].i - a[4].i };
+        const whisper_fft_cpx s8  = { a[2].r + a[3].r, a[2].i + a[3].i };
+        const whisper_fft_cpx s9  = { a[2].r - a[3].r, a[2].i - a[3].i };
+
+        out[k] = { a[0].r + s7.r + s8.r, a[0].i + s7.i + s8.i };
+
+        const whisper_fft_cpx s5  = { a[0].r + s7.r*ya.r + s8.r*yb.r, a[0].i + s7.i*ya.r + s8.i*yb.r };
+        const whisper_fft_cpx s6  = {  s10.i*ya.i + s9.i*yb.i, -s10.r*ya.i - s9.r*yb.i };
+        const whisper_fft_cpx s11 = { a[0].r + s7.r*yb.r + s8.r*ya.r, a[0].i + s7.i*yb.r + s8.i*ya.r };
+        const whisper_fft_cpx s12 = { -s10.i*yb.i + s9.i*ya.i, s10.r*yb.i - s9.r*ya.i };
+
+        out[k +   m] = { s5.r  - s6.r,  s5.i  - s6.i  };
+        out[k + 4*m] = { s5.r  + s6.r,  s5.i  + s6.i  };
+        out[k + 2*m] = { s11.r + s12.r, s11.i + s12.i };
+        out[k + 3*m] = { s11.r - s12.r, s11.i - s12.i };
     }
 }
 
-// Cooley-Tukey FFT
-// poor man's implementation - use something better
-// input is real-valued
-// output is complex-valued
-static void fft(const std::vector<float> & in, std::vector<float> & out) {
-    out.resize(in.size()*2);
+// butterfly for any other radix p - O(p^2) per output, only used for sizes with prime factors above 5
+static void whisper_fft_bfly_generic(whisper_fft_cpx * out, const whisper_fft_plan & plan, int fstride, int m, int p, whisper_fft_cpx * scratch) {
+    const whisper_fft_cpx * tw = plan.twiddles.data();
+    const int n = plan.n;
 
-    int N = in.size();
+    for (int u = 0; u < m; ++u) {
+        for (int q = 0; q < p; ++q) {
+            scratch[q] = out[u + q*m];
+        }
 
-    if (N == 1) {
-        out[0] = in[0];
-        out[1] = 0;
-        return;
+        for (int q = 0; q < p; ++q) {
+            const int k = u + q*m;
+            whisper_fft_cpx acc = scratch[0];
+            int idx = 0;
+            for (int t = 1; t < p; ++t) {
+                idx += fstride*k;
+                if (idx >= n) {
+                    idx %= n;
+                }
+                const whisper_fft_cpx w = tw[idx];
+                acc.r += scratch[t].r*w.r - scratch[t].i*w.i;
+                acc.i += scratch[t].r*w.i + scratch[t].i*w.r;
+            }
+            out[k] = acc;
+        }
     }
+}
 
-    if (N%2 == 1) {
-        dft(in, out);
-        return;
+// decimation in time: out[0 .. p*m) = FFT of in[0], in[fstride], in[2*fstride], ...
+static void whisper_fft_work(
+        whisper_fft_cpx * out, const whisper_fft_cpx * in, int fstride,
+        const int * factors, const whisper_fft_plan & plan, whisper_fft_cpx * scratch) {
+    const int p = factors[0];
+    const int m = factors[1];
+
+    if (m == 1) {
+        for (int q = 0; q < p; ++q) {
+            out[q] = in[q*fstride];
+        }
+    } else {
+        for (int q = 0; q < p; ++q) {
+            whisper_fft_work(out + q*m, in + q*fstride, fstride*p, factors + 2, plan, scratch);
+        }
     }
 
-    std::vector<float> even;
-    std::vector<float> odd;
+    switch (p) {
+        case 2:  whisper_fft_bfly2(out, plan, fstride, m); break;
+        case 3:  whisper_fft_bfly3(out, plan, fstride, m); break;
+        case 4:  whisper_fft_bfly4(out, plan, fstride, m); break;
+        case 5:  whisper_fft_bfly5(out, plan, fstride, m); break;
+        default: whisper_fft_bfly_generic(out, plan, fstride, m, p, scratch); break;
+    }
+}
 
-    even.reserve(N/2);
-    odd.reserve(N/2);
+// per-worker buffers for whisper_fft_power_spectrum
+struct whisper_fft_scratch {
+    std::vector<whisper_fft_cpx> in;
+    std::vector<whisper_fft_cpx> out;
+    std::vector<whisper_fft_cpx> bfly;
 
-    for (int i = 0; i < N; i++) {
-        if (i % 2 == 0) {
-            even.push_back(in[i]);
-        } else {
-            odd.push_back(in[i]);
+    void init(const whisper_fft_plan & plan) {
+        int p_max = 0;
+        for (size_t i = 0; i < plan.factors.size(); i += 2) {
+            p_max = std::max(p_max, plan.factors[i]);
         }
+        in  .resize(plan.n);
+        out .resize(plan.n);
+        bfly.resize(p_max);
     }
+};
 
-    std::vector<float> even_fft;
-    std::vector<float> odd_fft;
+// power spectrum |FFT(hann * frame)|^2 of a real frame of plan.n_real samples - writes plan.n_real/2 + 1 bins
+// the frame is read up to n_avail samples and zero-padded after that
+static void whisper_fft_power_spectrum(
+        const whisper_fft_plan & plan, whisper_fft_scratch & scratch,
+        const float * hann, const float * frame, int n_avail, float * power) {
+    const int n = plan.n;
 
-    fft(even, even_fft);
-    fft(odd, odd_fft);
+    // window and pack the even/odd samples as complex values
+    whisper_fft_cpx * in = scratch.in.data();
+    for (int j = 0; j < n; ++j) {
+        const int j0 = 2*j;
+        const int j1 = 2*j + 1;
+        in[j].r = j0 < n_avail ? hann[j0]*frame[j0] : 0.0f;
+        in[j].i = j1 < n_avail ? hann[j1]*frame[j1] : 0.0f;
+    }
+
+    whisper_fft_cpx * z = scratch.out.data();
+    whisper_fft_work(z, in, 1, plan.factors.data(), plan, scratch.bfly.data());
 
-    const int sin_cos_step = SIN_COS_N_COUNT / N;
-    for (int k = 0; k < N/2; k++) {
-        int idx = k * sin_cos_step; // t = 2*M_PI*k/N
-        float re = cos_vals[idx]; // cos(t)
-        float im = -sin_vals[idx]; // sin(t)
+    // split into the spectrum of the real sequence: X[k] = E[k] + w^k O[k], w = exp(-2*pi*i/n_real)
+    const whisper_fft_cpx * tw = plan.twiddles_real.data();
+    for (int k = 0; k <= n; ++k) {
+        const whisper_fft_cpx zk = z[k == n ? 0 : k];
+        const whisper_fft_cpx zc = z[k == 0 ? 0 : n - k];
 
-        float re_odd = odd_fft[2*k + 0];
-        float im_odd = odd_fft[2*k + 1];
+        // E[k] = (Z[k] + conj(Z[n-k]))/2, O[k] = (Z[k] - conj(Z[n-k]))/(2i)
+        const float er = 0.5f*(zk.r + zc.r);
+        const float ei = 0.5f*(zk.i - zc.i);
+        const float or_ = 0.5f*(zk.i + zc.i);
+        const float oi = -0.5f*(zk.r - zc.r);
 
-        out[2*k + 0] = even_fft[2*k + 0] + re*re_odd - im*im_odd;
-        out[2*k + 1] = even_fft[2*k + 1] + re*im_odd + im*re_odd;
+        const float xr = er + tw[k].r*or_ - tw[k].i*oi;
+        const float xi = ei + tw[k].r*oi  + tw[k].i*or_;
 
-        out[2*(k + N/2) + 0] = even_fft[2*k + 0] - re*re_odd + im*im_odd;
-        out[2*(k + N/2) + 1] = even_fft[2*k + 1] - re*im_odd - im*re_odd;
+        power[k] = xr*xr + xi*xi;
     }
 }
 
@@ -2737,11 +3518,40 @@ static bool hann_window(int length, bool periodic, std::vector<float> & output)
     return true;
 }
 
-static void log_mel_spectrogram_worker_thread(int ith, const std::vector<float> & hann, const std::vector<float> & samples,
+// mel filter bank and log10 of one power spectrum - writes out[j*stride] for the n_mel bands
+static void whisper_mel_frame(const float * fft_out, int n_fft, const whisper_filters & filters, int n_mel, float * out, int stride) {
+    for (int j = 0; j < n_mel; j++) {
+        double sum = 0.0;
+
+        // unroll loop (suggested by GH user @lunixbochs)
+        int k = 0;
+        for (k = 0; k < n_fft - 3; k += 4) {
+            sum +=
+                    fft_out[k + 0] * filters.data[j * n_fft + k + 0] +
+                    fft_out[k + 1] * filters.data[j * n_fft + k + 1] +
+                    fft_out[k + 2] * filters.data[j * n_fft + k + 2] +
+                    fft_out[k + 3] * filters.data[j * n_fft + k + 3];
+        }
+
+        // handle n_fft remainder
+        for (; k < n_fft; k++) {
+            sum += fft_out[k] * filters.data[j * n_fft + k];
+        }
+
+        sum = log10(std::max(sum, 1e-10));
+
+        out[j * stride] = sum;
+    }
+}
+
+static void log_mel_spectrogram_worker_thread(int ith, const std::vector<float> & hann, const whisper_fft_plan & plan,
+                                              const std::vector<float> & samples,
                                               int n_samples, int frame_size, int frame_step, int n_threads,
                                               const whisper_filters & filters, whisper_mel & mel) {
-    std::vector<float> fft_in(frame_size, 0.0);
-    std::vector<float> fft_out(2 * frame_step);
+    whisper_fft_scratch scratch;
+    scratch.init(plan);
+
+    std::vector<float> fft_out(frame_size/2 + 1);
     // make sure n_fft == 1 + (WHISPER_N_FFT / 2), bin_0 to bin_nyquist
     int n_fft = 1 + (frame_size / 2);
     int i = ith;
@@ -2750,47 +3560,11 @@ static void log_mel_spectrogram_worker_thread(int ith, const std::vector<float>
     for (; i < std::min(n_samples / frame_step + 1, mel.n_len); i += n_threads) {
         const int offset = i * frame_step;
 
-        // apply Hanning window (~10% faster)
-        for (int j = 0; j < std::min(frame_size, n_samples - offset); j++) {
-            fft_in[j] = hann[j] * samples[offset + j];
-        }
-        // fill the rest with zeros
-        if (n_samples - offset < frame_size) {
-            std::fill(fft_in.begin() + (n_samples - offset), fft_in.end(), 0.0);
-        }
-
-        // FFT
-        fft(fft_in, fft_out);
-
-        // Calculate modulus^2 of complex numbers
-        // Use pow(fft_out[2 * j + 0], 2) + pow(fft_out[2 * j + 1], 2) causes inference quality problem? Interesting.
-        for (int j = 0; j < frame_size; j++) {
-            fft_out[j] = (fft_out[2 * j + 0] * fft_out[2 * j + 0] + fft_out[2 * j + 1] * fft_out[2 * j + 1]);
-        }
+        // Hann window, FFT and modulus^2 of the complex bins
+        whisper_fft_power_spectrum(plan, scratch, hann.data(), samples.data() + offset, std::min(frame_size, n_samples - offset), fft_out.data());
 
         // mel spectrogram
-        for (int j = 0; j < mel.n_mel; j++) {
-            double sum = 0.0;
-
-            // unroll loop (suggested by GH user @lunixbochs)
-            int k = 0;
-            for (k = 0; k < n_fft - 3; k += 4) {
-                sum +=
-                        fft_out[k + 0] * filters.data[j * n_fft + k + 0] +
-                        fft_out[k + 1] * filters.data[j * n_fft + k + 1] +
-                        fft_out[k + 2] * filters.data[j * n_fft + k + 2] +
-                        fft_out[k + 3] * filters.data[j * n_fft + k + 3];
-            }
-
-            // handle n_fft remainder
-            for (; k < n_fft; k++) {
-                sum += fft_out[k] * filters.data[j * n_fft + k];
-            }
-
-            sum = log10(std::max(sum, 1e-10));
-
-            mel.data[j * mel.n_len + i] = sum;
-        }
+        whisper_mel_frame(fft_out.data(), n_fft, filters, mel.n_mel, mel.data.data() + i, mel.n_len);
     }
 
     // Otherwise fft_out are all zero
@@ -2802,6 +3576,26 @@ static void log_mel_spectrogram_worker_thread(int ith, const std::vector<float>
     }
 }
 
+// clamp to 8 orders of magnitude below the maximum and scale to roughly [-1, 1]
+static void log_mel_spectrogram_normalize(whisper_mel & mel) {
+    double mmax = -1e20;
+    for (int i = 0; i < mel.n_mel*mel.n_len; i++) {
+        if (mel.data[i] > mmax) {
+            mmax = mel.data[i];
+        }
+    }
+
+    mmax -= 8.0;
+
+    for (int i = 0; i < mel.n_mel*mel.n_len; i++) {
+        if (mel.data[i] < mmax) {
+            mel.data[i] = mmax;
+        }
+
+        mel.data[i] = (mel.data[i] + 4.0)/4.0;
+    }
+}
+
 // ref: https://github.com/openai/whisper/blob/main/whisper/audio.py#L110-L157
 static bool log_mel_spectrogram(
               whisper_state & wstate,
@@ -2823,6 +3617,9 @@ static bool log_mel_spectrogram(
     std::vector<float> hann;
     hann_window(frame_size, true, hann);
 
+    whisper_fft_plan plan;
+    plan.init(frame_size);
+
 
     // Calculate the length of padding
     int64_t stage_1_pad = WHISPER_SAMPLE_RATE * 30;
@@ -2852,13 +3649,13 @@ static bool log_mel_spectrogram(
         std::vector<std::thread> workers(n_threads - 1);
         for (int iw = 0; iw < n_threads - 1; ++iw) {
             workers[iw] = std::thread(
-                    log_mel_spectrogram_worker_thread, iw + 1, std::cref(hann), samples_padded,
+                    log_mel_spectrogram_worker_thread, iw + 1, std::cref(hann), std::cref(plan), std::cref(samples_padded),
                     n_samples + stage_2_pad, frame_size, frame_step, n_threads,
                     std::cref(filters), std::ref(mel));
         }
 
         // main thread
-        log_mel_spectrogram_worker_thread(0, hann, samples_padded, n_samples + stage_2_pad, frame_size, frame_step, n_threads, filters, mel);
+        log_mel_spectrogram_worker_thread(0, hann, plan, samples_padded, n_samples + stage_2_pad, frame_size, frame_step, n_threads, filters, mel);
 
         for (int iw = 0; iw < n_threads - 1; ++iw) {
             workers[iw].join();
@@ -2866,24 +3663,12 @@ static bool log_mel_spectrogram(
     }
 
     // clamping and normalization
-    double mmax = -1e20;
-    for (int i = 0; i < mel.n_mel*mel.n_len; i++) {
-        if (mel.data[i] > mmax) {
-            mmax = mel.data[i];
-        }
-    }
+    log_mel_spectrogram_normalize(mel);
 
-    mmax -= 8.0;
+    const int64_t t_mel_us = ggml_time_us() - t_start_us;
 
-    for (int i = 0; i < mel.n_mel*mel.n_len; i++) {
-        if (mel.data[i] < mmax) {
-            mel.data[i] = mmax;
-        }
-
-        mel.data[i] = (mel.data[i] + 4.0)/4.0;
-    }
-
-    wstate.t_mel_us += ggml_time_us() - t_start_us;
+    wstate.t_mel_us += t_mel_us;
+    whisper_timings_hist_add(wstate.hist_mel, t_mel_us);
 
     // Dump log_mel_spectrogram
     if (debug) {
@@ -2899,7 +3684,75 @@ static bool log_mel_spectrogram(
     return true;
 }
 
-// split text into tokens
+// incremental log mel spectrogram
+//
+// The frames are those of log_mel_spectrogram() over all samples pushed since the last reset: frame i is centered at
+// sample i*WHISPER_HOP_LENGTH and the stream is reflection padded at its start. A frame is computed once, when the
+// samples up to the end of its window have been pushed, and kept unnormalized in a ring buffer. The few frames at the
+// end whose windows are not complete yet are computed zero padded by every whisper_stream_mel_view() instead
+struct whisper_mel_stream {
+    int n_mel = 0;
+    int n_cap = 0; // capacity of the ring buffer in frames
+
+    int64_t n_samples = 0; // samples pushed since the reset
+    int64_t n_frames  = 0; // complete frames since the reset
+
+    std::vector<float> hann;
+    whisper_fft_plan   plan;
+
+    // samples from the start of the window of frame n_frames onwards, in the padded signal
+    // until there are enough samples for the reflection padding, the unpadded samples
+    bool               padded = false;
+    std::vector<float> pcm;
+
+    // log10 of the mel bands before clamping and normalization, frame f at (f % n_cap)*n_mel
+    std::vector<float> ring;
+
+    void init(int n_mel, int n_cap) {
+        this->n_mel = n_mel;
+        this->n_cap = n_cap;
+
+        n_samples = 0;
+        n_frames  = 0;
+
+        hann_window(WHISPER_N_FFT, true, hann);
+        plan.init(WHISPER_N_FFT);
+
+        padded = false;
+        pcm.clear();
+
+        ring.assign((size_t) n_mel*n_cap, 0.0f);
+    }
+};
+
+// computes the complete frames [f0, f1) of the stream into the ring buffer
+static void whisper_mel_stream_worker_thread(int ith, int n_threads, whisper_mel_stream & ms, const whisper_filters & filters, int64_t f0, int64_t f1) {
+    whisper_fft_scratch scratch;
+    scratch.init(ms.plan);
+
+    const int n_fft = 1 + WHISPER_N_FFT/2;
+
+    std::vector<float> fft_out(n_fft);
+
+    for (int64_t f = f0 + ith; f < f1; f += n_threads) {
+        const float * frame = ms.pcm.data() + (f - ms.n_frames)*WHISPER_HOP_LENGTH;
+
+        whisper_fft_power_spectrum(ms.plan, scratch, ms.hann.data(), frame, WHISPER_N_FFT, fft_out.data());
+        whisper_mel_frame(fft_out.data(), n_fft, filters, ms.n_mel, ms.ring.data() + (f % ms.n_cap)*ms.n_mel, 1);
+    }
+}
+
+// character classes of the regex below, in the "C" locale - the bytes of multi-byte UTF-8 characters are in none of
+// the first three
+static bool whisper_is_space(uint8_t c) { return c == ' ' || (c >= '\t' && c <= '\r'); }
+static bool whisper_is_alpha(uint8_t c) { return (c >= 'a' && c <= 'z') || (c >= 'A' && c <= 'Z'); }
+static bool whisper_is_digit(uint8_t c) { return c >= '0' && c <= '9'; }
+
+static int whisper_char_class(uint8_t c) {
+    return whisper_is_space(c) ? 0 : whisper_is_alpha(c) ? 1 : whisper_is_digit(c) ? 2 : 3;
+}
+
+// split text into words, as (offset, length)
 //
 // ref: https://github.com/openai/gpt-2/blob/a74da5d99abaaba920de8131d64da2862a8f213b/src/encoder.py#L53
 //
@@ -2909,47 +3762,74 @@ static bool log_mel_spectrogram(
 // Regex (C++):
 // R"('s|'t|'re|'ve|'m|'ll|'d| ?[[:alpha:]]+| ?[[:digit:]]+| ?[^\s[:alpha:][:digit:]]+|\s+(?!\S)|\s+)"
 //
-static std::vector<whisper_vocab::id> tokenize(const whisper_vocab & vocab, const std::string & text) {
-    std::vector<std::string> words;
-
-    // first split the text into words
-    {
-        std::string str = text;
-        std::string pat = R"('s|'t|'re|'ve|'m|'ll|'d| ?[[:alpha:]]+| ?[[:digit:]]+| ?[^\s[:alpha:][:digit:]]+|\s+(?!\S)|\s+)";
+// the same matches as std::regex_search with the C++ regex, in a single pass over the text
+static std::vector<std::pair<int, int>> whisper_split_words(const std::string & text) {
+    std::vector<std::pair<int, int>> words;
+
+    const char * str = text.data();
+    const int    n   = text.size();
+
+    int i = 0;
+    while (i < n) {
+        int j = i;
+
+        // 's|'t|'re|'ve|'m|'ll|'d
+        if (str[i] == '\'' && i + 1 < n) {
+            const char c1 = str[i + 1];
+            const char c2 = i + 2 < n ? str[i + 2] : 0;
+            if (c1 == 's' || c1 == 't' || c1 == 'm' || c1 == 'd') {
+                j = i + 2;
+            } else if ((c1 == 'r' && c2 == 'e') || (c1 == 'v' && c2 == 'e') || (c1 == 'l' && c2 == 'l')) {
+                j = i + 3;
+            }
+        }
 
-        std::regex re(pat);
-        std::smatch m;
+        if (j == i) {
+            // ' ?[[:alpha:]]+| ?[[:digit:]]+| ?[^\s[:alpha:][:digit:]]+'
+            const int k = (str[i] == ' ' && i + 1 < n && !whisper_is_space(str[i + 1])) ? i + 1 : i;
+            const int c = whisper_char_class(str[k]);
 
-        while (std::regex_search(str, m, re)) {
-            for (auto x : m) {
-                words.push_back(x);
+            if (c != 0) {
+                j = k + 1;
+                while (j < n && whisper_char_class(str[j]) == c) {
+                    ++j;
+                }
+            } else {
+                // \s+(?!\S)|\s+ - the whitespace before a word is left for the word, unless it is a single character
+                while (j < n && whisper_is_space(str[j])) {
+                    ++j;
+                }
+                if (j < n && j - i > 1) {
+                    --j;
+                }
             }
-            str = m.suffix();
         }
+
+        words.emplace_back(i, j - i);
+        i = j;
     }
 
-    // find the longest tokens that form the words:
+    return words;
+}
+
+// split text into tokens
+static std::vector<whisper_vocab::id> tokenize(const whisper_vocab & vocab, const std::string & text) {
     std::vector<whisper_vocab::id> tokens;
-    for (const auto & word : words) {
-        if (word.empty()) continue;
+
+    // find the longest tokens that form the words:
+    for (const auto & word : whisper_split_words(text)) {
+        const char * str = text.data() + word.first;
+        const int    n   = word.second;
 
         int i = 0;
-        int n = word.size();
         while (i < n) {
-            int j = n;
-            bool found = false;
-            while (j > i) {
-                auto sub = word.substr(i, j-i);
-                auto it = vocab.token_to_id.find(sub);
-                if (it != vocab.token_to_id.end()) {
-                    tokens.push_back(it->second);
-                    i = j;
-                    found = true;
-                    break;
-                }
-                --j;
-            }
-            if (!found) {
+            whisper_vocab::id id = -1;
+
+            const int len = vocab.trie.match(str + i, n - i, id);
+            if (len > 0) {
+                tokens.push_back(id);
+                i += len;
+            } else {
                 WHISPER_LOG_ERROR("unknown token\n");
                 ++i;
             }
@@ -2959,6 +3839,33 @@ static std::vector<whisper_vocab::id> tokenize(const whisper_vocab & vocab, cons
     return tokens;
 }
 
+// the number of texts in whisper_context::tokenize_cache - it is cleared when full
+#define WHISPER_TOKENIZE_CACHE_SIZE 64
+
+static std::vector<whisper_token> whisper_tokenize_cached(struct whisper_context * ctx, const std::string & text) {
+    {
+        std::lock_guard<std::mutex> lock(ctx->tokenize_mutex);
+
+        const auto it = ctx->tokenize_cache.find(text);
+        if (it != ctx->tokenize_cache.end()) {
+            return it->second;
+        }
+    }
+
+    std::vector<whisper_token> tokens = tokenize(ctx->vocab, text);
+
+    {
+        std::lock_guard<std::mutex> lock(ctx->tokenize_mutex);
+
+        if (ctx->tokenize_cache.size() >= WHISPER_TOKENIZE_CACHE_SIZE) {
+            ctx->tokenize_cache.clear();
+        }
+        ctx->tokenize_cache[text] = tokens;
+    }
+
+    return tokens;
+}
+
 //
 // interface implementation
 //
@@ -3011,18 +3918,53 @@ static std::string whisper_openvino_get_path_cache(std::string path_bin) {
 }
 #endif
 
-struct whisper_state * whisper_init_state(whisper_context * ctx) {
-    fill_sin_cos_table();
+// the types of the keys and the values in the KV caches - see whisper_context_params.kv_type
+//
+// the values are stored transposed, with a row per channel that is filled a few positions at a time, so they cannot
+// be stored in a block format
+static void whisper_kv_types(const whisper_context & ctx, ggml_type & ktype, ggml_type & vtype) {
+    ktype = ctx.itype;
+    vtype = ctx.itype;
+
+    switch (ctx.params.kv_type) {
+        case WHISPER_KV_TYPE_DEFAULT:
+            break;
+        case WHISPER_KV_TYPE_F16:
+            {
+                ktype = GGML_TYPE_F16;
+                vtype = GGML_TYPE_F16;
+            } break;
+        case WHISPER_KV_TYPE_Q8_0:
+            {
+                ktype = GGML_TYPE_F16;
+                vtype = GGML_TYPE_F16;
+
+                const auto & hparams = ctx.model.hparams;
+
+                // the keys of each head are quantized as a whole number of blocks
+                if (!ggml_backend_is_cpu(ctx.backend) || (hparams.n_text_state/hparams.n_text_head) % ggml_blck_size(GGML_TYPE_Q8_0) != 0) {
+                    WHISPER_LOG_WARN("%s: q8_0 KV cache is not supported with this model or backend, using f16\n", __func__);
+                } else {
+                    ktype = GGML_TYPE_Q8_0;
+                }
+            } break;
+    }
+}
 
+struct whisper_state * whisper_init_state(whisper_context * ctx) {
     whisper_state * state = new whisper_state;
 
     state->backend = whisper_backend_init(ctx->params);
 
+    ggml_type ktype;
+    ggml_type vtype;
+    whisper_kv_types(*ctx, ktype, vtype);
+
     // at this point, we don't know yet how many decoders will be used, so we overallocate 3x ctx
     // in theory, there can be a case where this is not enough, but in practice it should always be enough
     const int factor = 3;
 
-    if (!kv_cache_init(ctx->model.hparams, state->kv_self, ctx->backend, ctx->itype, factor*ctx->model.hparams.n_text_ctx)) {
+    if (!kv_cache_init(ctx->model.hparams, state->kv_self, ctx->backend, ktype, vtype, factor*ctx->model.hparams.n_text_ctx)) {
         WHISPER_LOG_ERROR("%s: kv_cache_init() failed for self-attention cache\n", __func__);
         delete state;
         return nullptr;
@@ -3030,10 +3972,10 @@ struct whisper_state * whisper_init_state(whisper_context * ctx) {
 
     {
         const size_t memory_size = ggml_nbytes(state->kv_self.k) + ggml_nbytes(state->kv_self.v);
-        WHISPER_LOG_INFO("%s: kv self size  = %7.2f MB\n", __func__, memory_size / 1e6);
+        WHISPER_LOG_INFO("%s: kv self size  = %7.2f MB (k: %s, v: %s)\n", __func__, memory_size / 1e6, ggml_type_name(ktype), ggml_type_name(vtype));
     }
 
-    if (!kv_cache_init(ctx->model.hparams, state->kv_cross, ctx->backend, ctx->itype, ctx->model.hparams.n_audio_ctx)) {
+    if (!kv_cache_init(ctx->model.hparams, state->kv_cross, ctx->backend, ktype, vtype, ctx->model.hparams.n_audio_ctx)) {
         WHISPER_LOG_ERROR("%s: kv_cache_init() failed for cross-attention cache\n", __func__);
         delete state;
         return nullptr;
@@ -3072,7 +4014,7 @@ struct whisper_state * whisper_init_state(whisper_context * ctx) {
     state->decoders[0].probs.reserve    (ctx->vocab.n_vocab);
     state->decoders[0].logits.reserve   (ctx->vocab.n_vocab);
     state->decoders[0].logprobs.reserve (ctx->vocab.n_vocab);
-    state->decoders[0].logits_id.reserve(ctx->model.hparams.n_vocab);
+    state->decoders[0].logits_id.reserve(g_lang.size());
 
     state->decoders[0].rng = std::mt19937(0);
 
@@ -3090,7 +4032,7 @@ struct whisper_state * whisper_init_state(whisper_context * ctx) {
     if (!whisper_encode_external(*state)) {
         whisper_allocr_graph_init(state->alloc_encode, ctx->backend,
                 [&]() {
-                    return whisper_build_graph_encoder(*ctx, *state);
+                    return whisper_build_graph_encoder(*ctx, state->alloc_encode, state->embd_conv, ctx->model.hparams.n_audio_ctx, 1, &state->embd_enc);
                 });
 
         WHISPER_LOG_INFO("%s: compute buffer (encode) = %7.2f MB\n", __func__, whisper_allocr_size(state->alloc_encode) / 1e6);
@@ -3129,6 +4071,8 @@ struct whisper_state * whisper_init_state(whisper_context * ctx) {
     whisper_allocr_graph_realloc(state->alloc_cross,  ctx->backend);
     whisper_allocr_graph_realloc(state->alloc_decode, ctx->backend);
 
+    WHISPER_LOG_INFO("%s: state size = %7.2f MB\n", __func__, whisper_get_memory_with_state(ctx, state).total / 1e6);
+
     return state;
 }
 
@@ -3184,10 +4128,19 @@ int whisper_ctx_init_openvino_encoder(
 struct whisper_context_params whisper_context_default_params() {
     struct whisper_context_params result = {
         /*.use_gpu    =*/ true,
+        /*.use_mmap   =*/ true,
+
+        /*.kv_type    =*/ WHISPER_KV_TYPE_DEFAULT,
     };
     return result;
 }
 
+static struct whisper_context * whisper_init_with_params_no_state_impl(
+        struct whisper_model_loader * loader,
+        struct whisper_context_params params,
+        const std::map<std::string, ggml_type> & tensor_types,
+        struct whisper_mmap * mapping);
+
 struct whisper_context * whisper_init_from_file_with_params_no_state(const char * path_model, struct whisper_context_params params) {
     WHISPER_LOG_INFO("%s: loading model from '%s'\n", __func__, path_model);
 
@@ -3217,7 +4170,24 @@ struct whisper_context * whisper_init_from_file_with_params_no_state(const char
         fin->close();
     };
 
-    auto ctx = whisper_init_with_params_no_state(&loader, params);
+    std::map<std::string, ggml_type> tensor_types;
+    {
+        auto fscan = std::ifstream(path_model, std::ios::binary);
+        if (!whisper_model_scan_tensor_types(fscan, tensor_types)) {
+            tensor_types.clear();
+        }
+    }
+
+    whisper_mmap * mapping = params.use_mmap ? whisper_mmap::open(path_model) : nullptr;
+
+    whisper_context * ctx = nullptr;
+    if (mapping) {
+        whisper_model_loader loader_mmap = whisper_mmap_loader(mapping);
+        ctx = whisper_init_with_params_no_state_impl(&loader_mmap, params, tensor_types, mapping);
+        loader.close(loader.context);
+    } else {
+        ctx = whisper_init_with_params_no_state_impl(&loader, params, tensor_types, nullptr);
+    }
 
     if (ctx) {
         ctx->path_model = path_model;
@@ -3260,27 +4230,66 @@ struct whisper_context * whisper_init_from_buffer_with_params_no_state(void * bu
 
     loader.close = [](void * /*ctx*/) { };
 
-    return whisper_init_with_params_no_state(&loader, params);
+    std::map<std::string, ggml_type> tensor_types;
+    {
+        struct membuf : std::streambuf {
+            membuf(char * data, size_t size) {
+                setg(data, data, data + size);
+            }
+
+            pos_type seekoff(off_type off, std::ios_base::seekdir dir, std::ios_base::openmode /*which*/) override {
+                char * pos = dir == std::ios_base::beg ? eback() + off : dir == std::ios_base::cur ? gptr() + off : egptr() + off;
+                if (pos < eback() || pos > egptr()) {
+                    return pos_type(off_type(-1));
+                }
+                setg(eback(), pos, egptr());
+                return pos_type(pos - eback());
+            }
+        };
+
+        membuf buf(reinterpret_cast<char *>(buffer), buffer_size);
+        std::istream fscan(&buf);
+        if (!whisper_model_scan_tensor_types(fscan, tensor_types)) {
+            tensor_types.clear();
+        }
+    }
+
+    return whisper_init_with_params_no_state_impl(&loader, params, tensor_types, nullptr);
 }
 
-struct whisper_context * whisper_init_with_params_no_state(struct whisper_model_loader * loader, struct whisper_context_params params) {
+// mapping: the mapped model file that the loader reads, if any - it is owned by the context when the tensors point
+// into it, and freed otherwise
+static struct whisper_context * whisper_init_with_params_no_state_impl(
+        struct whisper_model_loader * loader,
+        struct whisper_context_params params,
+        const std::map<std::string, ggml_type> & tensor_types,
+        struct whisper_mmap * mapping) {
     ggml_time_init();
 
     whisper_context * ctx = new whisper_context;
     ctx->params = params;
 
-    if (!whisper_model_load(loader, *ctx)) {
+    if (!whisper_model_load(loader, *ctx, tensor_types, mapping)) {
         loader->close(loader->context);
         WHISPER_LOG_ERROR("%s: failed to load model\n", __func__);
+        delete mapping;
         delete ctx;
         return nullptr;
     }
 
     loader->close(loader->context);
 
+    if (ctx->model.mapping != mapping) {
+        delete mapping;
+    }
+
     return ctx;
 }
 
+struct whisper_context * whisper_init_with_params_no_state(struct whisper_model_loader * loader, struct whisper_context_params params) {
+    return whisper_init_with_params_no_state_impl(loader, params, {}, nullptr);
+}
+
 struct whisper_context * whisper_init_from_file_with_params(const char * path_model, struct whisper_context_params params) {
     whisper_context * ctx = whisper_init_from_file_with_params_no_state(path_model, params);
     if (!ctx) {
@@ -3372,6 +4381,8 @@ void whisper_free_state(struct whisper_state * state)
 
         whisper_batch_free(state->batch);
 
+        delete state->mel_stream;
+
         whisper_allocr_free(state->alloc_conv);
         whisper_allocr_free(state->alloc_encode);
         whisper_allocr_free(state->alloc_cross);
@@ -3393,6 +4404,8 @@ void whisper_free(struct whisper_context * ctx) {
             ggml_backend_buffer_free(ctx->model.buffer);
         }
 
+        delete ctx->model.mapping;
+
         whisper_free_state(ctx->state);
 
         ggml_backend_free(ctx->backend);
@@ -3479,6 +4492,162 @@ int whisper_set_mel(
     return whisper_set_mel_with_state(ctx, ctx->state, data, n_len, n_mel);
 }
 
+int whisper_stream_mel_reset_with_state(struct whisper_context * ctx, struct whisper_state * state, int n_frames_max) {
+    if (state->mel_stream == nullptr) {
+        state->mel_stream = new whisper_mel_stream;
+    }
+
+    // by default, keep the frames of one 30 second chunk
+    state->mel_stream->init(ctx->model.filters.n_mel, n_frames_max > 0 ? n_frames_max : WHISPER_CHUNK_SIZE*WHISPER_SAMPLE_RATE/WHISPER_HOP_LENGTH);
+
+    return 0;
+}
+
+int whisper_stream_mel_reset(struct whisper_context * ctx, int n_frames_max) {
+    return whisper_stream_mel_reset_with_state(ctx, ctx->state, n_frames_max);
+}
+
+int whisper_stream_mel_push_with_state(struct whisper_context * ctx, struct whisper_state * state, const float * samples, int n_samples, int n_threads) {
+    if (n_samples < 0) {
+        WHISPER_LOG_ERROR("%s: invalid number of samples: %d\n", __func__, n_samples);
+        return -1;
+    }
+
+    if (state->mel_stream == nullptr) {
+        whisper_stream_mel_reset_with_state(ctx, state, 0);
+    }
+
+    const int64_t t_start_us = ggml_time_us();
+
+    auto & ms = *state->mel_stream;
+
+    const int pad = WHISPER_N_FFT/2;
+
+    ms.pcm.insert(ms.pcm.end(), samples, samples + n_samples);
+    ms.n_samples += n_samples;
+
+    // reflective pad 200 samples at the beginning of the stream
+    if (!ms.padded) {
+        if (ms.n_samples <= pad) {
+            return 0;
+        }
+
+        std::vector<float> reflection(pad);
+        std::reverse_copy(ms.pcm.begin() + 1, ms.pcm.begin() + 1 + pad, reflection.begin());
+        ms.pcm.insert(ms.pcm.begin(), reflection.begin(), reflection.end());
+        ms.padded = true;
+    }
+
+    // the frames whose windows are complete now - the ones that would not fit in the ring buffer are not computed
+    const int64_t f1 = 1 + (ms.n_samples + pad - WHISPER_N_FFT)/WHISPER_HOP_LENGTH;
+    const int64_t f0 = std::max(ms.n_frames, f1 - ms.n_cap);
+
+    if (f1 > f0) {
+        const int n_workers = (int) std::max<int64_t>(1, std::min<int64_t>(n_threads, f1 - f0));
+
+        std::vector<std::thread> workers(n_workers - 1);
+        for (int iw = 0; iw < n_workers - 1; ++iw) {
+            workers[iw] = std::thread(
+                    whisper_mel_stream_worker_thread, iw + 1, n_workers, std::ref(ms), std::cref(ctx->model.filters), f0, f1);
+        }
+
+        // main thread
+        whisper_mel_stream_worker_thread(0, n_workers, ms, ctx->model.filters, f0, f1);
+
+        for (int iw = 0; iw < n_workers - 1; ++iw) {
+            workers[iw].join();
+        }
+    }
+
+    // drop the samples that are not needed by the next frames
+    const int n_new = (int) (f1 - ms.n_frames);
+
+    ms.pcm.erase(ms.pcm.begin(), ms.pcm.begin() + (size_t) n_new*WHISPER_HOP_LENGTH);
+    ms.n_frames = f1;
+
+    const int64_t t_mel_us = ggml_time_us() - t_start_us;
+
+    state->t_mel_us += t_mel_us;
+    whisper_timings_hist_add(state->hist_mel, t_mel_us);
+
+    return n_new;
+}
+
+int whisper_stream_mel_push(struct whisper_context * ctx, const float * samples, int n_samples, int n_threads) {
+    return whisper_stream_mel_push_with_state(ctx, ctx->state, samples, n_samples, n_threads);
+}
+
+int whisper_stream_mel_view_with_state(struct whisper_context * ctx, struct whisper_state * state, int n_frames) {
+    if (state->mel_stream == nullptr) {
+        WHISPER_LOG_ERROR("%s: no audio has been pushed, call whisper_stream_mel_push() first\n", __func__);
+        return -1;
+    }
+
+    const int64_t t_start_us = ggml_time_us();
+
+    const auto & ms = *state->mel_stream;
+
+    const int pad   = WHISPER_N_FFT/2;
+    const int n_fft = 1 + WHISPER_N_FFT/2;
+
+    // the last complete frames
+    int n_view = (int) std::min<int64_t>(ms.n_frames, ms.n_cap);
+    if (n_frames > 0) {
+        n_view = std::min(n_view, n_frames);
+    }
+
+    // followed by the frames that extend past the last sample, zero padded, and by 30 seconds of silence - the same
+    // frames as in the spectrogram of whisper_pcm_to_mel()
+    const int n_tail = ms.padded ? (int) ((ms.n_samples + pad)/WHISPER_HOP_LENGTH + 1 - ms.n_frames) : 0;
+    const int n_pad  = (int) ((ms.n_samples + WHISPER_CHUNK_SIZE*WHISPER_SAMPLE_RATE)/WHISPER_HOP_LENGTH - ms.n_frames - n_tail);
+
+    whisper_mel & mel = state->mel;
+
+    mel.n_mel     = ms.n_mel;
+    mel.n_len     = n_view + n_tail + n_pad;
+    mel.n_len_org = n_view;
+    mel.data.resize(mel.n_mel * mel.n_len);
+
+    const int64_t f0 = ms.n_frames - n_view;
+    for (int i = 0; i < n_view; ++i) {
+        const float * src = ms.ring.data() + ((f0 + i) % ms.n_cap)*ms.n_mel;
+        for (int j = 0; j < mel.n_mel; ++j) {
+            mel.data[j * mel.n_len + i] = src[j];
+        }
+    }
+
+    if (n_tail > 0) {
+        whisper_fft_scratch scratch;
+        scratch.init(ms.plan);
+
+        std::vector<float> fft_out(n_fft);
+
+        for (int i = 0; i < n_tail; ++i) {
+            const int offset = i*WHISPER_HOP_LENGTH;
+
+            whisper_fft_power_spectrum(ms.plan, scratch, ms.hann.data(), ms.pcm.data() + offset, std::min<int>(WHISPER_N_FFT, ms.pcm.size() - offset), fft_out.data());
+            whisper_mel_frame(fft_out.data(), n_fft, ctx->model.filters, mel.n_mel, mel.data.data() + n_view + i, mel.n_len);
+        }
+    }
+
+    for (int j = 0; j < mel.n_mel; ++j) {
+        std::fill(mel.data.begin() + j*mel.n_len + n_view + n_tail, mel.data.begin() + (j + 1)*mel.n_len, log10(1e-10));
+    }
+
+    log_mel_spectrogram_normalize(mel);
+
+    const int64_t t_mel_us = ggml_time_us() - t_start_us;
+
+    state->t_mel_us += t_mel_us;
+    whisper_timings_hist_add(state->hist_mel, t_mel_us);
+
+    return n_view;
+}
+
+int whisper_stream_mel_view(struct whisper_context * ctx, int n_frames) {
+    return whisper_stream_mel_view_with_state(ctx, ctx->state, n_frames);
+}
+
 int whisper_encode_with_state(struct whisper_context * ctx, struct whisper_state * state, int offset, int n_threads) {
     if (!whisper_encode_internal(*ctx, *state, offset, n_threads, nullptr, nullptr)) {
         WHISPER_LOG_ERROR("%s: failed to eval\n", __func__);
@@ -3497,6 +4666,166 @@ int whisper_encode(struct whisper_context * ctx, int offset, int n_threads) {
     return 0;
 }
 
+struct whisper_encoder_batch * whisper_encoder_batch_init(struct whisper_context * ctx, int n_batch_max) {
+    if (n_batch_max < 1) {
+        WHISPER_LOG_ERROR("%s: invalid batch size %d\n", __func__, n_batch_max);
+        return nullptr;
+    }
+
+    whisper_encoder_batch * batch = new whisper_encoder_batch;
+
+    batch->n_batch_max = n_batch_max;
+
+    batch->backend = whisper_backend_init(ctx->params);
+
+    const int n_ctx = ctx->model.hparams.n_audio_ctx;
+
+    // conv allocator
+    {
+        std::vector<whisper_state *> states(n_batch_max, nullptr);
+        std::vector<int> offsets(n_batch_max, 0);
+
+        whisper_allocr_graph_init(batch->alloc_conv, ctx->backend,
+                [&]() {
+                    return whisper_build_graph_conv_batch(*ctx, *batch, states.data(), offsets.data(), n_batch_max, n_ctx);
+                });
+
+        WHISPER_LOG_INFO("%s: compute buffer (conv)   = %7.2f MB\n", __func__, whisper_allocr_size(batch->alloc_conv) / 1e6);
+    }
+
+    // encoder allocator
+    {
+        whisper_allocr_graph_init(batch->alloc_encode, ctx->backend,
+                [&]() {
+                    return whisper_build_graph_encoder(*ctx, batch->alloc_encode, batch->embd_conv, n_ctx, n_batch_max, &batch->embd_enc);
+                });
+
+        WHISPER_LOG_INFO("%s: compute buffer (encode) = %7.2f MB\n", __func__, whisper_allocr_size(batch->alloc_encode) / 1e6);
+    }
+
+    whisper_allocr_graph_realloc(batch->alloc_conv,   ctx->backend);
+    whisper_allocr_graph_realloc(batch->alloc_encode, ctx->backend);
+
+    batch->meta_views.resize(ggml_tensor_overhead()*n_batch_max);
+
+    return batch;
+}
+
+void whisper_encoder_batch_free(struct whisper_encoder_batch * batch) {
+    if (batch) {
+        whisper_allocr_free(batch->alloc_conv);
+        whisper_allocr_free(batch->alloc_encode);
+
+        ggml_backend_free(batch->backend);
+
+        delete batch;
+    }
+}
+
+int whisper_encode_batch(
+        struct whisper_context * ctx,
+  struct whisper_encoder_batch * batch,
+          struct whisper_state ** states,
+                     const int * offsets,
+                           int   n_states,
+                           int   n_threads) {
+    if (n_states < 1 || n_states > batch->n_batch_max) {
+        WHISPER_LOG_ERROR("%s: invalid number of states %d (batch size %d)\n", __func__, n_states, batch->n_batch_max);
+        return -1;
+    }
+
+    const auto & hparams = ctx->model.hparams;
+
+    const int n_ctx = states[0]->exp_n_audio_ctx > 0 ? states[0]->exp_n_audio_ctx : hparams.n_audio_ctx;
+
+    bool is_external = false;
+
+    for (int i = 0; i < n_states; ++i) {
+        const int n_ctx_cur = states[i]->exp_n_audio_ctx > 0 ? states[i]->exp_n_audio_ctx : hparams.n_audio_ctx;
+        if (n_ctx_cur != n_ctx) {
+            WHISPER_LOG_ERROR("%s: all states must use the same audio context (%d != %d)\n", __func__, n_ctx_cur, n_ctx);
+            return -1;
+        }
+        if (states[i]->mel.n_mel != hparams.n_mels) {
+            WHISPER_LOG_ERROR("%s: state %d has no mel spectrogram\n", __func__, i);
+            return -1;
+        }
+        is_external = is_external || whisper_encode_external(*states[i]);
+    }
+
+    // external encoders (Core ML, OpenVINO) run one state at a time
+    if (is_external) {
+        for (int i = 0; i < n_states; ++i) {
+            if (!whisper_encode_internal(*ctx, *states[i], offsets[i], n_threads, nullptr, nullptr)) {
+                WHISPER_LOG_ERROR("%s: failed to eval\n", __func__);
+                return -1;
+            }
+        }
+
+        return 0;
+    }
+
+    const int64_t t_start_us = ggml_time_us();
+
+    // conv
+    {
+        auto & alloc = batch->alloc_conv.alloc;
+
+        ggml_allocr_reset(alloc);
+
+        ggml_cgraph * gf = whisper_build_graph_conv_batch(*ctx, *batch, states, offsets, n_states, n_ctx);
+
+        ggml_allocr_alloc_graph(alloc, gf);
+
+        ggml_graph_compute_helper(batch->backend, gf, n_threads);
+    }
+
+    // encoder
+    {
+        auto & alloc = batch->alloc_encode.alloc;
+
+        ggml_allocr_reset(alloc);
+
+        ggml_cgraph * gf = whisper_build_graph_encoder(*ctx, batch->alloc_encode, batch->embd_conv, n_ctx, n_states, &batch->embd_enc);
+
+        ggml_allocr_alloc_graph(alloc, gf);
+
+        ggml_graph_compute_helper(batch->backend, gf, n_threads);
+    }
+
+    // cross, each state from its part of the output
+    {
+        struct ggml_init_params params = {
+            /*.mem_size   =*/ batch->meta_views.size(),
+            /*.mem_buffer =*/ batch->meta_views.data(),
+            /*.no_alloc   =*/ true,
+        };
+
+        struct ggml_context * ctx_views = ggml_init(params);
+
+        const size_t nb1 = batch->embd_enc->nb[1];
+
+        for (int i = 0; i < n_states; ++i) {
+            states[i]->embd_enc = ggml_view_2d(ctx_views, batch->embd_enc, hparams.n_audio_state, n_ctx, nb1, i*n_ctx*nb1);
+
+            whisper_encode_cross(*ctx, *states[i], n_threads);
+        }
+
+        ggml_free(ctx_views);
+    }
+
+    // each state waited for the whole batch
+    const int64_t t_encode_us = ggml_time_us() - t_start_us;
+
+    for (int i = 0; i < n_states; ++i) {
+        states[i]->t_encode_us += t_encode_us;
+        states[i]->n_encode++;
+        whisper_timings_hist_add(states[i]->hist_encode, t_encode_us);
+    }
+
+    return 0;
+}
+
 int whisper_decode_with_state(struct whisper_context * ctx, struct whisper_state * state, const whisper_token * tokens, int n_tokens, int n_past, int n_threads) {
     whisper_batch_prep_legacy(state->batch, tokens, n_tokens, n_past, 0);
 
@@ -3520,7 +4849,7 @@ int whisper_decode(struct whisper_context * ctx, const whisper_token * tokens, i
 }
 
 int whisper_tokenize(struct whisper_context * ctx, const char * text, whisper_token * tokens, int n_max_tokens) {
-    const auto res = tokenize(ctx->vocab, text);
+    const auto res = whisper_tokenize_cached(ctx, text);
 
     if (n_max_tokens < (int) res.size()) {
         WHISPER_LOG_ERROR("%s: too many resulting tokens: %d (max %d)\n", __func__, (int) res.size(), n_max_tokens);
@@ -3618,17 +4947,15 @@ int whisper_lang_auto_detect_with_state(
         logits_id.emplace_back(state->logits[token_lang], kv.second.first);
     }
 
-    // sort descending
-    {
-        using pair_type = std::remove_reference<decltype(logits_id)>::type::value_type;
-        std::sort(logits_id.begin(), logits_id.end(), [](const pair_type & a, const pair_type & b) {
-            return a.first > b.first;
-        });
-    }
+    // the most likely language - the softmax does not need the others in order
+    using pair_type = std::remove_reference<decltype(logits_id)>::type::value_type;
+    const pair_type lang_max = *std::max_element(logits_id.begin(), logits_id.end(), [](const pair_type & a, const pair_type & b) {
+        return a.first < b.first;
+    });
 
     // softmax
     {
-        const auto max = logits_id[0].first;
+        const auto max = lang_max.first;
 
         double sum = 0.0f;
         for (auto & kv : logits_id) {
@@ -3651,7 +4978,7 @@ int whisper_lang_auto_detect_with_state(
         }
     }
 
-    return logits_id[0].second;
+    return lang_max.second;
 }
 
 int whisper_lang_auto_detect(
@@ -3710,6 +5037,10 @@ int whisper_model_type(struct whisper_context * ctx) {
     return ctx->model.type;
 }
 
+size_t whisper_model_size(struct whisper_context * ctx) {
+    return ggml_backend_buffer_get_size(ctx->model.buffer);
+}
+
 const char *whisper_model_type_readable(struct whisper_context * ctx) {
     switch (ctx->model.type) {
     case e_model::MODEL_TINY:
@@ -3816,31 +5147,122 @@ void whisper_print_timings(struct whisper_context * ctx) {
         const int32_t n_batchd = std::max(1, ctx->state->n_batchd);
         const int32_t n_prompt = std::max(1, ctx->state->n_prompt);
 
-        WHISPER_LOG_INFO("%s:     fallbacks = %3d p / %3d h\n", __func__, ctx->state->n_fail_p, ctx->state->n_fail_h);
-        WHISPER_LOG_INFO("%s:      mel time = %8.2f ms\n", __func__, ctx->state->t_mel_us / 1000.0f);
-        WHISPER_LOG_INFO("%s:   sample time = %8.2f ms / %5d runs (%8.2f ms per run)\n", __func__, 1e-3f * ctx->state->t_sample_us, n_sample, 1e-3f * ctx->state->t_sample_us / n_sample);
-        WHISPER_LOG_INFO("%s:   encode time = %8.2f ms / %5d runs (%8.2f ms per run)\n", __func__, 1e-3f * ctx->state->t_encode_us, n_encode, 1e-3f * ctx->state->t_encode_us / n_encode);
-        WHISPER_LOG_INFO("%s:   decode time = %8.2f ms / %5d runs (%8.2f ms per run)\n", __func__, 1e-3f * ctx->state->t_decode_us, n_decode, 1e-3f * ctx->state->t_decode_us / n_decode);
-        WHISPER_LOG_INFO("%s:   batchd time = %8.2f ms / %5d runs (%8.2f ms per run)\n", __func__, 1e-3f * ctx->state->t_batchd_us, n_batchd, 1e-3f * ctx->state->t_batchd_us / n_batchd);
-        WHISPER_LOG_INFO("%s:   prompt time = %8.2f ms / %5d runs (%8.2f ms per run)\n", __func__, 1e-3f * ctx->state->t_prompt_us, n_prompt, 1e-3f * ctx->state->t_prompt_us / n_prompt);
+        WHISPER_LOG_INFO("%s:     fallbacks = %3d p / %3d h\n", __func__, ctx->state->n_fail_p, ctx->state->n_fail_h);
+        WHISPER_LOG_INFO("%s:      mel time = %8.2f ms\n", __func__, ctx->state->t_mel_us / 1000.0f);
+        WHISPER_LOG_INFO("%s:   sample time = %8.2f ms / %5d runs (%8.2f ms per run)\n", __func__, 1e-3f * ctx->state->t_sample_us, n_sample, 1e-3f * ctx->state->t_sample_us / n_sample);
+        WHISPER_LOG_INFO("%s:   encode time = %8.2f ms / %5d runs (%8.2f ms per run)\n", __func__, 1e-3f * ctx->state->t_encode_us, n_encode, 1e-3f * ctx->state->t_encode_us / n_encode);
+        WHISPER_LOG_INFO("%s:   decode time = %8.2f ms / %5d runs (%8.2f ms per run)\n", __func__, 1e-3f * ctx->state->t_decode_us, n_decode, 1e-3f * ctx->state->t_decode_us / n_decode);
+        WHISPER_LOG_INFO("%s:   batchd time = %8.2f ms / %5d runs (%8.2f ms per run)\n", __func__, 1e-3f * ctx->state->t_batchd_us, n_batchd, 1e-3f * ctx->state->t_batchd_us / n_batchd);
+        WHISPER_LOG_INFO("%s:   prompt time = %8.2f ms / %5d runs (%8.2f ms per run)\n", __func__, 1e-3f * ctx->state->t_prompt_us, n_prompt, 1e-3f * ctx->state->t_prompt_us / n_prompt);
+    }
+    WHISPER_LOG_INFO("%s:    total time = %8.2f ms\n", __func__, (t_end_us - ctx->t_start_us)/1000.0f);
+}
+
+static void whisper_reset_timings_state(struct whisper_state * state) {
+    state->t_mel_us = 0;
+    state->t_sample_us = 0;
+    state->t_encode_us = 0;
+    state->t_decode_us = 0;
+    state->t_batchd_us = 0;
+    state->t_prompt_us = 0;
+    state->n_sample = 0;
+    state->n_encode = 0;
+    state->n_decode = 0;
+    state->n_batchd = 0;
+    state->n_prompt = 0;
+    state->n_fail_p = 0;
+    state->n_fail_h = 0;
+    memset(state->hist_mel,    0, sizeof(state->hist_mel));
+    memset(state->hist_encode, 0, sizeof(state->hist_encode));
+    memset(state->hist_decode, 0, sizeof(state->hist_decode));
+    memset(state->hist_batchd, 0, sizeof(state->hist_batchd));
+    memset(state->hist_prompt, 0, sizeof(state->hist_prompt));
+    memset(state->hist_sample, 0, sizeof(state->hist_sample));
+}
+
+void whisper_reset_timings(struct whisper_context * ctx) {
+    ctx->t_start_us = ggml_time_us();
+    if (ctx->state != nullptr) {
+        whisper_reset_timings_state(ctx->state);
+    }
+}
+
+struct whisper_timings whisper_get_timings_with_state(struct whisper_context * ctx, struct whisper_state * state) {
+    struct whisper_timings result = {};
+
+    result.load_ms  = 1e-3f*ctx->t_load_us;
+    result.total_ms = 1e-3f*(ggml_time_us() - ctx->t_start_us);
+    result.backend  = ctx->backend ? ggml_backend_name(ctx->backend) : "CPU";
+
+    if (state == nullptr) {
+        return result;
+    }
+
+    result.mel_ms    = 1e-3f*state->t_mel_us;
+    result.sample_ms = 1e-3f*state->t_sample_us;
+    result.encode_ms = 1e-3f*state->t_encode_us;
+    result.decode_ms = 1e-3f*state->t_decode_us;
+    result.batchd_ms = 1e-3f*state->t_batchd_us;
+    result.prompt_ms = 1e-3f*state->t_prompt_us;
+
+    result.n_sample = state->n_sample;
+    result.n_encode = state->n_encode;
+    result.n_decode = state->n_decode;
+    result.n_batchd = state->n_batchd;
+    result.n_prompt = state->n_prompt;
+    result.n_fail_p = state->n_fail_p;
+    result.n_fail_h = state->n_fail_h;
+
+    memcpy(result.hist_mel,    state->hist_mel,    sizeof(result.hist_mel));
+    memcpy(result.hist_encode, state->hist_encode, sizeof(result.hist_encode));
+    memcpy(result.hist_decode, state->hist_decode, sizeof(result.hist_decode));
+    memcpy(result.hist_batchd, state->hist_batchd, sizeof(result.hist_batchd));
+    memcpy(result.hist_prompt, state->hist_prompt, sizeof(result.hist_prompt));
+    memcpy(result.hist_sample, state->hist_sample, sizeof(result.hist_sample));
+
+    return result;
+}
+
+struct whisper_timings whisper_get_timings(struct whisper_context * ctx) {
+    return whisper_get_timings_with_state(ctx, ctx->state);
+}
+
+struct whisper_memory whisper_get_memory_with_state(struct whisper_context * ctx, struct whisper_state * state) {
+    GGML_UNUSED(ctx);
+
+    struct whisper_memory result = {};
+
+    if (state == nullptr) {
+        return result;
+    }
+
+    if (state->kv_self.ctx) {
+        result.kv_self = ggml_nbytes(state->kv_self.k) + ggml_nbytes(state->kv_self.v);
+    }
+    if (state->kv_cross.ctx) {
+        result.kv_cross = ggml_nbytes(state->kv_cross.k) + ggml_nbytes(state->kv_cross.v);
+    }
+
+    result.compute_conv   = whisper_allocr_size(state->alloc_conv);
+    result.compute_encode = whisper_allocr_size(state->alloc_encode);
+    result.compute_cross  = whisper_allocr_size(state->alloc_cross);
+    result.compute_decode = whisper_allocr_size(state->alloc_decode);
+
+    result.output = state->logits.capacity()*sizeof(float);
+    for (const auto & decoder : state->decoders) {
+        result.output += (decoder.probs.capacity() + decoder.logits.capacity() + decoder.logprobs.capacity())*sizeof(float);
+        result.output += decoder.logits_id.capacity()*sizeof(decoder.logits_id[0]);
     }
-    WHISPER_LOG_INFO("%s:    total time = %8.2f ms\n", __func__, (t_end_us - ctx->t_start_us)/1000.0f);
+
+    result.total = result.kv_self + result.kv_cross +
+        result.compute_conv + result.compute_encode + result.compute_cross + result.compute_decode +
+        result.output;
+
+    return result;
 }
 
-void whisper_reset_timings(struct whisper_context * ctx) {
-    ctx->t_start_us = ggml_time_us();
-    if (ctx->state != nullptr) {
-        ctx->state->t_mel_us = 0;
-        ctx->state->t_sample_us = 0;
-        ctx->state->t_encode_us = 0;
-        ctx->state->t_decode_us = 0;
-        ctx->state->t_prompt_us = 0;
-        ctx->state->n_sample = 0;
-        ctx->state->n_encode = 0;
-        ctx->state->n_decode = 0;
-        ctx->state->n_batchd = 0;
-        ctx->state->n_prompt = 0;
-    }
+struct whisper_memory whisper_get_memory(struct whisper_context * ctx) {
+    return whisper_get_memory_with_state(ctx, ctx->state);
 }
 
 static int whisper_has_coreml(void) {
@@ -4351,6 +5773,11 @@ struct whisper_full_params whisper_full_default_params(enum whisper_sampling_str
 
         /*.tdrz_enable       =*/ false,
 
+        /*.vad                =*/ false,
+        /*.vad_thold          =*/ 0.3f,
+        /*.vad_min_silence_ms =*/ 1000,
+        /*.vad_pad_ms         =*/ 200,
+
         /*.initial_prompt    =*/ nullptr,
         /*.prompt_tokens     =*/ nullptr,
         /*.prompt_n_tokens   =*/ 0,
@@ -4389,6 +5816,9 @@ struct whisper_full_params whisper_full_default_params(enum whisper_sampling_str
         /*.encoder_begin_callback           =*/ nullptr,
         /*.encoder_begin_callback_user_data =*/ nullptr,
 
+        /*.encode_callback                  =*/ nullptr,
+        /*.encode_callback_user_data        =*/ nullptr,
+
         /*.abort_callback                   =*/ nullptr,
         /*.abort_callback_user_data         =*/ nullptr,
 
@@ -4491,17 +5921,117 @@ static int whisper_wrap_segment(struct whisper_context & ctx, struct whisper_sta
     return res;
 }
 
-static const std::vector<std::string> non_speech_tokens = {
-    "\"", "#", "(", ")", "*", "+", "/", ":", ";", "<", "=", ">", "@", "[", "\\", "]", "^",
-    "_", "`", "{", "|", "}", "~", "「", "」", "『", "』", "<<", ">>", "<<<", ">>>", "--",
-    "---", "-(", "-[", "('", "(\"", "((", "))", "(((", ")))", "[[", "]]", "{{", "}}", "♪♪",
-    "♪♪♪","♩", "♪", "♫", "♬", "♭", "♮", "♯"
-};
+// the logits post-processing runs over the whole vocab for each decoder and each token. Its loops are written so that
+// the compiler vectorizes them without -ffast-math:
+// - the loop bodies have no branches, the selects are bit masks
+// - the max is an integer reduction, and the sums are split over WHISPER_VEC_LANES independent partial sums
+#define WHISPER_VEC_LANES 8
+
+// exp(x) for x <= 0, within 1 ULP of expf
+// 0 below -87.33 where expf is denormal, and for -INFINITY
+// ref: the range reduction and the polynomial of the Cephes expf
+static inline float whisper_exp_f32(float x) {
+    // x = n*ln(2) + r, |r| <= ln(2)/2 - adding 1.5*2^23 rounds x/ln(2) to the integer n in the low bits of t
+    const float t = x*1.44269504088896341f + 12582912.0f;
+    const float n = t - 12582912.0f;
+    const float r = (x - n*0.693359375f) + n*2.12194440e-4f;
+
+    float p = 1.9875691500e-4f;
+    p = p*r + 1.3981999507e-3f;
+    p = p*r + 8.3334519073e-3f;
+    p = p*r + 4.1665795894e-2f;
+    p = p*r + 1.6666665459e-1f;
+    p = p*r + 5.0000001201e-1f;
+    p = p*r*r + r + 1.0f;
+
+    // 2^n
+    int32_t tb;
+    memcpy(&tb, &t, sizeof(tb));
+    const int32_t sb = (tb - 0x4b400000 + 127) << 23;
+    float s;
+    memcpy(&s, &sb, sizeof(s));
+
+    const float y = p*s;
+
+    // masked instead of a branch - the exponent of 2^n underflows below -87.33
+    int32_t yb;
+    memcpy(&yb, &y, sizeof(yb));
+    yb &= -(int32_t) (x >= -87.33654f);
+    float res;
+    memcpy(&res, &yb, sizeof(res));
+
+    return res;
+}
+
+// max of n values - the floats are mapped to integers of the same order
+static float whisper_vec_max_f32(const float * x, int n) {
+    int32_t max = INT32_MIN;
+    for (int i = 0; i < n; ++i) {
+        int32_t b;
+        memcpy(&b, &x[i], sizeof(b));
+        b ^= (b >> 31) & 0x7fffffff;
+        max = max > b ? max : b;
+    }
+
+    max ^= (max >> 31) & 0x7fffffff;
+
+    float res;
+    memcpy(&res, &max, sizeof(res));
+
+    return res;
+}
+
+// sum of exp(x[i] - max) over n values
+static float whisper_vec_sum_exp_f32(const float * x, float max, int n) {
+    float sums[WHISPER_VEC_LANES] = { 0.0f };
+
+    int i = 0;
+    for (; i + WHISPER_VEC_LANES <= n; i += WHISPER_VEC_LANES) {
+        for (int j = 0; j < WHISPER_VEC_LANES; ++j) {
+            sums[j] += whisper_exp_f32(x[i + j] - max);
+        }
+    }
+
+    float sum = 0.0f;
+    for (int j = 0; j < WHISPER_VEC_LANES; ++j) {
+        sum += sums[j];
+    }
+    for (; i < n; ++i) {
+        sum += whisper_exp_f32(x[i] - max);
+    }
+
+    return sum;
+}
+
+// log(sum(exp(x))) of n values, -INFINITY if they are all -INFINITY
+// the -INFINITY values of the suppressed tokens add 0 to the sum
+static float whisper_logsumexp(const float * x, int n) {
+    const float max = whisper_vec_max_f32(x, n);
+
+    if (max == -INFINITY) {
+        return -INFINITY;
+    }
+
+    return logf(whisper_vec_sum_exp_f32(x, max, n)) + max;
+}
+
+// y = log_softmax(x) over n values, the -INFINITY values stay -INFINITY
+static void whisper_log_softmax(const float * x, float * y, int n) {
+    const float lse = whisper_logsumexp(x, n);
+
+    if (lse == -INFINITY) {
+        std::fill(y, y + n, -INFINITY);
+        return;
+    }
+
+    for (int i = 0; i < n; ++i) {
+        y[i] = x[i] - lse;
+    }
+}
 
 // process the logits for the selected decoder
 // - applies logit filters
 // - computes logprobs and probs
-// TODO: optimize
 static void whisper_process_logits(
               struct whisper_context & ctx,
                struct whisper_state  & state,
@@ -4586,21 +6116,8 @@ static void whisper_process_logits(
         // suppress non-speech tokens
         // ref: https://github.com/openai/whisper/blob/7858aa9c08d98f75575035ecd6481f462d66ca27/whisper/tokenizer.py#L224-L253
         if (params.suppress_non_speech_tokens) {
-            for (const std::string & token : non_speech_tokens) {
-                const std::string suppress_tokens[] = {token, " " + token};
-                for (const std::string & suppress_token : suppress_tokens) {
-                    if (vocab.token_to_id.find(suppress_token) != vocab.token_to_id.end()) {
-                        logits[vocab.token_to_id.at(suppress_token)] = -INFINITY;
-                    }
-                }
-            }
-
-            // allow hyphens "-" and single quotes "'" between words, but not at the beginning of a word
-            if (vocab.token_to_id.find(" -") != vocab.token_to_id.end()) {
-                logits[vocab.token_to_id.at(" -")] = -INFINITY;
-            }
-            if (vocab.token_to_id.find(" '") != vocab.token_to_id.end()) {
-                logits[vocab.token_to_id.at(" '")] = -INFINITY;
+            for (const auto id : vocab.non_speech) {
+                logits[id] = -INFINITY;
             }
         }
 
@@ -4647,44 +6164,15 @@ static void whisper_process_logits(
         }
 
         // populate the logprobs array (log_softmax)
-        {
-            const float logit_max = *std::max_element(logits.begin(), logits.end());
-            float logsumexp = 0.0f;
-            for (int i = 0; i < n_logits; ++i) {
-                if (logits[i] > -INFINITY) {
-                    logsumexp += expf(logits[i] - logit_max);
-                }
-            }
-            logsumexp = logf(logsumexp) + logit_max;
-
-            for (int i = 0; i < n_logits; ++i) {
-                if (logits[i] > -INFINITY) {
-                    logprobs[i] = logits[i] - logsumexp;
-                } else {
-                    logprobs[i] = -INFINITY;
-                }
-            }
-        }
+        whisper_log_softmax(logits.data(), logprobs.data(), n_logits);
 
         // if sum of probability over timestamps is above any other token, sample timestamp
         // ref: https://github.com/openai/whisper/blob/0b1ba3d46ebf7fe6f953acfd8cad62a4f851b49f/whisper/decoding.py#L431-L437
         {
             // logsumexp over timestamps
-            float timestamp_logprob = -INFINITY;
-            {
-                float logsumexp = 0.0f;
-                const float logprob_max = *std::max_element(logprobs.begin() + vocab.token_beg, logprobs.end());
-                for (int i = vocab.token_beg; i < n_logits; ++i) {
-                    if (logprobs[i] > -INFINITY) {
-                        logsumexp += expf(logprobs[i] - logprob_max);
-                    }
-                }
-                if (logsumexp > 0.0f) {
-                    timestamp_logprob = logf(logsumexp) + logprob_max;
-                }
-            }
+            const float timestamp_logprob = whisper_logsumexp(logprobs.data() + vocab.token_beg, n_logits - vocab.token_beg);
 
-            const float max_text_token_logprob = *std::max_element(logprobs.begin(), logprobs.begin() + vocab.token_beg);
+            const float max_text_token_logprob = whisper_vec_max_f32(logprobs.data(), vocab.token_beg);
 
             //WHISPER_LOG_INFO("timestamp_logprob=%f max_text_token_logprob=%f\n", timestamp_logprob, max_text_token_logprob);
 
@@ -4698,24 +6186,7 @@ static void whisper_process_logits(
                     whisper_suppress_invalid_grammar(ctx, params, logits, decoder.grammar);
 
                     // populate the logprobs array (log_softmax)
-                    {
-                        const float logit_max = *std::max_element(logits.begin(), logits.end());
-                        float logsumexp = 0.0f;
-                        for (int i = 0; i < n_logits; ++i) {
-                            if (logits[i] > -INFINITY) {
-                                logsumexp += expf(logits[i] - logit_max);
-                            }
-                        }
-                        logsumexp = logf(logsumexp) + logit_max;
-
-                        for (int i = 0; i < n_logits; ++i) {
-                            if (logits[i] > -INFINITY) {
-                                logprobs[i] = logits[i] - logsumexp;
-                            } else {
-                                logprobs[i] = -INFINITY;
-                            }
-                        }
-                    }
+                    whisper_log_softmax(logits.data(), logprobs.data(), n_logits);
                 }
             }
         }
@@ -4723,12 +6194,9 @@ static void whisper_process_logits(
 
     // compute probs
     {
+        // the probs of the suppressed tokens are exp(-INFINITY) = 0
         for (int i = 0; i < n_logits; ++i) {
-            if (logits[i] == -INFINITY) {
-                probs[i] = 0.0f;
-            } else {
-                probs[i] = expf(logprobs[i]);
-            }
+            probs[i] = whisper_exp_f32(logprobs[i]);
         }
     }
 
@@ -4852,29 +6320,10 @@ static std::vector<whisper_token_data> whisper_sample_token_topk(
     const auto & vocab = ctx.vocab;
 
     const auto & probs    = decoder.probs;
-    const auto & logits   = decoder.logits;
     const auto & logprobs = decoder.logprobs;
 
     const int n_logits = vocab.n_vocab;
 
-    auto & logits_id = decoder.logits_id;
-
-    logits_id.resize(n_logits);
-    for (int i = 0; i < n_logits; ++i) {
-        logits_id[i].first = logits[i];
-        logits_id[i].second = i;
-    }
-
-    {
-        using pair_type = std::remove_reference<decltype(logits_id)>::type::value_type;
-        std::partial_sort(
-                logits_id.begin(),
-                logits_id.begin() + k, logits_id.end(),
-                [](const pair_type & a, const pair_type & b) {
-            return a.first > b.first;
-        });
-    }
-
     std::vector<whisper_token_data> result;
     result.reserve(k);
 
@@ -4969,6 +6418,187 @@ static void whisper_sequence_score(
     }
 }
 
+// a span of speech frames, kept by the VAD pre-pass - the last one is the rest of the spectrogram after seek_end
+struct whisper_vad_span {
+    int c0; // first frame in the compacted spectrogram
+    int o0; // first frame in the original spectrogram
+    int n;
+};
+
+// drop the frames without speech in [seek_start, seek_end) of the spectrogram, and return the new seek_end
+//
+// the energy of a frame is the mean of its log mel bands, and the spectral flux the mean of their increase since the
+// previous frame, both smoothed over 110 ms. A frame is speech when its energy is above vad_thold of the range between
+// the noise floor (10th percentile) and the peak (95th percentile), or when it is an onset - a flux of twice the mean,
+// with half that energy. The speech is padded with vad_pad_ms on each side, and the pauses shorter than
+// vad_min_silence_ms are kept, so that the words are not glued together
+static int whisper_vad_compact(whisper_mel & mel, int seek_start, int seek_end, const whisper_full_params & params, std::vector<whisper_vad_span> & spans) {
+    spans.clear();
+
+    const int n_mel = mel.n_mel;
+    const int n     = seek_end - seek_start;
+
+    if (n < 200) {
+        return seek_end;
+    }
+
+    std::vector<float> energy(n, 0.0f);
+    std::vector<float> flux  (n, 0.0f);
+
+    for (int j = 0; j < n_mel; ++j) {
+        const float * row = mel.data.data() + (size_t) j*mel.n_len + seek_start;
+        for (int i = 0; i < n; ++i) {
+            energy[i] += row[i];
+            if (i > 0) {
+                flux[i] += std::max(0.0f, row[i] - row[i - 1]);
+            }
+        }
+    }
+
+    const int n_smooth = 5;
+
+    const auto smooth = [n, n_smooth](std::vector<float> & x) {
+        std::vector<float> res(n);
+        double sum = 0.0;
+        int lo = 0;
+        int hi = 0;
+        for (int i = 0; i < n; ++i) {
+            while (hi < n && hi <= i + n_smooth) {
+                sum += x[hi++];
+            }
+            while (lo < i - n_smooth) {
+                sum -= x[lo++];
+            }
+            res[i] = sum/(hi - lo);
+        }
+        x = std::move(res);
+    };
+
+    smooth(energy);
+    smooth(flux);
+
+    std::vector<float> sorted = energy;
+    std::sort(sorted.begin(), sorted.end());
+
+    const float e_floor = sorted[n/10];
+    const float e_peak  = sorted[(95*n)/100];
+
+    // no quiet parts to drop
+    if (e_peak - e_floor < 1e-3f*n_mel) {
+        return seek_end;
+    }
+
+    double flux_mean = 0.0;
+    for (int i = 0; i < n; ++i) {
+        flux_mean += flux[i];
+    }
+    flux_mean /= n;
+
+    const float e_thold = e_floor + params.vad_thold*(e_peak - e_floor);
+    const float o_thold = e_floor + 0.5f*params.vad_thold*(e_peak - e_floor);
+
+    std::vector<bool> speech(n, false);
+    for (int i = 0; i < n; ++i) {
+        speech[i] = energy[i] > e_thold || (flux[i] > 2.0*flux_mean && energy[i] > o_thold);
+    }
+
+    // speech padding - a frame is kept when there is speech within n_pad frames
+    const int n_pad         = std::max(0, params.vad_pad_ms/10);
+    const int n_min_silence = std::max(0, params.vad_min_silence_ms/10);
+
+    std::vector<bool> keep(n, false);
+    {
+        int last = -1 - n_pad;
+        for (int i = 0; i < n; ++i) {
+            if (speech[i]) {
+                last = i;
+            }
+            keep[i] = i - last <= n_pad;
+        }
+        last = n + n_pad;
+        for (int i = n - 1; i >= 0; --i) {
+            if (speech[i]) {
+                last = i;
+            }
+            keep[i] = keep[i] || last - i <= n_pad;
+        }
+    }
+
+    // the spans of speech, with the short pauses between them
+    int n_keep = 0;
+    for (int i = 0; i < n; ) {
+        if (!keep[i]) {
+            ++i;
+            continue;
+        }
+
+        int i1 = i;
+        while (i1 < n && keep[i1]) {
+            ++i1;
+        }
+
+        if (!spans.empty() && i - (spans.back().o0 + spans.back().n - seek_start) < n_min_silence) {
+            const int n_add = i1 - (spans.back().o0 + spans.back().n - seek_start);
+            spans.back().n += n_add;
+            n_keep         += n_add;
+        } else {
+            spans.push_back({ seek_start + n_keep, seek_start + i, i1 - i });
+            n_keep += i1 - i;
+        }
+
+        i = i1;
+    }
+
+    const int n_drop = n - n_keep;
+
+    // not worth it - keep the whole audio
+    if (n_drop < 100) {
+        spans.clear();
+        return seek_end;
+    }
+
+    WHISPER_LOG_INFO("%s: VAD kept %d ms of speech in %d spans, dropped %d ms\n", __func__, n_keep*10, (int) spans.size(), n_drop*10);
+
+    // frames before seek_start, the spans, and the frames from seek_end, including the padding
+    const int n_len = mel.n_len - n_drop;
+
+    std::vector<float> data((size_t) n_mel*n_len);
+    for (int j = 0; j < n_mel; ++j) {
+        const float * src = mel.data.data() + (size_t) j*mel.n_len;
+              float * dst = data.data()     + (size_t) j*n_len;
+
+        memcpy(dst, src, seek_start*sizeof(float));
+        for (const auto & span : spans) {
+            memcpy(dst + span.c0, src + span.o0, span.n*sizeof(float));
+        }
+        memcpy(dst + seek_start + n_keep, src + seek_end, (mel.n_len - seek_end)*sizeof(float));
+    }
+
+    mel.data       = std::move(data);
+    mel.n_len      = n_len;
+    mel.n_len_org -= n_drop;
+
+    // the frames from seek_end
+    spans.push_back({ seek_start + n_keep, seek_end, mel.n_len - (seek_start + n_keep) });
+
+    return seek_end - n_drop;
+}
+
+// map a time (in 10 ms, i.e. frames) of the compacted spectrogram back to the input audio - a time at the boundary
+// of two spans is the end of the first one when is_end, and the start of the second otherwise
+static int64_t whisper_vad_map(const std::vector<whisper_vad_span> & spans, int64_t t, bool is_end) {
+    if (spans.empty() || t < spans.front().c0) {
+        return t;
+    }
+
+    int k = (int) spans.size() - 1;
+    while (k > 0 && (is_end ? spans[k].c0 >= t : spans[k].c0 > t)) {
+        --k;
+    }
+
+    return spans[k].o0 + std::min<int64_t>(t - spans[k].c0, spans[k].n);
+}
+
 int whisper_full_with_state(
         struct whisper_context * ctx,
           struct whisper_state * state,
@@ -5016,13 +6646,24 @@ int whisper_full_with_state(
         state->t_beg    = 0;
         state->t_last   = 0;
         state->tid_last = 0;
+        // without the PCM signal (a mel spectrogram set with whisper_set_mel or computed incrementally), the
+        // timestamps are not refined with the signal energy - an energy left from a previous call would not match
         if (n_samples > 0) {
             state->energy = get_signal_energy(samples, n_samples, 32);
+        } else {
+            state->energy.clear();
         }
     }
 
     const int seek_start = params.offset_ms/10;
-    const int seek_end = params.duration_ms == 0 ? whisper_n_len_from_state(state) : seek_start + params.duration_ms/10;
+    int seek_end = params.duration_ms == 0 ? whisper_n_len_from_state(state) : seek_start + params.duration_ms/10;
+
+    // drop the parts without speech of the spectrogram computed above - the timestamps of the segments are mapped
+    // back to the input audio
+    std::vector<whisper_vad_span> vad_spans;
+    if (params.vad && n_samples > 0 && !params.speed_up) {
+        seek_end = whisper_vad_compact(state->mel, seek_start, std::min(seek_end, state->mel.n_len_org), params, vad_spans);
+    }
 
     // if length of spectrogram is less than 1.0s (100 frames), then return
     // basically don't process anything that is less than 1.0s
@@ -5073,7 +6714,6 @@ int whisper_full_with_state(
         decoder.probs.resize   (ctx->vocab.n_vocab);
         decoder.logits.resize  (ctx->vocab.n_vocab);
         decoder.logprobs.resize(ctx->vocab.n_vocab);
-        decoder.logits_id.reserve(ctx->model.hparams.n_vocab);
 
         decoder.rng = std::mt19937(0);
     }
@@ -5090,8 +6730,7 @@ int whisper_full_with_state(
 
         // initial prompt
         if (!params.prompt_tokens && params.initial_prompt) {
-            prompt_tokens.resize(1024);
-            prompt_tokens.resize(whisper_tokenize(ctx, params.initial_prompt, prompt_tokens.data(), prompt_tokens.size()));
+            prompt_tokens = whisper_tokenize_cached(ctx, params.initial_prompt);
             params.prompt_tokens   = prompt_tokens.data();
             params.prompt_n_tokens = prompt_tokens.size();
         }
@@ -5145,6 +6784,11 @@ int whisper_full_with_state(
     std::vector<whisper_token> prompt;
     prompt.reserve(whisper_n_text_ctx(ctx));
 
+    // the prompt last decoded for the current window, and the logits of its last token - its KV cells are kept in
+    // WHISPER_SEQ_PROMPT, so that the temperature fallbacks with the same prompt do not decode it again
+    std::vector<whisper_token> prompt_decoded;
+    std::vector<float>         prompt_logits;
+
     struct beam_candidate {
         int decoder_idx;
         int seek_delta;
@@ -5180,7 +6824,12 @@ int whisper_full_with_state(
         }
 
         // encode audio features starting at offset seek
-        if (!whisper_encode_internal(*ctx, *state, seek, params.n_threads, params.abort_callback, params.abort_callback_user_data)) {
+        if (params.encode_callback) {
+            if (!params.encode_callback(ctx, state, seek, params.encode_callback_user_data)) {
+                WHISPER_LOG_ERROR("%s: failed to encode\n", __func__);
+                return -6;
+            }
+        } else if (!whisper_encode_internal(*ctx, *state, seek, params.n_threads, params.abort_callback, params.abort_callback_user_data)) {
             WHISPER_LOG_ERROR("%s: failed to encode\n", __func__);
             return -6;
         }
@@ -5191,6 +6840,9 @@ int whisper_full_with_state(
             prompt_past.clear();
         }
 
+        // the cross-attention KV cache has changed
+        prompt_decoded.clear();
+
         int best_decoder_id = 0;
 
         for (int it = 0; it < (int) temperatures.size(); ++it) {
@@ -5245,7 +6897,6 @@ int whisper_full_with_state(
             }
 
             // init prompt and kv cache for the current iteration
-            // TODO: do not recompute the prompt if it is the same as previous time
             {
                 prompt.clear();
 
@@ -5267,20 +6918,37 @@ int whisper_full_with_state(
                 }
                 WHISPER_PRINT_DEBUG("\n\n");
 
-                whisper_kv_cache_clear(state->kv_self);
+                const int n_vocab = ctx->vocab.n_vocab;
+
+                if (prompt == prompt_decoded) {
+                    // the same prompt as the previous iteration - drop the decoded tokens and reuse its KV cells
+                    whisper_kv_cache_seq_keep(state->kv_self, WHISPER_SEQ_PROMPT);
+                    whisper_kv_cache_seq_cp  (state->kv_self, WHISPER_SEQ_PROMPT, 0, -1, -1);
+
+                    state->logits = prompt_logits;
 
-                whisper_batch_prep_legacy(state->batch, prompt.data(), prompt.size(), 0, 0);
+                    state->decoders[0].i_batch = 0;
+                } else {
+                    whisper_kv_cache_clear(state->kv_self);
+
+                    whisper_batch_prep_legacy(state->batch, prompt.data(), prompt.size(), 0, 0);
+
+                    if (!whisper_decode_internal(*ctx, *state, state->batch, params.n_threads, params.abort_callback, params.abort_callback_user_data)) {
+                        WHISPER_LOG_ERROR("%s: failed to decode\n", __func__);
+                        return -7;
+                    }
+
+                    whisper_kv_cache_seq_cp(state->kv_self, 0, WHISPER_SEQ_PROMPT, -1, -1);
+
+                    prompt_decoded = prompt;
+                    prompt_logits.assign(state->logits.end() - n_vocab, state->logits.end());
 
-                if (!whisper_decode_internal(*ctx, *state, state->batch, params.n_threads, params.abort_callback, params.abort_callback_user_data)) {
-                    WHISPER_LOG_ERROR("%s: failed to decode\n", __func__);
-                    return -7;
+                    state->decoders[0].i_batch = prompt.size() - 1;
                 }
 
                 {
                     const int64_t t_start_sample_us = ggml_time_us();
 
-                    state->decoders[0].i_batch = prompt.size() - 1;
-
                     whisper_process_logits(*ctx, *state, state->decoders[0], params, t_cur);
 
                     for (int j = 1; j < n_decoders_cur; ++j) {
@@ -5293,7 +6961,9 @@ int whisper_full_with_state(
                         memcpy(decoder.logprobs.data(), state->decoders[0].logprobs.data(), decoder.logprobs.size()*sizeof(decoder.logprobs[0]));
                     }
 
-                    state->t_sample_us += ggml_time_us() - t_start_sample_us;
+                    const int64_t t_sample_us = ggml_time_us() - t_start_sample_us;
+                    state->t_sample_us += t_sample_us;
+                    whisper_timings_hist_add(state->hist_sample, t_sample_us);
                 }
             }
 
@@ -5369,6 +7039,14 @@ int whisper_full_with_state(
                     }
                 }
 
+                if (params.strategy == whisper_sampling_strategy::WHISPER_SAMPLING_GREEDY) {
+                    for (int j = 0; j < n_decoders_cur; ++j) {
+                        if (!state->decoders[j].completed && !state->decoders[j].failed) {
+                            state->n_sample += 1;
+                        }
+                    }
+                }
+
                 beam_candidates.clear();
                 for (const auto & bc : bc_per_dec) {
                     beam_candidates.insert(beam_candidates.end(), bc.begin(), bc.end());
@@ -5537,7 +7215,9 @@ int whisper_full_with_state(
                     }
                 }
 
-                state->t_sample_us += ggml_time_us() - t_start_sample_us;
+                const int64_t t_sample_us = ggml_time_us() - t_start_sample_us;
+                state->t_sample_us += t_sample_us;
+                whisper_timings_hist_add(state->hist_sample, t_sample_us);
 
                 // obtain logits for the next token
                 {
@@ -5616,7 +7296,9 @@ int whisper_full_with_state(
                         }
                     }
 
-                    state->t_sample_us += ggml_time_us() - t_start_sample_us;
+                    const int64_t t_sample_us = ggml_time_us() - t_start_sample_us;
+                    state->t_sample_us += t_sample_us;
+                    whisper_timings_hist_add(state->hist_sample, t_sample_us);
                 }
             }
 
@@ -5728,8 +7410,8 @@ int whisper_full_with_state(
                         const auto t1 = seek + 2*(tokens_cur[i].tid - whisper_token_beg(ctx));
 
                         if (!text.empty()) {
-                            const auto tt0 = params.speed_up ? 2*t0 : t0;
-                            const auto tt1 = params.speed_up ? 2*t1 : t1;
+                            const auto tt0 = whisper_vad_map(vad_spans, params.speed_up ? 2*t0 : t0, false);
+                            const auto tt1 = whisper_vad_map(vad_spans, params.speed_up ? 2*t1 : t1, true);
 
                             if (params.print_realtime) {
                                 if (params.print_timestamps) {
@@ -5775,8 +7457,8 @@ int whisper_full_with_state(
                 if (!text.empty()) {
                     const auto t1 = seek + seek_delta;
 
-                    const auto tt0 = params.speed_up ? 2*t0 : t0;
-                    const auto tt1 = params.speed_up ? 2*t1 : t1;
+                    const auto tt0 = whisper_vad_map(vad_spans, params.speed_up ? 2*t0 : t0, false);
+                    const auto tt1 = whisper_vad_map(vad_spans, params.speed_up ? 2*t1 : t1, true);
 
                     if (params.print_realtime) {
                         if (params.print_timestamps) {
@@ -5826,37 +7508,131 @@ int whisper_full(
     return whisper_full_with_state(ctx, ctx->state, params, samples, n_samples);
 }
 
-int whisper_full_parallel(
+// the energy of the audio in frames of this many samples (10 ms), used to pick the split points
+#define WHISPER_SPLIT_FRAME 160
+
+// pick the boundaries of n chunks of samples [i0, i1)
+//
+// the energy of each frame is the mean of |x|, smoothed over 300 ms. Like vad_simple() in the examples, a frame is
+// speech when its energy is above 0.6 of the mean - a silent frame weighs 1/4 of a speech frame, since it still has to
+// be encoded. The ideal boundaries split the total weight evenly, and each is moved to the quietest frame within 5 s
+// (but at most a quarter of a chunk), so that the chunks are cut in pauses rather than in the middle of a word
+static std::vector<int> whisper_parallel_splits(const float * samples, int i0, int i1, int n) {
+    std::vector<int> splits(n + 1);
+
+    splits[0] = i0;
+    splits[n] = i1;
+
+    const int n_frames = (i1 - i0)/WHISPER_SPLIT_FRAME;
+
+    if (n_frames < 2*n) {
+        for (int i = 1; i < n; ++i) {
+            splits[i] = i0 + (int) ((int64_t) i*(i1 - i0)/n);
+        }
+        return splits;
+    }
+
+    std::vector<float> energy(n_frames);
+    for (int f = 0; f < n_frames; ++f) {
+        const float * x = samples + i0 + f*WHISPER_SPLIT_FRAME;
+
+        float sum = 0.0f;
+        for (int j = 0; j < WHISPER_SPLIT_FRAME; ++j) {
+            sum += fabsf(x[j]);
+        }
+        energy[f] = sum/WHISPER_SPLIT_FRAME;
+    }
+
+    // moving average over 2*n_smooth + 1 frames
+    const int n_smooth = 15;
+
+    std::vector<float> smooth(n_frames);
+    {
+        double sum = 0.0;
+        int lo = 0;
+        int hi = 0;
+        for (int f = 0; f < n_frames; ++f) {
+            while (hi < n_frames && hi <= f + n_smooth) {
+                sum += energy[hi++];
+            }
+            while (lo < f - n_smooth) {
+                sum -= energy[lo++];
+            }
+            smooth[f] = sum/(hi - lo);
+        }
+    }
+
+    double energy_all = 0.0;
+    for (int f = 0; f < n_frames; ++f) {
+        energy_all += energy[f];
+    }
+    energy_all /= n_frames;
+
+    // cumulative weight of the frames before f
+    std::vector<double> weight(n_frames + 1, 0.0);
+    for (int f = 0; f < n_frames; ++f) {
+        weight[f + 1] = weight[f] + (smooth[f] > 0.6*energy_all ? 1.0 : 0.25);
+    }
+
+    const int n_radius = std::min(500, n_frames/(4*n));
+
+    int f_prev = 0;
+    for (int i = 1; i < n; ++i) {
+        const double target = weight[n_frames]*i/n;
+
+        const int f_target = std::lower_bound(weight.begin(), weight.end(), target) - weight.begin();
+
+        // keep at least one frame in each chunk
+        const int f_lo = std::max(f_prev + 1,                std::max(1, f_target - n_radius));
+        const int f_hi = std::min(n_frames - (n - i), std::min(n_frames - 1, f_target + n_radius));
+
+        int f_best = std::min(std::max(f_target, f_lo), f_hi);
+        for (int f = f_lo; f <= f_hi; ++f) {
+            if (smooth[f] < smooth[f_best] || (smooth[f] == smooth[f_best] && abs(f - f_target) < abs(f_best - f_target))) {
+                f_best = f;
+            }
+        }
+
+        splits[i] = i0 + f_best*WHISPER_SPLIT_FRAME;
+        f_prev = f_best;
+    }
+
+    return splits;
+}
+
+int whisper_full_parallel_with_states(
         struct whisper_context * ctx,
+          struct whisper_state ** states,
         struct whisper_full_params params,
-        const float * samples,
-        int n_samples,
-        int n_processors) {
-    if (n_processors == 1) {
-        return whisper_full(ctx, params, samples, n_samples);
+                   const float * samples,
+                           int   n_samples,
+                           int   n_states) {
+    if (n_states == 1) {
+        return whisper_full_with_state(ctx, states[0], params, samples, n_samples);
     }
     int ret = 0;
 
-    // prepare separate states for each thread
-    std::vector<whisper_state*> states;
+    const int offset_samples = std::min(n_samples, (WHISPER_SAMPLE_RATE*params.offset_ms)/1000);
+
+    int end_samples = n_samples;
+    if (params.duration_ms > 0) {
+        end_samples = std::min(n_samples, offset_samples + (int) (((int64_t) WHISPER_SAMPLE_RATE*params.duration_ms)/1000));
+    }
 
-    const int offset_samples = (WHISPER_SAMPLE_RATE*params.offset_ms)/1000;
-    const int n_samples_per_processor = (n_samples - offset_samples)/n_processors;
+    const std::vector<int> splits = whisper_parallel_splits(samples, offset_samples, end_samples, n_states);
 
     // the calling thread will process the first chunk
     // while the other threads will process the remaining chunks
 
-    std::vector<std::thread> workers(n_processors - 1);
-    for (int i = 0; i < n_processors - 1; ++i) {
-        // create a new state for each thread
-        states.push_back(whisper_init_state(ctx));
-
-        const int start_samples = offset_samples + (i + 1)*n_samples_per_processor;
-        const int n_samples_cur = (i == n_processors - 2) ? n_samples - start_samples : n_samples_per_processor;
+    std::vector<std::thread> workers(n_states - 1);
+    for (int i = 1; i < n_states; ++i) {
+        // the timings of the other states are merged into the first one
+        whisper_reset_timings_state(states[i]);
 
         auto params_cur = params;
 
         params_cur.offset_ms = 0;
+        params_cur.duration_ms = 0;
         params_cur.print_progress = false;
         params_cur.print_realtime = false;
 
@@ -5866,7 +7642,7 @@ int whisper_full_parallel(
         params_cur.progress_callback = nullptr;
         params_cur.progress_callback_user_data = nullptr;
 
-        workers[i] = std::thread(whisper_full_with_state, ctx, states[i], std::move(params_cur), samples + start_samples, n_samples_cur);
+        workers[i - 1] = std::thread(whisper_full_with_state, ctx, states[i], std::move(params_cur), samples + splits[i], splits[i + 1] - splits[i]);
     }
 
     {
@@ -5874,69 +7650,126 @@ int whisper_full_parallel(
 
         // We need to disable the print real-time for this one as well, otherwise it will show only for the first chunk.
         params_cur.print_realtime = false;
+        params_cur.duration_ms = 0;
 
-        // Run the first transformation using default state but only for the first chunk.
-        ret = whisper_full_with_state(ctx, ctx->state, std::move(params_cur), samples, offset_samples + n_samples_per_processor);
+        // Run the first transformation using the first state but only for the first chunk.
+        ret = whisper_full_with_state(ctx, states[0], std::move(params_cur), samples, splits[1]);
     }
 
-    for (int i = 0; i < n_processors - 1; ++i) {
+    for (int i = 0; i < n_states - 1; ++i) {
         workers[i].join();
     }
 
-    const int64_t offset_t = (int64_t) params.offset_ms/10.0;
+    whisper_state * state = states[0];
 
-    // combine results into result_state->result_all from all other states
-    for (int i = 0; i < n_processors - 1; ++i) {
+    // combine results into the result_all of the first state from all other states
+    for (int i = 1; i < n_states; ++i) {
         auto& results_i = states[i]->result_all;
 
+        // the chunk starts at splits[i] samples, i.e. in units of 10 ms
+        const int64_t offset_t = (100*(int64_t) splits[i])/WHISPER_SAMPLE_RATE;
+
         for (auto& result : results_i) {
             // correct the segment timestamp taking into account the offset
-            result.t0 += 100 * ((i + 1) * n_samples_per_processor) / WHISPER_SAMPLE_RATE + offset_t;
-            result.t1 += 100 * ((i + 1) * n_samples_per_processor) / WHISPER_SAMPLE_RATE + offset_t;
+            result.t0 += offset_t;
+            result.t1 += offset_t;
 
             // make sure that segments are not overlapping
-            if (!ctx->state->result_all.empty()) {
-                result.t0 = std::max(result.t0, ctx->state->result_all.back().t1);
+            if (!state->result_all.empty()) {
+                result.t0 = std::max(result.t0, state->result_all.back().t1);
+                result.t1 = std::max(result.t1, result.t0);
+            }
+
+            for (auto & token : result.tokens) {
+                if (token.t0 >= 0) {
+                    token.t0 += offset_t;
+                    token.t1 += offset_t;
+                }
             }
 
-            ctx->state->result_all.push_back(std::move(result));
+            state->result_all.push_back(std::move(result));
 
             // call the new_segment_callback for each segment
             if (params.new_segment_callback) {
-                params.new_segment_callback(ctx, ctx->state, 1, params.new_segment_callback_user_data);
+                params.new_segment_callback(ctx, state, 1, params.new_segment_callback_user_data);
             }
         }
 
-        ctx->state->t_mel_us += states[i]->t_mel_us;
+        results_i.clear();
 
-        ctx->state->t_sample_us += states[i]->t_sample_us;
-        ctx->state->t_encode_us += states[i]->t_encode_us;
-        ctx->state->t_decode_us += states[i]->t_decode_us;
-        ctx->state->t_batchd_us += states[i]->t_batchd_us;
-        ctx->state->t_prompt_us += states[i]->t_prompt_us;
+        state->t_mel_us += states[i]->t_mel_us;
 
-        ctx->state->n_sample += states[i]->n_sample;
-        ctx->state->n_encode += states[i]->n_encode;
-        ctx->state->n_decode += states[i]->n_decode;
-        ctx->state->n_batchd += states[i]->n_batchd;
-        ctx->state->n_prompt += states[i]->n_prompt;
+        state->t_sample_us += states[i]->t_sample_us;
+        state->t_encode_us += states[i]->t_encode_us;
+        state->t_decode_us += states[i]->t_decode_us;
+        state->t_batchd_us += states[i]->t_batchd_us;
+        state->t_prompt_us += states[i]->t_prompt_us;
 
-        whisper_free_state(states[i]);
+        state->n_sample += states[i]->n_sample;
+        state->n_encode += states[i]->n_encode;
+        state->n_decode += states[i]->n_decode;
+        state->n_batchd += states[i]->n_batchd;
+        state->n_prompt += states[i]->n_prompt;
+        state->n_fail_p += states[i]->n_fail_p;
+        state->n_fail_h += states[i]->n_fail_h;
+
+        for (int j = 0; j < WHISPER_TIMINGS_N_BUCKETS; ++j) {
+            state->hist_mel   [j] += states[i]->hist_mel   [j];
+            state->hist_encode[j] += states[i]->hist_encode[j];
+            state->hist_decode[j] += states[i]->hist_decode[j];
+            state->hist_batchd[j] += states[i]->hist_batchd[j];
+            state->hist_prompt[j] += states[i]->hist_prompt[j];
+            state->hist_sample[j] += states[i]->hist_sample[j];
+        }
     }
 
     // average the timings
-    ctx->state->t_mel_us    /= n_processors;
-    ctx->state->t_sample_us /= n_processors;
-    ctx->state->t_encode_us /= n_processors;
-    ctx->state->t_decode_us /= n_processors;
+    state->t_mel_us    /= n_states;
+    state->t_sample_us /= n_states;
+    state->t_encode_us /= n_states;
+    state->t_decode_us /= n_states;
 
     // print information about the audio boundaries
-    WHISPER_LOG_WARN("\n");
-    WHISPER_LOG_WARN("%s: the audio has been split into %d chunks at the following times:\n", __func__, n_processors);
-    for (int i = 0; i < n_processors - 1; ++i) {
-        WHISPER_LOG_WARN("%s: split %d - %s\n", __func__, (i + 1), to_timestamp(100*((i + 1)*n_samples_per_processor)/WHISPER_SAMPLE_RATE + offset_t).c_str());
+    WHISPER_LOG_INFO("\n");
+    WHISPER_LOG_INFO("%s: the audio has been split into %d chunks at the following times:\n", __func__, n_states);
+    for (int i = 1; i < n_states; ++i) {
+        WHISPER_LOG_INFO("%s: split %d - %s\n", __func__, i, to_timestamp((100*(int64_t) splits[i])/WHISPER_SAMPLE_RATE).c_str());
+    }
+    WHISPER_LOG_INFO("%s: the splits are in the quietest parts of the audio, but the context is still lost at the boundaries\n", __func__);
+
+    return ret;
+}
+
+int whisper_full_parallel(
+        struct whisper_context * ctx,
+        struct whisper_full_params params,
+        const float * samples,
+        int n_samples,
+        int n_processors) {
+    if (n_processors == 1) {
+        return whisper_full(ctx, params, samples, n_samples);
+    }
+
+    // the first chunk is processed with the default state, each of the others with a new state
+    std::vector<whisper_state *> states(n_processors);
+
+    states[0] = ctx->state;
+    for (int i = 1; i < n_processors; ++i) {
+        states[i] = whisper_init_state(ctx);
+        if (states[i] == nullptr) {
+            for (int j = 1; j < i; ++j) {
+                whisper_free_state(states[j]);
+            }
+            WHISPER_LOG_ERROR("%s: failed to initialize the state of processor %d\n", __func__, i);
+            return -1;
+        }
+    }
+
+    const int ret = whisper_full_parallel_with_states(ctx, states.data(), params, samples, n_samples, n_processors);
+
+    for (int i = 1; i < n_processors; ++i) {
+        whisper_free_state(states[i]);
     }
-    WHISPER_LOG_WARN("%s: the transcription quality may be degraded near these boundaries\n", __func__);
 
     return ret;
 }
@@ -6388,11 +8221,6 @@ static void whisper_exp_compute_token_level_timestamps(
 
     const int n_samples = state.energy.size();
 
-    if (n_samples == 0) {
-        WHISPER_LOG_ERROR("%s: no signal data available\n", __func__);
-        return;
-    }
-
     const int64_t t0 = segment.t0;
     const int64_t t1 = segment.t1;
 
@@ -6514,8 +8342,8 @@ static void whisper_exp_compute_token_level_timestamps(
     }
 
     // VAD
-    // expand or contract tokens based on voice activity
-    {
+    // expand or contract tokens based on voice activity, when the signal energy is available
+    if (n_samples > 0) {
         const int hw = WHISPER_SAMPLE_RATE/8;
 
         for (int j = 0; j < n; j++) {
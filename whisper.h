@@ -84,8 +84,18 @@ extern "C" {
     typedef int32_t whisper_token;
     typedef int32_t whisper_seq_id;
 
+    // Types of the KV caches of the states
+    enum whisper_kv_type {
+        WHISPER_KV_TYPE_DEFAULT, // the type of the intermediate results (currently f16)
+        WHISPER_KV_TYPE_F16,     // f16
+        WHISPER_KV_TYPE_Q8_0,    // keys in q8_0 and values in f16, CPU backend only - about 0.75x the size of f16
+    };
+
     struct whisper_context_params {
         bool  use_gpu;
+        bool  use_mmap; // with the CPU backend, map the model file instead of reading it (whisper_init_from_file_* only)
+
+        enum whisper_kv_type kv_type;
     };
 
     typedef struct whisper_token_data {
@@ -256,6 +266,45 @@ extern "C" {
                                int   n_len,
                                int   n_mel);
 
+    // Incremental log mel spectrogram for live audio.
+    // whisper_stream_mel_push() appends PCM samples to the stream of the state and computes only the frames that the new
+    // samples complete. The frames are the same as those of whisper_pcm_to_mel() over all samples pushed since the last
+    // reset. whisper_stream_mel_view() then stores the last n_frames frames (0 - all that are kept) inside the state as
+    // its log mel spectrogram, ready for whisper_encode() or whisper_full() with no samples.
+    // whisper_stream_mel_reset() starts a new stream that keeps up to n_frames_max frames (0 - 30 seconds). It is
+    // called with the default by the first push if needed.
+    // push returns the number of new frames, view the number of frames in the view, or a negative value on failure
+    WHISPER_API int whisper_stream_mel_reset(
+            struct whisper_context * ctx,
+                               int   n_frames_max);
+
+    WHISPER_API int whisper_stream_mel_reset_with_state(
+            struct whisper_context * ctx,
+              struct whisper_state * state,
+                               int   n_frames_max);
+
+    WHISPER_API int whisper_stream_mel_push(
+            struct whisper_context * ctx,
+                       const float * samples,
+                               int   n_samples,
+                               int   n_threads);
+
+    WHISPER_API int whisper_stream_mel_push_with_state(
+            struct whisper_context * ctx,
+              struct whisper_state * state,
+                       const float * samples,
+                               int   n_samples,
+                               int   n_threads);
+
+    WHISPER_API int whisper_stream_mel_view(
+            struct whisper_context * ctx,
+                               int   n_frames);
+
+    WHISPER_API int whisper_stream_mel_view_with_state(
+            struct whisper_context * ctx,
+              struct whisper_state * state,
+                               int   n_frames);
+
     // Run the Whisper encoder on the log mel spectrogram stored inside the default state in the provided whisper context.
     // Make sure to call whisper_pcm_to_mel() or whisper_set_mel() first.
     // offset can be used to specify the offset of the first frame in the spectrogram.
@@ -271,6 +320,27 @@ extern "C" {
                                int   offset,
                                int   n_threads);
 
+    // Run the encoder on the log mel spectrograms of several states at once, so that the weights are read once per batch
+    // rather than once per state. Afterwards, each state is as after whisper_encode_with_state(ctx, states[i], offsets[i]).
+    // The states must use the same audio_ctx. The compute buffers of the batch are allocated by whisper_encoder_batch_init()
+    // for up to n_batch_max states - they grow linearly with it.
+    // Returns 0 on success
+    struct whisper_encoder_batch;
+
+    WHISPER_API struct whisper_encoder_batch * whisper_encoder_batch_init(
+            struct whisper_context * ctx,
+                               int   n_batch_max);
+
+    WHISPER_API void whisper_encoder_batch_free(struct whisper_encoder_batch * batch);
+
+    WHISPER_API int whisper_encode_batch(
+            struct whisper_context * ctx,
+      struct whisper_encoder_batch * batch,
+              struct whisper_state ** states,
+                         const int * offsets,
+                               int   n_states,
+                               int   n_threads);
+
     // Run the Whisper decoder to obtain the logits and probabilities for the next token.
     // Make sure to call whisper_encode() first.
     // tokens + n_tokens is the provided context for the decoder.
@@ -357,6 +427,9 @@ extern "C" {
     WHISPER_API int whisper_model_ftype        (struct whisper_context * ctx);
     WHISPER_API int whisper_model_type         (struct whisper_context * ctx);
 
+    // Size of the model weights in bytes
+    WHISPER_API size_t whisper_model_size(struct whisper_context * ctx);
+
     // Token logits obtained from the last call to whisper_decode()
     // The logits for the last token are stored in the last row
     // Rows: n_tokens
@@ -387,6 +460,64 @@ extern "C" {
     WHISPER_API void whisper_print_timings(struct whisper_context * ctx);
     WHISPER_API void whisper_reset_timings(struct whisper_context * ctx);
 
+    // Number of buckets of the per-call duration histograms
+    // Bucket i counts the calls that took [2^i, 2^(i+1)) microseconds - bucket 0 also counts the calls below 1 us and
+    // the last bucket all calls above 2^(WHISPER_TIMINGS_N_BUCKETS - 1) us
+    #define WHISPER_TIMINGS_N_BUCKETS 32
+
+    // Structured performance information - the same numbers as printed by whisper_print_timings()
+    // The times are totals in milliseconds. The decoder calls are split by the number of tokens:
+    //   decode: n_tokens == 1 (text generation), batchd: n_tokens < 16 (batch decoding), prompt: n_tokens >= 16
+    // Note that n_batchd and n_prompt count tokens, while the histograms count calls
+    struct whisper_timings {
+        float load_ms;
+        float mel_ms;
+        float sample_ms;
+        float encode_ms;
+        float decode_ms;
+        float batchd_ms;
+        float prompt_ms;
+        float total_ms;
+
+        int32_t n_sample;
+        int32_t n_encode;
+        int32_t n_decode;
+        int32_t n_batchd;
+        int32_t n_prompt;
+        int32_t n_fail_p;
+        int32_t n_fail_h;
+
+        int32_t hist_mel   [WHISPER_TIMINGS_N_BUCKETS];
+        int32_t hist_encode[WHISPER_TIMINGS_N_BUCKETS];
+        int32_t hist_decode[WHISPER_TIMINGS_N_BUCKETS];
+        int32_t hist_batchd[WHISPER_TIMINGS_N_BUCKETS];
+        int32_t hist_prompt[WHISPER_TIMINGS_N_BUCKETS];
+        int32_t hist_sample[WHISPER_TIMINGS_N_BUCKETS]; // per decoding step, while n_sample counts tokens
+
+        // name of the backend used for the computation (e.g. "CPU", "CUDA", "Metal")
+        const char * backend;
+    };
+
+    WHISPER_API struct whisper_timings whisper_get_timings           (struct whisper_context * ctx);
+    WHISPER_API struct whisper_timings whisper_get_timings_with_state(struct whisper_context * ctx, struct whisper_state * state);
+
+    // Memory used by a state, in bytes - the same numbers as printed by whisper_init_state()
+    // The KV caches and the compute buffers are allocated by the backend, the output buffers are in host memory and
+    // grow with the number of decoders
+    struct whisper_memory {
+        size_t kv_self;        // self-attention KV cache
+        size_t kv_cross;       // cross-attention KV cache
+        size_t compute_conv;   // compute buffers of the graphs
+        size_t compute_encode;
+        size_t compute_cross;
+        size_t compute_decode;
+        size_t output;         // logits and sampling buffers
+        size_t total;
+    };
+
+    WHISPER_API struct whisper_memory whisper_get_memory           (struct whisper_context * ctx);
+    WHISPER_API struct whisper_memory whisper_get_memory_with_state(struct whisper_context * ctx, struct whisper_state * state);
+
     // Print system information
     WHISPER_API const char * whisper_print_system_info(void);
 
@@ -411,6 +542,12 @@ extern "C" {
     // If it returns false, the computation is aborted
     typedef bool (*whisper_encoder_begin_callback)(struct whisper_context * ctx, struct whisper_state * state, void * user_data);
 
+    // Encode callback
+    // If not NULL, called instead of running the encoder on the state, with the offset of the window in the mel spectrogram
+    // Can be used to encode the windows of several states at once with whisper_encode_batch()
+    // If it returns false, the computation is aborted
+    typedef bool (*whisper_encode_callback)(struct whisper_context * ctx, struct whisper_state * state, int offset, void * user_data);
+
     // Abort callback
     // If not NULL, called before ggml computation
     // If it returns true, the computation is aborted
@@ -464,6 +601,14 @@ extern "C" {
         // [EXPERIMENTAL] [TDRZ] tinydiarize
         bool tdrz_enable;       // enable tinydiarize speaker turn detection
 
+        // [EXPERIMENTAL] voice activity detection
+        // the frames of the spectrogram without speech are dropped before the encoder, the timestamps are still in
+        // the time of the input audio
+        bool  vad;                // enable the voice activity detection pre-pass
+        float vad_thold;          // speech threshold, as a fraction of the energy range above the noise floor (~0.3)
+        int   vad_min_silence_ms; // shorter pauses are kept
+        int   vad_pad_ms;         // silence kept on each side of the speech
+
         // tokens to provide to the whisper decoder as initial prompt
         // these are prepended to any existing text context from a previous call
         const char * initial_prompt;
@@ -511,6 +656,10 @@ extern "C" {
         whisper_encoder_begin_callback encoder_begin_callback;
         void * encoder_begin_callback_user_data;
 
+        // called to run the encoder, instead of running it on the state
+        whisper_encode_callback encode_callback;
+        void * encode_callback_user_data;
+
         // called each time before ggml computation starts
         whisper_abort_callback abort_callback;
         void * abort_callback_user_data;
@@ -551,6 +700,7 @@ extern "C" {
     // Result is stored in the default state of the context
     // Not thread safe if executed in parallel on the same context.
     // It seems this approach can offer some speedup in some cases.
+    // The audio is split in the quietest parts, so that each chunk has about the same duration of speech.
     // However, the transcription accuracy can be worse at the beginning and end of each chunk.
     WHISPER_API int whisper_full_parallel(
                 struct whisper_context * ctx,
@@ -559,6 +709,17 @@ extern "C" {
                                    int   n_samples,
                                    int   n_processors);
 
+    // Same as whisper_full_parallel, with n_states chunks processed by the given states instead of the default state
+    // and n_processors - 1 new ones, so that the states can be reused across calls
+    // Result is stored in states[0], and the timings of the other states are reset and added to it
+    WHISPER_API int whisper_full_parallel_with_states(
+                struct whisper_context * ctx,
+                  struct whisper_state ** states,
+            struct whisper_full_params   params,
+                           const float * samples,
+                                   int   n_samples,
+                                   int   n_states);
+
     // Number of generated text segments
     // A segment can be a few words, a sentence, or even a paragraph.
     WHISPER_API int whisper_full_n_segments           (struct whisper_context * ctx);